@@ -27,6 +27,6 @@ setup(
         "sympy~=1.12",
         "numba~=0.61.2",
     ],
-    extras_require={"dev": []},
-    entry_points={'console_scripts': []},
+    extras_require={"dev": ["pytest"]},
+    entry_points={'console_scripts': ['slpn-miner-batch=slpn_miner.batch:main']},
 )
\ No newline at end of file
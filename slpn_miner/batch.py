@@ -0,0 +1,224 @@
+# This file contains the batch discovery of SLPNs over a manifest of jobs, installed as the slpn-miner-batch command.
+# Every job discovers the weights of one petri net from one log and exports them. The logs are read once in the
+# parent process, before the job processes are forked, so the jobs on the same log share its stochastic language.
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+from slpn_miner.instrumentation import Instrumentation
+from slpn_miner.log_util import get_stochastic_language, get_xes_variant_counts
+from slpn_miner.slpn_exporter import export_slpn, export_slpn_xml
+from slpn_miner.slpn_frequency_weights_discovery import get_activity_counts, get_frequency_weights
+from slpn_miner.slpn_opt_entropic_relevance_discovery import optimize_with_er
+from slpn_miner.slpn_opt_uemsc_discovery import optimize_with_uemsc
+from slpn_miner.slpn_unit_weights_discovery import get_unit_weights
+from slpn_miner.util import get_slpn, load_petri_net
+from slpn_miner.worker_pool import TimeoutWorkerPool
+
+
+OBJECTIVES = ("uemsc", "er", "unit", "frequency")
+ENGINES = ("symbolic", "sparse", "prefix_tree", "forward")
+
+# the result of a job whose process died or raised an error outside of run_job
+JOB_FAILED = object()
+
+# the fields of a job, besides the log, the model and at least one output path
+JOB_DEFAULTS = {"name": None, "objective": "uemsc", "engine": "symbolic", "slpn": None, "pnml": None,
+                "time_budget": None, "n_chains": 1}
+
+
+def read_manifest(manifest_path):
+    """
+    Read the jobs of a manifest, a json file holding either a list of jobs or an object with the list of jobs under
+    "jobs" and the fields shared by them under "defaults". A job is an object with the paths of its "log" (an XES
+    file, optionally gzip compressed, or a .slang stochastic language) and its "model" (a pnml file), the paths of
+    its outputs "slpn" and "pnml", of which one may be left out, and optionally its "name", "objective" (one of
+    OBJECTIVES), "engine" (one of ENGINES), "time_budget" of the cross products and "n_chains". Relative paths are
+    relative to the directory of the manifest.
+    :param manifest_path: the path of the manifest
+    :return: the jobs, with all fields of JOB_DEFAULTS
+    """
+    with open(manifest_path) as file:
+        manifest = json.load(file)
+    if isinstance(manifest, list):
+        manifest = {"jobs": manifest}
+    defaults = dict(JOB_DEFAULTS, **manifest.get("defaults", {}))
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+
+    jobs = []
+    for job_idx, job in enumerate(manifest["jobs"]):
+        job = dict(defaults, **job)
+        for field in ("log", "model"):
+            if not job.get(field):
+                raise ValueError(f"Job {job_idx} of {manifest_path} has no {field}.")
+        if job["slpn"] is None and job["pnml"] is None:
+            raise ValueError(f"Job {job_idx} of {manifest_path} has no output, give its slpn or pnml path.")
+        if job["objective"] not in OBJECTIVES:
+            raise ValueError(f"Invalid objective of job {job_idx}: " + str(job["objective"]))
+        if job["engine"] not in ENGINES:
+            raise ValueError(f"Invalid engine of job {job_idx}: " + str(job["engine"]))
+        for field in ("log", "model", "slpn", "pnml"):
+            if job[field] is not None:
+                job[field] = os.path.join(base_dir, os.path.expanduser(job[field]))
+        if job["name"] is None:
+            job["name"] = str(job_idx)
+        jobs.append(job)
+    return jobs
+
+
+def read_log(log_path):
+    """
+    :param log_path: the path of an XES file, optionally gzip compressed, or of a .slang stochastic language
+    :return: the stochastic language of the log, and the number of traces of every variant, None for a .slang file,
+             which only holds the probabilities
+    """
+    if log_path.endswith(".slang"):
+        return get_stochastic_language(log_path), None
+    variant_counts = get_xes_variant_counts(log_path)
+    all_counts_sum = sum(variant_counts.values())
+    return {variant: count / all_counts_sum for variant, count in variant_counts.items()}, variant_counts
+
+
+# the logs read by read_log, inherited from the parent process by every job process
+_logs = None
+
+
+def init_batch_worker(logs):
+    global _logs
+    _logs = logs
+
+
+def run_job(args):
+    """
+    Discover the weights of the model of a job from its log and export them.
+    :param args: the job and the number of processes its cross products are computed by
+    :return: the record of the job, with its status, the error if it failed, and the time of every phase
+    """
+    job, processes = args
+    record = {"name": job["name"], "log": job["log"], "model": job["model"], "objective": job["objective"],
+              "engine": job["engine"], "status": "done", "error": None}
+    instrumentation = Instrumentation()
+    start_time = time.perf_counter()
+    try:
+        log = _logs[job["log"]]
+        if isinstance(log, Exception):
+            raise ValueError("Cannot read the log: " + str(log))
+        stochastic_lang, variant_counts = log
+        with instrumentation.phase("model"):
+            pn, im, fm = load_petri_net(job["model"])
+        if job["objective"] == "uemsc":
+            trans2weight = optimize_with_uemsc(stochastic_lang, pn, im, fm, engine=job["engine"],
+                                               n_chains=job["n_chains"], instrumentation=instrumentation,
+                                               time_budget=job["time_budget"], processes=processes)
+        elif job["objective"] == "er":
+            trans2weight = optimize_with_er(stochastic_lang, pn, im, fm, engine=job["engine"],
+                                            n_chains=job["n_chains"], instrumentation=instrumentation,
+                                            time_budget=job["time_budget"], processes=processes)
+        elif job["objective"] == "unit":
+            trans2weight = get_unit_weights(pn)
+        else:
+            # the weights are the absolute activity counts, as in the benchmark, which a .slang file does not hold
+            if variant_counts is None:
+                raise ValueError("The frequency objective needs the trace counts of an XES log, not a .slang file.")
+            trans2weight = get_frequency_weights(pn, get_activity_counts(variant_counts))
+
+        with instrumentation.phase("export"):
+            if job["slpn"] is not None:
+                place_in_im_num, place2num, t2l, t2op_num, t2ip_num = get_slpn(pn, im)
+                export_slpn(job["slpn"], place_in_im_num, place2num, t2l, t2ip_num, t2op_num, trans2weight)
+            if job["pnml"] is not None:
+                export_slpn_xml(job["pnml"], pn, im, trans2weight, final_marking=fm)
+    except Exception as e:
+        logging.exception(f"Job {job['name']} failed")
+        record["status"] = "failed"
+        record["error"] = str(e)
+    record["time"] = time.perf_counter() - start_time
+    record["phases"] = {name: phase["time"] for name, phase in instrumentation.phases.items()}
+    return record
+
+
+def run_batch(jobs, n_jobs=1, processes=None, job_timeout=None):
+    """
+    Run the jobs concurrently, each in a process of its own.
+    :param jobs: the jobs, see read_manifest
+    :param n_jobs: the number of jobs run at the same time
+    :param processes: the number of processes computing the cross products of every job, the number of cpus divided
+                      by n_jobs by default
+    :param job_timeout: the time in seconds after which a job is killed, None to never kill a job
+    :return: the records of the jobs, in their order, see run_job, and the time of reading every log
+    """
+    if processes is None:
+        processes = max(1, (os.cpu_count() or 1) // n_jobs)
+
+    # every log is read once, however many jobs use it; the jobs on a log that cannot be read fail
+    logs = {}
+    log_times = {}
+    for job in jobs:
+        if job["log"] not in logs:
+            start_time = time.perf_counter()
+            try:
+                logs[job["log"]] = read_log(job["log"])
+                logging.info(f"Read {len(logs[job['log']][0])} trace variants from {job['log']}.")
+            except Exception as e:
+                logging.exception(f"Cannot read the log {job['log']}")
+                logs[job["log"]] = e
+            log_times[job["log"]] = time.perf_counter() - start_time
+
+    # the job processes are forked, so they inherit the stochastic languages instead of receiving them pickled, and
+    # they are not daemonic, so they can start the processes computing their cross products, which are killed with
+    # the process group of their job
+    with TimeoutWorkerPool(run_job, initializer=init_batch_worker, initargs=(logs,), processes=n_jobs,
+                           context="fork", daemon=False, process_group=True) as pool:
+        results = pool.map([(job, processes) for job in jobs], timeout=job_timeout, error=JOB_FAILED)
+        errors = pool.errors
+
+    records = []
+    for job_idx, (job, record) in enumerate(zip(jobs, results)):
+        # a job that raised an error is recorded by run_job, these are the jobs killed or whose process died
+        if record is None or record is JOB_FAILED:
+            failed = record is JOB_FAILED
+            record = {"name": job["name"], "log": job["log"], "model": job["model"], "objective": job["objective"],
+                      "engine": job["engine"], "status": "failed" if failed else "timed out",
+                      "error": errors.get(job_idx) if failed else None, "time": None if failed else job_timeout,
+                      "phases": {}}
+        records.append(record)
+    return records, log_times
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Discover SLPNs for every job of a manifest.")
+    parser.add_argument("manifest", help="the json file of the jobs, see read_manifest")
+    parser.add_argument("--jobs", type=int, default=1, help="the number of jobs run at the same time")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="the number of processes computing the cross products of every job")
+    parser.add_argument("--job-timeout", type=float, default=None, help="the time in seconds after which a job is "
+                                                                        "killed")
+    parser.add_argument("--summary", help="the json file the timing summary is written to")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    jobs = read_manifest(args.manifest)
+    start_time = time.perf_counter()
+    records, log_times = run_batch(jobs, n_jobs=args.jobs, processes=args.processes, job_timeout=args.job_timeout)
+    total_time = time.perf_counter() - start_time
+    if args.summary:
+        with open(args.summary, "w") as file:
+            json.dump({"time": total_time, "logs": log_times, "jobs": records}, file, indent=1)
+
+    for log, log_time in log_times.items():
+        print(f"log {log}: {log_time:.3f}")
+    for record in records:
+        time_text = "-" if record["time"] is None else f"{record['time']:.3f}"
+        phases = ", ".join(f"{name} {phase_time:.3f}" for name, phase_time in record["phases"].items())
+        print(f"job {record['name']} ({record['objective']}, {record['engine']}): {record['status']} {time_text}"
+              + (f" [{phases}]" if phases else "") + (f" {record['error']}" if record["error"] else ""))
+    failed = [record for record in records if record["status"] != "done"]
+    print(f"{len(records) - len(failed)} of {len(records)} jobs done in {total_time:.3f}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
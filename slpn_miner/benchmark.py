@@ -0,0 +1,317 @@
+# This file contains a benchmark of the discovery phases on the bundled models.
+# Every model gets a synthetic log sampled from its own reachability graph with a fixed seed, so two runs measure the
+# same work, and the results of a run can be compared with the ones saved by an earlier run.
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+import numpy as np
+import pm4py
+from pm4py.objects.petri_net.utils import final_marking, initial_marking
+
+from slpn_miner.compact_reachability_graph import CompactReachabilityGraph, ProbabilityMatrix
+from slpn_miner.instrumentation import Instrumentation, get_peak_memory, reset_peak_memory
+from slpn_miner.silent_closure import SilentClosure
+from slpn_miner.slpn_frequency_weights_discovery import get_activity_counts, get_frequency_weights
+from slpn_miner.slpn_opt_entropic_relevance_discovery import get_er_obj_func, get_sparse_er_obj_func
+from slpn_miner.slpn_opt_entropic_relevance_discovery import \
+    optimize_with_basin_hopping as optimize_er_with_basin_hopping
+from slpn_miner.slpn_opt_uemsc_discovery import get_uemsc_obj_func, get_sparse_uemsc_obj_func
+from slpn_miner.slpn_opt_uemsc_discovery import \
+    optimize_with_basin_hopping as optimize_uemsc_with_basin_hopping
+from slpn_miner.slpn_unit_weights_discovery import get_unit_weights
+from slpn_miner.util import setup
+
+# one model of every dataset in data/
+DEFAULT_MODELS = [
+    "data/road/road_id0.2.pnml",
+    "data/prepaid/prepaid_id02.pnml",
+    "data/domestic/domestic_id0.2.pnml",
+    "data/request/request_id0.2.pnml",
+    "data/offer/offer_id0.2.pnml",
+    "data/ccc20/a_id02.pnml",
+    "data/prAm6/prAm6.pnml",
+    "data/hospital/hospital_id02.pnml",
+]
+
+ENGINES = ("symbolic", "sparse", "prefix_tree", "forward")
+
+
+@contextmanager
+def measure_phase(record):
+    """Store the wall time and the peak memory of the enclosed code in the record dict"""
+    reset_peak_memory()
+    start_time = time.perf_counter()
+    yield record
+    record["time"] = time.perf_counter() - start_time
+    record["peak_memory_mb"] = get_peak_memory()
+
+
+def load_model(model_path):
+    """
+    :param model_path: the path of a pnml file
+    :return: the petri net, with its transitions renamed n0, n1, ... in the order of their ids, and its markings,
+             which are discovered if the file has none
+    """
+    pn, im, fm = pm4py.read_pnml(model_path, auto_guess_final_marking=True)
+    if not im:
+        im = initial_marking.discover_initial_marking(pn)
+    if not fm:
+        fm = final_marking.discover_final_marking(pn)
+    for trans_idx, trans in enumerate(sorted(pn.transitions, key=lambda trans: trans.name)):
+        trans.name = "n" + str(trans_idx)
+    return pn, im, fm
+
+
+def sample_stochastic_language(srg, n_traces, seed=0, max_trace_length=50, var_lst=None):
+    """
+    Sample traces by walking the srg from its initial state until a final state is reached. Walks longer than
+    max_trace_length are discarded.
+    :param srg: the CompactReachabilityGraph
+    :param n_traces: the number of walks
+    :param seed: the seed of the walks
+    :param max_trace_length: the maximal number of transitions fired by a walk
+    :param var_lst: the weight of every transition of the srg, in its order, every enabled transition is equally
+                    likely by default
+    :return: the number of times every trace was sampled, in the order they were first sampled
+    """
+    rng = np.random.default_rng(seed)
+    cumulative_probs = None
+    if var_lst is not None:
+        # the probabilities of the arcs of every state add up to 1, their running sums within the state pick an arc
+        running_probs = np.concatenate([[0.0], np.cumsum(ProbabilityMatrix(srg).refill(var_lst).data)])
+        cumulative_probs = running_probs[1:] - np.repeat(running_probs[srg.arc_ptr[:-1]], np.diff(srg.arc_ptr))
+    variant_counts = Counter()
+    for _ in range(n_traces):
+        state = srg.initial_state
+        trace = []
+        for _ in range(max_trace_length):
+            n_arcs = srg.arc_ptr[state + 1] - srg.arc_ptr[state]
+            if n_arcs == 0:
+                variant_counts[tuple(trace)] += 1
+                break
+            if cumulative_probs is None:
+                arc = srg.arc_ptr[state] + rng.integers(n_arcs)
+            else:
+                state_probs = cumulative_probs[srg.arc_ptr[state]:srg.arc_ptr[state + 1]]
+                arc = srg.arc_ptr[state] + min(np.searchsorted(state_probs, rng.random(), side="right"), n_arcs - 1)
+            label = srg.get_label(arc)
+            if label is not None:
+                trace.append(label)
+            state = srg.arc_to[arc]
+    return variant_counts
+
+
+def benchmark_cross_products(pn, im, fm, stochastic_lang, engine, processes=None, timeout=15):
+    """
+    Compute the trace probabilities with setup, instrumented. The peak memory of the engines computing the cross
+    products in worker processes is the largest peak of a worker over a trace.
+    :return: obj2add and the variable maps of setup, and the phase record
+    """
+    instrumentation = Instrumentation()
+    record = {}
+    with measure_phase(record):
+        obj2add, var_name2idx_map, var_idx2name_map, _ = setup(stochastic_lang, pn, im, fm, engine=engine,
+                                                               processes=processes, instrumentation=instrumentation,
+                                                               timeout=timeout)
+    # setup also builds the srg, which is measured on its own
+    record["time"] = instrumentation.phases.get("cross_products", {}).get("time", 0.0)
+    record["n_traces"] = len(stochastic_lang)
+    record["n_fitting"] = len(obj2add)
+    record["n_timeouts"] = sum(trace_record.get("timed_out", False) for trace_record in instrumentation.traces)
+    record["n_skipped"] = sum(trace_record.get("skipped", False) for trace_record in instrumentation.traces)
+    if instrumentation.traces:
+        record["build_time"] = sum(trace_record.get("build_time") or 0.0 for trace_record in instrumentation.traces)
+        record["solve_time"] = sum(trace_record.get("solve_time") or 0.0 for trace_record in instrumentation.traces)
+        record["traces"] = [{field: value for field, value in trace_record.items() if field != "trace"}
+                            for trace_record in instrumentation.traces]
+        # the cross products are built in the worker processes, whose peak the parent process does not see
+        worker_peaks = [trace_record["peak_memory_mb"] for trace_record in instrumentation.traces
+                        if trace_record.get("peak_memory_mb") is not None]
+        if worker_peaks:
+            record["parent_peak_memory_mb"] = record["peak_memory_mb"]
+            record["peak_memory_mb"] = max(worker_peaks)
+    return obj2add, var_name2idx_map, var_idx2name_map, record
+
+
+def get_objective_functions(obj2add, var_name2idx_map, engine):
+    if engine == "symbolic":
+        return {"uemsc": get_uemsc_obj_func(obj2add, var_name2idx_map, jac=True),
+                "er": get_er_obj_func(obj2add, var_name2idx_map, jac=True)}
+    return {"uemsc": get_sparse_uemsc_obj_func(obj2add, jac=True), "er": get_sparse_er_obj_func(obj2add, jac=True)}
+
+
+def benchmark_model(model_path, n_traces=200, engines=ENGINES, n_evaluations=200, optimize=True, seed=0,
+                    processes=None, timeout=15):
+    """
+    Run every phase of the discovery on one model.
+    :param model_path: the path of the pnml file
+    :param n_traces: the number of traces sampled from the model, see sample_stochastic_language
+    :param engines: the engines computing the trace probabilities, see setup
+    :param n_evaluations: the number of evaluations of every objective function to measure their throughput
+    :param optimize: whether to run the basin hopping optimisation of both objectives
+    :param seed: the seed of the sampled log and of the evaluated weights
+    :param processes: the number of worker processes computing the cross products
+    :param timeout: the time in seconds after which the cross product of a trace is given up
+    :return: the results as a dict
+    """
+    pn, im, fm = load_model(model_path)
+    result = {"model": model_path, "n_transitions": len(pn.transitions), "phases": {}, "engines": {}}
+
+    with measure_phase(result["phases"].setdefault("srg", {})):
+        srg = CompactReachabilityGraph.from_petri_net(pn, im)
+    with measure_phase(result["phases"].setdefault("silent_closure", {})):
+        # the weights of the closure are solved on demand, so the ones of every silent component are solved here
+        closure = SilentClosure(srg)
+        for component in closure.components:
+            closure.get_weights(component[0])
+    result["n_states"] = srg.n_states
+    result["n_arcs"] = len(srg.arc_to)
+
+    variant_counts = sample_stochastic_language(srg, n_traces, seed=seed)
+    all_counts_sum = sum(variant_counts.values())
+    stochastic_lang = {trace: count / all_counts_sum for trace, count in variant_counts.items()}
+    result["n_variants"] = len(stochastic_lang)
+
+    # the reference weights, the objectives are evaluated at them with every engine
+    reference_weights = {"unit": get_unit_weights(pn),
+                         "frequency": get_frequency_weights(pn, get_activity_counts(variant_counts))}
+
+    rng = np.random.default_rng(seed)
+    evaluation_points = rng.uniform(0.0001, 1, size=(n_evaluations, len(pn.transitions)))
+    for engine in engines:
+        engine_result = result["engines"].setdefault(engine, {})
+        obj2add, var_name2idx_map, var_idx2name_map, engine_result["cross_products"] = benchmark_cross_products(
+            pn, im, fm, stochastic_lang, engine, processes=processes, timeout=timeout)
+        if not obj2add:
+            logging.warning(f"No sampled trace of {model_path} fits with the {engine} engine.")
+            continue
+
+        with measure_phase(engine_result.setdefault("compile", {})):
+            objective_functions = get_objective_functions(obj2add, var_name2idx_map, engine)
+
+        for objective, objective_function in objective_functions.items():
+            evaluate_record = engine_result.setdefault("evaluate_" + objective, {})
+            with measure_phase(evaluate_record):
+                for x in evaluation_points:
+                    objective_function(x)
+            evaluate_record["evaluations_per_second"] = n_evaluations / evaluate_record["time"]
+
+            for reference, trans2weight in reference_weights.items():
+                x = np.array([trans2weight[var_idx2name_map[idx]] for idx in range(len(var_idx2name_map))],
+                             dtype=np.float64)
+                engine_result.setdefault(reference + "_weights", {})[objective] = float(objective_function(x)[0])
+
+        if optimize:
+            x0 = [1] * len(pn.transitions)
+            for objective, optimize_with_basin_hopping in (("uemsc", optimize_uemsc_with_basin_hopping),
+                                                          ("er", optimize_er_with_basin_hopping)):
+                optimize_record = engine_result.setdefault("optimize_" + objective, {})
+                with measure_phase(optimize_record):
+                    x = optimize_with_basin_hopping(x0, objective_functions[objective], jac=True)
+                optimize_record["objective"] = float(objective_functions[objective](x)[0])
+    return result
+
+
+def run_benchmark(model_paths=None, **kwargs):
+    """
+    :param model_paths: the pnml files, DEFAULT_MODELS by default
+    :param kwargs: the settings of benchmark_model
+    :return: the results of all models, together with the settings and the environment
+    """
+    model_paths = DEFAULT_MODELS if model_paths is None else model_paths
+    results = {"settings": dict(kwargs), "cpu_count": os.cpu_count(), "python": sys.version.split()[0],
+               "models": {}}
+    for model_path in model_paths:
+        logging.info(f"Benchmarking {model_path}")
+        results["models"][model_path] = benchmark_model(model_path, **kwargs)
+    return results
+
+
+def get_timings(results):
+    """
+    :return: every time measured in the results, as a dict from its path, e.g. "road.pnml/engines/sparse/compile",
+             to seconds; the timeouts are counted too
+    """
+    timings = {}
+
+    def collect(record, path):
+        for key, value in record.items():
+            if isinstance(value, dict):
+                collect(value, path + "/" + key)
+            elif key in ("time", "build_time", "solve_time", "n_timeouts"):
+                timings[path + ("" if key == "time" else "/" + key)] = value
+
+    for model_path, model_result in results["models"].items():
+        collect(model_result, model_path)
+    return timings
+
+
+def compare_with_baseline(results, baseline, tolerance=0.2, min_difference=0.05):
+    """
+    :param results: the results of run_benchmark
+    :param baseline: the results of an earlier run
+    :param tolerance: the relative slow down that counts as a regression
+    :param min_difference: the absolute slow down in seconds below which it is considered noise
+    :return: the comparison of every timing in both runs, as a list of (path, baseline, current, ratio, regressed)
+    """
+    timings = get_timings(results)
+    baseline_timings = get_timings(baseline)
+    comparison = []
+    for path, value in timings.items():
+        if path not in baseline_timings:
+            continue
+        baseline_value = baseline_timings[path]
+        ratio = value / baseline_value if baseline_value > 0 else (1.0 if value == 0 else float("inf"))
+        if path.endswith("n_timeouts"):
+            regressed = value > baseline_value
+        else:
+            regressed = value > baseline_value * (1 + tolerance) and value - baseline_value > min_difference
+        comparison.append((path, baseline_value, value, ratio, regressed))
+    return comparison
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the SLPN discovery on petri net models.")
+    parser.add_argument("models", nargs="*", help="the pnml files, one model of every dataset in data/ by default")
+    parser.add_argument("--traces", type=int, default=200, help="the number of traces sampled from every model")
+    parser.add_argument("--engines", nargs="+", choices=ENGINES, default=list(ENGINES))
+    parser.add_argument("--evaluations", type=int, default=200,
+                        help="the number of evaluations of every objective function")
+    parser.add_argument("--no-optimize", action="store_true", help="skip the basin hopping optimisation")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--timeout", type=float, default=15, help="the timeout of one cross product in seconds")
+    parser.add_argument("--output", help="the json file the results are written to")
+    parser.add_argument("--baseline", help="the json file of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="the relative slow down that is a regression")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.models or None, n_traces=args.traces, engines=args.engines,
+                            n_evaluations=args.evaluations, optimize=not args.no_optimize, seed=args.seed,
+                            processes=args.processes, timeout=args.timeout)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=1)
+
+    for path, value in get_timings(results).items():
+        print(f"{path}: {value:.3f}")
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        comparison = compare_with_baseline(results, baseline, tolerance=args.tolerance)
+        regressions = [row for row in comparison if row[4]]
+        for path, baseline_value, value, ratio, _ in regressions:
+            print(f"REGRESSION {path}: {baseline_value:.3f} -> {value:.3f} ({ratio:.2f}x)")
+        print(f"{len(regressions)} regressions out of {len(comparison)} timings compared with {args.baseline}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,175 @@
+# This file contains a compact stochastic reachability graph.
+# States are integers and the arcs are CSR arrays, so the graph takes little memory and is cheap to pickle to the
+# worker processes. The symbolic arcs used by the cross products are only built for the states they visit. The numeric
+# probabilities of the arcs are refilled in place for every weight vector, see ProbabilityMatrix.
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from slpn_miner.stochastic_reachability_graph import marking_flow_incidence
+
+
+class CompactReachabilityGraph(object):
+    """
+    The stochastic reachability graph of a petri net as CSR arrays.
+
+    The arcs leaving state s are arc_ptr[s]..arc_ptr[s+1]-1, each with its target state, the index of the petri net
+    transition it fires and the index of its label (-1 for silent transitions). The transitions enabled in a state
+    form its normaliser group; the distinct enabled sets are interned into a table shared by all states with the
+    same set. The initial marking is state 0 and the final states are the states without outgoing arcs.
+    """
+
+    def __init__(self, transition_names, transition_labels, arc_ptr, arc_to, arc_transition):
+        """
+        :param transition_names: the name of every petri net transition
+        :param transition_labels: the label of every petri net transition, None for silent transitions
+        :param arc_ptr: CSR pointer into the arcs, one entry per state
+        :param arc_to: the target state of every arc
+        :param arc_transition: the index of the transition fired by every arc
+        """
+        self.transition_names = list(transition_names)
+        self.labels = sorted({label for label in transition_labels if label is not None})
+        label_to_idx = {label: idx for idx, label in enumerate(self.labels)}
+        self.transition_label = np.array([-1 if label is None else label_to_idx[label] for label in transition_labels],
+                                         dtype=np.int32)
+
+        self.arc_ptr = np.asarray(arc_ptr, dtype=np.int64)
+        self.arc_to = np.asarray(arc_to, dtype=np.int32)
+        self.arc_transition = np.asarray(arc_transition, dtype=np.int32)
+        self.arc_label = self.transition_label[self.arc_transition]
+        self.n_states = len(self.arc_ptr) - 1
+        self.initial_state = 0
+        self.final_states = np.flatnonzero(np.diff(self.arc_ptr) == 0)
+
+        # the table of distinct enabled sets
+        group_to_idx = {}
+        self.state_group = np.zeros(self.n_states, dtype=np.int32)
+        group_ptr = [0]
+        group_transitions = []
+        for state in range(self.n_states):
+            enabled = tuple(self.arc_transition[self.arc_ptr[state]:self.arc_ptr[state + 1]].tolist())
+            if enabled not in group_to_idx:
+                group_to_idx[enabled] = len(group_to_idx)
+                group_transitions.extend(enabled)
+                group_ptr.append(len(group_transitions))
+            self.state_group[state] = group_to_idx[enabled]
+        self.group_ptr = np.array(group_ptr, dtype=np.int64)
+        self.group_transitions = np.array(group_transitions, dtype=np.int32)
+
+        self.__outgoing = {}
+
+    def __getstate__(self):
+        # the symbolic arcs are rebuilt on demand
+        state = self.__dict__.copy()
+        state["_CompactReachabilityGraph__outgoing"] = {}
+        return state
+
+    @classmethod
+    def from_petri_net(cls, net, im, parameters=None):
+        """
+        :param net: petri net
+        :param im: initial marking
+        :return: the compact reachability graph of the petri net
+        """
+        _, transitions, markings, arc_from, arc_to, arc_transition = marking_flow_incidence(net, im,
+                                                                                          parameters=parameters)
+        # the arcs are grouped by source state
+        arc_ptr = np.searchsorted(arc_from, np.arange(len(markings) + 1))
+        return cls([transition.name for transition in transitions], [transition.label for transition in transitions],
+                   arc_ptr, arc_to, arc_transition)
+
+    def get_label(self, arc):
+        label_idx = self.arc_label[arc]
+        return None if label_idx < 0 else self.labels[label_idx]
+
+    def get_enabled_transitions(self, state):
+        """
+        :return: the indices of the transitions enabled in the state, i.e. its normaliser group
+        """
+        group = self.state_group[state]
+        return self.group_transitions[self.group_ptr[group]:self.group_ptr[group + 1]]
+
+    def get_probability_expression(self, arc):
+        """
+        :param arc: the arc id
+        :return: the probability of the arc as an inverse poland expression, e.g. ("n3", "n3", "n5", "+", "/")
+        """
+        state = np.searchsorted(self.arc_ptr, arc, side="right") - 1
+        arcs = range(self.arc_ptr[state], self.arc_ptr[state + 1])
+        if len(arcs) == 1:
+            return ("1",)
+        expression = [self.transition_names[self.arc_transition[arc]]]
+        for idx, other_arc in enumerate(arcs):
+            expression.append(self.transition_names[self.arc_transition[other_arc]])
+            if idx > 0:
+                expression.append("+")
+        expression.append("/")
+        return tuple(expression)
+
+    def get_outgoing(self, state):
+        """
+        The arcs leaving a state as ((arc name, transition name, label, probability string), next state), where the
+        probability string is like "n3/(n3+n5)".
+        :param state: the state id
+        :return: the list of outgoing arcs
+        """
+        outgoing = self.__outgoing.get(state)
+        if outgoing is None:
+            arcs = range(self.arc_ptr[state], self.arc_ptr[state + 1])
+            total_trans_weight = "(" + "+".join(self.transition_names[self.arc_transition[arc]] for arc in arcs) + ")"
+            outgoing = []
+            for arc in arcs:
+                transition_name = self.transition_names[self.arc_transition[arc]]
+                transition_prob = "1" if len(arcs) == 1 else transition_name + "/" + total_trans_weight
+                outgoing.append((("t" + str(arc), transition_name, self.get_label(arc), transition_prob),
+                                 int(self.arc_to[arc])))
+            self.__outgoing[state] = outgoing
+        return outgoing
+
+
+class ProbabilityMatrix(object):
+    """
+    The transition probability matrix P(w) of a CompactReachabilityGraph as a scipy CSR matrix, whose entries are
+    refilled in place for every weight vector.
+
+    The entries are the arcs of the srg in their order, so matrix.data[arc] is the probability of the arc; two arcs
+    between the same states are kept as two entries, which the matrix products add up. The weight of every arc is
+    gathered from the weight vector, the normaliser of every state is the segmented sum of the weights of its arcs,
+    and both are written to buffers allocated once.
+    """
+
+    def __init__(self, srg, var_name2idx_map=None):
+        """
+        :param srg: the CompactReachabilityGraph
+        :param var_name2idx_map: map transition to value in var_lst, the transitions of the srg in order by default
+        """
+        if var_name2idx_map is None:
+            transition_var = np.arange(len(srg.transition_names), dtype=np.int64)
+        else:
+            transition_var = np.array([var_name2idx_map[name] for name in srg.transition_names], dtype=np.int64)
+        self.arc_var = transition_var[srg.arc_transition]
+        n_arcs = len(self.arc_var)
+        self.matrix = csr_matrix((np.zeros(n_arcs, dtype=np.float64), srg.arc_to, srg.arc_ptr),
+                                 shape=(srg.n_states, srg.n_states))
+
+        # the states with arcs, the final states have no normaliser
+        self.__row_starts = srg.arc_ptr[:-1][np.diff(srg.arc_ptr) > 0]
+        self.arc_row = np.repeat(np.arange(len(self.__row_starts)), np.diff(np.append(self.__row_starts, n_arcs)))
+        self.arc_weights = np.zeros(n_arcs, dtype=np.float64)
+        self.row_normalisers = np.zeros(len(self.__row_starts), dtype=np.float64)
+        self.arc_normalisers = np.zeros(n_arcs, dtype=np.float64)
+
+    @property
+    def arc_probs(self):
+        return self.matrix.data
+
+    def refill(self, var_lst):
+        """
+        :param var_lst: the weight of every transition
+        :return: the matrix, with the probabilities of var_lst
+        """
+        np.take(np.asarray(var_lst, dtype=np.float64), self.arc_var, out=self.arc_weights)
+        if len(self.__row_starts) > 0:
+            np.add.reduceat(self.arc_weights, self.__row_starts, out=self.row_normalisers)
+        np.take(self.row_normalisers, self.arc_row, out=self.arc_normalisers)
+        np.divide(self.arc_weights, self.arc_normalisers, out=self.matrix.data)
+        return self.matrix
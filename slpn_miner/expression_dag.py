@@ -0,0 +1,263 @@
+# This file contains the compiler of the symbolic trace probabilities into one expression DAG.
+# All traces are hash-consed into a single program, such that a subterm shared by several traces, e.g. the
+# normaliser (n1+n2+n3) of a marking, is evaluated once per weight vector and differentiated once per gradient.
+# Compiling a DAG selects numba's fork-safe workqueue threading layer, unless a layer was configured before, see
+# use_fork_safe_threading_layer; importing this file does not change the configuration of numba.
+import os
+
+import numba
+import numpy as np
+
+from slpn_miner.symbolic_conversion import plus_idx, minus_idx, prod_idx, div_idx
+
+
+operator_indexes = {'+': plus_idx, '-': minus_idx, '*': prod_idx, '/': div_idx}
+
+# levels narrower than this are swept serially, the threads would cost more than they save
+min_parallel_width = 1024
+
+
+def use_fork_safe_threading_layer():
+    """
+    The worker pools fork processes that evaluate the objective too, after the parent may have evaluated it already;
+    TBB then hangs at exit and GNU OpenMP aborts the child. So the workqueue layer is selected before the first
+    evaluation, unless the threading layer was set in numba.config or by the NUMBA_THREADING_LAYER or
+    NUMBA_THREADING_LAYER_PRIORITY environment variables.
+    """
+    if numba.config.THREADING_LAYER == "default" and "NUMBA_THREADING_LAYER" not in os.environ \
+            and "NUMBA_THREADING_LAYER_PRIORITY" not in os.environ:
+        numba.config.THREADING_LAYER = "workqueue"
+
+
+@numba.njit(inline='always')
+def evaluate_node_numba(node, op_code, op_left, op_right, n_leaves, values):
+    op = node - n_leaves
+    p2 = values[op_left[op]]
+    p1 = values[op_right[op]]
+    code = op_code[op]
+    if code == plus_idx:
+        values[node] = p2 + p1
+    elif code == minus_idx:
+        values[node] = p2 - p1
+    elif code == prod_idx:
+        values[node] = p2 * p1
+    else:
+        values[node] = p2 / p1
+
+
+@numba.njit(parallel=True, cache=True)
+def evaluate_expression_dag_numba(op_code, op_left, op_right, level_ptr, n_leaves, values):
+    """
+    Evaluate the operator nodes of a DAG level by level, values must hold the leaves already.
+    The nodes of one level only depend on lower levels, so they are evaluated in parallel.
+    """
+    for level in range(1, len(level_ptr) - 1):
+        start = level_ptr[level]
+        end = level_ptr[level + 1]
+        if end - start >= min_parallel_width:
+            for node in numba.prange(start, end):
+                evaluate_node_numba(node, op_code, op_left, op_right, n_leaves, values)
+        else:
+            for node in range(start, end):
+                evaluate_node_numba(node, op_code, op_left, op_right, n_leaves, values)
+
+
+@numba.njit(inline='always')
+def pull_adjoint_numba(node, op_code, op_left, op_right, parent_ptr, parent_node, parent_side, n_leaves, values,
+                       adjoints):
+    total = 0.0
+    for k in range(parent_ptr[node], parent_ptr[node + 1]):
+        parent = parent_node[k]
+        adjoint = adjoints[parent]
+        if adjoint == 0.0:
+            continue
+        op = parent - n_leaves
+        code = op_code[op]
+        if parent_side[k] == 0:
+            if code == plus_idx or code == minus_idx:
+                total += adjoint
+            elif code == prod_idx:
+                total += adjoint * values[op_right[op]]
+            else:
+                total += adjoint / values[op_right[op]]
+        else:
+            if code == plus_idx:
+                total += adjoint
+            elif code == minus_idx:
+                total -= adjoint
+            elif code == prod_idx:
+                total += adjoint * values[op_left[op]]
+            else:
+                total -= adjoint * values[parent] / values[op_right[op]]
+    adjoints[node] += total
+
+
+@numba.njit(parallel=True, cache=True)
+def differentiate_expression_dag_numba(op_code, op_left, op_right, level_ptr, parent_ptr, parent_node, parent_side,
+                                       n_leaves, values, adjoints):
+    """
+    Propagate the adjoints of a DAG evaluated by evaluate_expression_dag_numba back to its leaves.
+    Every node gathers the adjoints of its parents, which are on higher levels and therefore final,
+    so the nodes of one level are processed in parallel without write conflicts.
+    """
+    for level in range(len(level_ptr) - 2, -1, -1):
+        start = level_ptr[level]
+        end = level_ptr[level + 1]
+        if end - start >= min_parallel_width:
+            for node in numba.prange(start, end):
+                pull_adjoint_numba(node, op_code, op_left, op_right, parent_ptr, parent_node, parent_side, n_leaves,
+                                   values, adjoints)
+        else:
+            for node in range(start, end):
+                pull_adjoint_numba(node, op_code, op_left, op_right, parent_ptr, parent_node, parent_side, n_leaves,
+                                   values, adjoints)
+
+
+class ExpressionDag(object):
+    """
+    The symbolic probabilities of several traces as one DAG of binary operators.
+
+    The nodes 0..n_vars-1 hold the transition weights, the next len(constants) nodes hold the constants, and the
+    k-th operator is node n_vars + len(constants) + k. The operators are stored by level, i.e. by the length of
+    the longest path to a leaf, so a sweep over the levels evaluates all traces, whose probabilities are read off
+    at their output nodes.
+    """
+
+    def __init__(self, n_vars, constants, op_code, op_left, op_right, output_nodes, level_ptr):
+        """
+        :param n_vars: number of transition weights
+        :param constants: the value of every constant leaf
+        :param op_code: the operator of every operator node, see plus_idx, minus_idx, prod_idx and div_idx
+        :param op_left: the left operand node of every operator node
+        :param op_right: the right operand node of every operator node
+        :param output_nodes: the node holding the probability of every trace
+        :param level_ptr: the first node of every level followed by the number of nodes, level 0 being the leaves
+        """
+        self.n_vars = int(n_vars)
+        self.constants = np.asarray(constants, dtype=np.float64)
+        self.op_code = np.asarray(op_code, dtype=np.int8)
+        self.op_left = np.asarray(op_left, dtype=np.int64)
+        self.op_right = np.asarray(op_right, dtype=np.int64)
+        self.output_nodes = np.asarray(output_nodes, dtype=np.int64)
+        self.n_leaves = self.n_vars + len(self.constants)
+        self.level_ptr = np.asarray(level_ptr, dtype=np.int64)
+
+        # the parents of every node, the side is 0 if the node is the left operand and 1 if it is the right one
+        children = np.concatenate((self.op_left, self.op_right))
+        order = np.argsort(children, kind="stable")
+        self.parent_node = np.tile(np.arange(self.n_leaves, self.n_nodes, dtype=np.int64), 2)[order]
+        self.parent_side = np.repeat(np.array([0, 1], dtype=np.int8), len(self.op_code))[order]
+        self.parent_ptr = np.zeros(self.n_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(children, minlength=self.n_nodes), out=self.parent_ptr[1:])
+
+        self.__cached_x = None
+        self.__values = np.zeros(self.n_nodes, dtype=np.float64)
+        self.__values[self.n_vars:self.n_leaves] = self.constants
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_ExpressionDag__cached_x"] = None
+        return state
+
+    @property
+    def n_nodes(self):
+        return self.n_leaves + len(self.op_code)
+
+    @property
+    def n_traces(self):
+        return len(self.output_nodes)
+
+    def evaluate(self, var_lst):
+        """
+        :param var_lst: the weight of every transition
+        :return: the value of every node, it is reused as long as the weights do not change
+        """
+        var_lst = np.asarray(var_lst, dtype=np.float64)
+        if self.__cached_x is not None and np.array_equal(self.__cached_x, var_lst):
+            return self.__values
+        self.__values[:self.n_vars] = var_lst
+        evaluate_expression_dag_numba(self.op_code, self.op_left, self.op_right, self.level_ptr, self.n_leaves,
+                                      self.__values)
+        self.__cached_x = var_lst.copy()
+        return self.__values
+
+    def probabilities(self, var_lst):
+        """
+        :param var_lst: the weight of every transition
+        :return: the probability of every trace
+        """
+        return self.evaluate(var_lst)[self.output_nodes]
+
+    def gradient(self, var_lst, coefficients):
+        """
+        Gradient of sum_k coefficients[k] * probabilities(var_lst)[k], computed with one reverse sweep.
+        :param var_lst: the weight of every transition
+        :param coefficients: the weight of every trace in the sum
+        :return: the gradient with respect to var_lst
+        """
+        values = self.evaluate(var_lst)
+        adjoints = np.zeros(self.n_nodes, dtype=np.float64)
+        np.add.at(adjoints, self.output_nodes, np.asarray(coefficients, dtype=np.float64))
+        differentiate_expression_dag_numba(self.op_code, self.op_left, self.op_right, self.level_ptr, self.parent_ptr,
+                                           self.parent_node, self.parent_side, self.n_leaves, values, adjoints)
+        return adjoints[:self.n_vars].copy()
+
+
+def compile_expression_dag(expressions, var_name2idx_map):
+    """
+    Hash-cons the expressions of all traces into one ExpressionDag.
+    Every distinct operator applied to the same operands becomes one node, with the operands of the commutative
+    operators in a canonical order, so that e.g. n1*n2 and n2*n1 share their node.
+    :param expressions: the Expression of every trace, see ExpressionBuilder
+    :param var_name2idx_map: map transition to value in var_lst
+    :return: the ExpressionDag, whose k-th trace is the k-th expression
+    """
+    assert len(var_name2idx_map) == max(var_name2idx_map.values()) + 1, "IDs must be continuously assigned"
+    use_fork_safe_threading_layer()
+    n_vars = len(var_name2idx_map)
+
+    constant_symbols = sorted({node for expression in expressions for node in expression.nodes
+                               if isinstance(node, str) and node not in var_name2idx_map})
+    constant_nodes = {symbol: n_vars + idx for idx, symbol in enumerate(constant_symbols)}
+    n_leaves = n_vars + len(constant_symbols)
+
+    op_nodes = {}
+    op_code, op_left, op_right = [], [], []
+    output_nodes = []
+    for expression in expressions:
+        # the operands of a node always come before it
+        dag_nodes = []
+        for node in expression.nodes:
+            if not isinstance(node, str):
+                operator, left, right = node
+                left, right = dag_nodes[left], dag_nodes[right]
+                code = operator_indexes[operator]
+                if code in (plus_idx, prod_idx) and right < left:
+                    left, right = right, left
+                key = (code, left, right)
+                if key not in op_nodes:
+                    op_nodes[key] = n_leaves + len(op_code)
+                    op_code.append(code)
+                    op_left.append(left)
+                    op_right.append(right)
+                dag_nodes.append(op_nodes[key])
+            elif node in var_name2idx_map:
+                dag_nodes.append(var_name2idx_map[node])
+            else:
+                dag_nodes.append(constant_nodes[node])
+        output_nodes.append(dag_nodes[expression.root])
+
+    # store the operators by level, the operands of an operator are always on lower levels
+    node_level = [0] * n_leaves
+    for left, right in zip(op_left, op_right):
+        node_level.append(max(node_level[left], node_level[right]) + 1)
+    node_level = np.array(node_level, dtype=np.int64)
+    new_node = np.arange(len(node_level), dtype=np.int64)
+    new_node[n_leaves:] = n_leaves + np.argsort(np.argsort(node_level[n_leaves:], kind="stable"), kind="stable")
+    order = np.argsort(new_node[n_leaves:])
+    level_ptr = np.concatenate(([0], np.cumsum(np.bincount(node_level))))
+
+    return ExpressionDag(n_vars, [float(symbol) for symbol in constant_symbols], np.array(op_code)[order],
+                         new_node[np.array(op_left, dtype=np.int64)][order],
+                         new_node[np.array(op_right, dtype=np.int64)][order],
+                         new_node[np.array(output_nodes, dtype=np.int64)], level_ptr)
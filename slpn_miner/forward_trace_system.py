@@ -0,0 +1,323 @@
+# This file contains the forward algorithm over the stochastic reachability graph.
+# For a given weight vector, the probability of a trace is computed by pushing a distribution over the srg states
+# through its activities, with the silent closure solved in between, without building a cross product. The traces
+# are replayed together along their prefix tree, one level of the tree at a time.
+from collections import namedtuple
+
+import numpy as np
+
+from scipy.sparse import csc_matrix, identity
+from scipy.sparse.linalg import splu
+
+from slpn_miner.compact_reachability_graph import ProbabilityMatrix
+from slpn_miner.sparse_equation_system import SparseTrace
+
+
+# the states a level of the prefix tree can be in, the column of the parent of every node of the level, the steps
+# into its nodes as (arc, local source state, local target state, node), one for every arc with the label of a node,
+# its silent arcs as (arc, local source state, local target state), its states with silent arcs as (local state,
+# index in silent_states) and its final states
+ForwardLevel = namedtuple("ForwardLevel", ["states", "parents", "steps", "silent_arcs", "silent_rows",
+                                           "final_states"])
+
+
+class ForwardTraceSystem(object):
+    """
+    The traces of a log replayed on a CompactReachabilityGraph with the forward algorithm.
+
+    With S(w) the probabilities of the silent arcs and V_a(w) the ones of the arcs labelled a, the expected visits
+    x of the states after a prefix solve (I - S)^T x = V_a^T x', where x' are the visits after the prefix without
+    its last activity a, and (I - S)^T x = e_0 for the empty prefix. The probability of a trace is the sum of x over
+    the final states after the whole trace. All nodes of a level of the prefix tree are advanced at once, as the
+    columns of one right hand side restricted to the states the level can be in. These states, and the nodes that
+    can be reached at all, are the same for all positive weights, so they are found once up front; the traces whose
+    node is not reached, or not in a final state, have no target, see has_target. I - S only differs from I on the
+    states with silent arcs, it is factorised on them once per weight vector.
+    """
+
+    def __init__(self, srg, tree_outgoing_transitions, trace_nodes, var_name2idx_map):
+        """
+        :param srg: the CompactReachabilityGraph
+        :param tree_outgoing_transitions: the outgoing transitions of the prefix tree, see create_prefix_tree_from_list
+        :param trace_nodes: the prefix tree node reached by every trace
+        :param var_name2idx_map: map transition to value in var_lst
+        """
+        self.probability_matrix = ProbabilityMatrix(srg, var_name2idx_map)
+        self.n_states = srg.n_states
+        self.arc_from = np.repeat(np.arange(srg.n_states), np.diff(srg.arc_ptr))
+        self.arc_to = srg.arc_to.astype(np.int64)
+        self.is_final = np.zeros(srg.n_states, dtype=bool)
+        self.is_final[srg.final_states] = True
+        self.silent_arcs = np.flatnonzero(srg.arc_label < 0)
+        self.label_arcs = [np.flatnonzero(srg.arc_label == label_idx) for label_idx in range(len(srg.labels))]
+        self.silent_states = np.unique(np.concatenate([self.arc_from[self.silent_arcs],
+                                                       self.arc_to[self.silent_arcs]]))
+        silent_state_idx = np.full(srg.n_states, -1, dtype=np.int64)
+        silent_state_idx[self.silent_states] = np.arange(len(self.silent_states))
+        self.silent_state_idx = silent_state_idx
+        silent_successors = [[] for _ in range(srg.n_states)]
+        for arc in self.silent_arcs:
+            silent_successors[self.arc_from[arc]].append(self.arc_to[arc])
+
+        self.__cached_x = None
+        self.__cached_forward = None
+
+        # the levels are built with unit weights, a state or a node reached with them is reached with any positive
+        # weights; the nodes of a level are sorted by label, so that the nodes reached by the same activity are
+        # one block of columns
+        arc_probs = self.probability_matrix.refill(np.ones(len(var_name2idx_map), dtype=np.float64)).data
+        lu = self.factorise(arc_probs)
+        label_to_idx = {label: idx for idx, label in enumerate(srg.labels)}
+        root_states = get_silent_closure([0], silent_successors)
+        self.root_state = int(np.searchsorted(root_states, 0))
+        self.levels = [self.get_level(root_states, None, None, [])]
+        visits = self.solve_level(arc_probs, lu, self.levels[0], None)
+        level_nodes = [0]
+        node_position = {0: (0, 0)}
+        node_fits = {0: visits[self.levels[0].final_states, 0].any()}
+        while True:
+            children = sorted((label_to_idx[label], parent_col, child)
+                              for parent_col, node in enumerate(level_nodes)
+                              for label, child in tree_outgoing_transitions[node].items() if label in label_to_idx)
+            if not children:
+                break
+            previous = self.levels[-1]
+            in_previous = np.zeros(srg.n_states, dtype=bool)
+            in_previous[previous.states] = True
+            targets = np.concatenate([self.arc_to[arcs[in_previous[self.arc_from[arcs]]]]
+                                      for arcs in (self.label_arcs[label_idx] for label_idx in
+                                                   {label_idx for label_idx, _, _ in children})])
+            parents = np.array([parent_col for _, parent_col, _ in children], dtype=np.int64)
+            labels = [label_idx for label_idx, _, _ in children]
+            level = self.get_level(get_silent_closure(targets, silent_successors), previous, parents, labels)
+            rhs = self.get_rhs(arc_probs, level, visits)
+
+            # keep the nodes and the states that are reached
+            live = np.flatnonzero(rhs.any(axis=0))
+            if len(live) == 0:
+                break
+            children = [children[col] for col in live]
+            reached = level.states[rhs[:, live].any(axis=1)]
+            level = self.get_level(get_silent_closure(reached, silent_successors), previous, parents[live],
+                                   [labels[col] for col in live])
+            visits = self.solve_level(arc_probs, lu, level, visits)
+            self.levels.append(level)
+            level_nodes = [child for _, _, child in children]
+            level_fits = visits[level.final_states].any(axis=0)
+            for col, node in enumerate(level_nodes):
+                node_position[node] = (len(self.levels) - 1, col)
+                node_fits[node] = level_fits[col]
+
+        self.trace_level = np.full(len(trace_nodes), -1, dtype=np.int64)
+        self.trace_col = np.zeros(len(trace_nodes), dtype=np.int64)
+        for trace_idx, node in enumerate(trace_nodes):
+            if node_fits.get(node, False):
+                self.trace_level[trace_idx], self.trace_col[trace_idx] = node_position[node]
+
+    def __getstate__(self):
+        # the factorisations are not picklable, they are recomputed on demand
+        state = self.__dict__.copy()
+        state["_ForwardTraceSystem__cached_x"] = None
+        state["_ForwardTraceSystem__cached_forward"] = None
+        return state
+
+    @property
+    def n_traces(self):
+        return len(self.trace_level)
+
+    def get_trace(self, trace_idx):
+        return SparseTrace(self, trace_idx)
+
+    def has_target(self, trace_idx):
+        return self.trace_level[trace_idx] >= 0
+
+    def get_level(self, states, previous, parents, labels):
+        """
+        :param states: the sorted states the level can be in, closed under silent arcs
+        :param previous: the previous level, None for the root
+        :param parents: the column of the parent of every node of the level in the previous level
+        :param labels: the sorted label of every node of the level
+        :return: the ForwardLevel
+        """
+        state_idx = np.full(self.n_states, -1, dtype=np.int64)
+        state_idx[states] = np.arange(len(states))
+        step_arcs, step_nodes = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        previous_idx = np.full(self.n_states, -1, dtype=np.int64)
+        if previous is not None:
+            previous_idx[previous.states] = np.arange(len(previous.states))
+            for label_idx, start, end in get_label_slices(labels):
+                arcs = self.label_arcs[label_idx]
+                arcs = arcs[(previous_idx[self.arc_from[arcs]] >= 0) & (state_idx[self.arc_to[arcs]] >= 0)]
+                step_arcs.append(np.tile(arcs, end - start))
+                step_nodes.append(np.repeat(np.arange(start, end), len(arcs)))
+        step_arcs = np.concatenate(step_arcs)
+        steps = (step_arcs, previous_idx[self.arc_from[step_arcs]], state_idx[self.arc_to[step_arcs]],
+                 np.concatenate(step_nodes))
+        silent_arcs = self.silent_arcs[state_idx[self.arc_from[self.silent_arcs]] >= 0]
+        silent_rows = np.flatnonzero(self.silent_state_idx[states] >= 0)
+        return ForwardLevel(states, parents, steps,
+                            (silent_arcs, state_idx[self.arc_from[silent_arcs]], state_idx[self.arc_to[silent_arcs]]),
+                            (silent_rows, self.silent_state_idx[states[silent_rows]]),
+                            np.flatnonzero(self.is_final[states]))
+
+    def get_rhs(self, arc_probs, level, previous_visits):
+        """
+        :param arc_probs: the probability of every arc
+        :param level: the ForwardLevel
+        :param previous_visits: the visits of the previous level, one column per node, None for the root
+        :return: the visits of the states of the level by the activity of every node, before the silent closure
+        """
+        if level.parents is None:
+            rhs = np.zeros((len(level.states), 1), dtype=np.float64)
+            rhs[self.root_state, 0] = 1.0
+            return rhs
+        arcs, arc_from, arc_to, nodes = level.steps
+        n_nodes = len(level.parents)
+        weights = arc_probs[arcs] * previous_visits[arc_from, level.parents[nodes]]
+        return np.bincount(arc_to * n_nodes + nodes, weights=weights,
+                           minlength=len(level.states) * n_nodes).reshape(len(level.states), n_nodes)
+
+    def factorise(self, arc_probs):
+        """
+        :param arc_probs: the probability of every arc
+        :return: the LU factorisation of I - S on the silent_states, None without silent arcs
+        """
+        if len(self.silent_arcs) == 0:
+            return None
+        n_silent_states = len(self.silent_states)
+        silent_matrix = csc_matrix((arc_probs[self.silent_arcs],
+                                    (self.silent_state_idx[self.arc_from[self.silent_arcs]],
+                                     self.silent_state_idx[self.arc_to[self.silent_arcs]])),
+                                   shape=(n_silent_states, n_silent_states))
+        return splu((identity(n_silent_states, format="csc") - silent_matrix).tocsc())
+
+    def solve_silent(self, lu, level, rhs, trans):
+        """
+        Solve (I - S)^T x = rhs if trans is "T", or (I - S) x = rhs if it is "N", on the states of the level.
+        Both systems only couple the states with silent arcs, and the ones a level can be in are closed under them.
+        :param lu: the factorisation, see factorise
+        """
+        silent_rows, silent_idx = level.silent_rows
+        if lu is None or len(silent_rows) == 0:
+            return rhs
+        embedded = np.zeros((len(self.silent_states), rhs.shape[1]), dtype=np.float64)
+        embedded[silent_idx] = rhs[silent_rows]
+        solution = rhs.copy()
+        solution[silent_rows] = lu.solve(embedded, trans=trans)[silent_idx]
+        return solution
+
+    def solve_level(self, arc_probs, lu, level, previous_visits):
+        """
+        :return: the visits of the states of the level, one column per node
+        """
+        return self.solve_silent(lu, level, self.get_rhs(arc_probs, level, previous_visits), "T")
+
+    def forward(self, var_lst):
+        """
+        The forward pass is reused as long as the weights do not change, the probability matrix is refilled for
+        every other weight vector.
+        :param var_lst: the weight of every transition
+        :return: the arc probabilities, the normaliser of every arc, the factorisation and the visits of every level
+        """
+        var_lst = np.asarray(var_lst, dtype=np.float64)
+        if self.__cached_x is not None and np.array_equal(self.__cached_x, var_lst):
+            return self.__cached_forward
+
+        arc_probs = self.probability_matrix.refill(var_lst).data
+        normalisers = self.probability_matrix.arc_normalisers
+        lu = self.factorise(arc_probs)
+        visits = []
+        for level in self.levels:
+            visits.append(self.solve_level(arc_probs, lu, level, visits[-1] if visits else None))
+
+        self.__cached_x = var_lst.copy()
+        self.__cached_forward = (arc_probs, normalisers, lu, visits)
+        return self.__cached_forward
+
+    def probabilities(self, var_lst):
+        """
+        :param var_lst: the weight of every transition
+        :return: the probability of every trace in the system, 0 for the traces without target
+        """
+        _, _, _, visits = self.forward(var_lst)
+        trace_probs = np.zeros(self.n_traces, dtype=np.float64)
+        for level_idx, (level, level_visits) in enumerate(zip(self.levels, visits)):
+            level_traces = np.flatnonzero(self.trace_level == level_idx)
+            trace_probs[level_traces] = level_visits[level.final_states][:, self.trace_col[level_traces]].sum(axis=0)
+        return trace_probs
+
+    def gradient(self, var_lst, coefficients):
+        """
+        Gradient of sum_k coefficients[k] * probabilities(var_lst)[k], computed with a backward pass over the
+        levels. For the visits x = (I - S)^-T V_a^T x' of a node, the adjoint mu = (I - S)^-1 lambda of x gives
+        dx = (I - S)^-T (dS^T x + dV_a^T x'), so an arc u -> v contributes mu[v] * x[u] if it is silent and
+        mu[v] * x'[u] if it is labelled a, and lambda' = V_a mu is passed on to the parent.
+        :param var_lst: the weight of every transition
+        :param coefficients: the weight of every trace in the sum
+        :return: the gradient with respect to var_lst
+        """
+        arc_probs, normalisers, lu, visits = self.forward(var_lst)
+        coefficients = np.asarray(coefficients, dtype=np.float64)
+        arc_adjoints = np.zeros(len(self.arc_from), dtype=np.float64)
+
+        adjoint = None
+        for level_idx in range(len(self.levels) - 1, -1, -1):
+            level = self.levels[level_idx]
+            level_visits = visits[level_idx]
+            level_adjoint = np.zeros_like(level_visits) if adjoint is None else adjoint
+            level_traces = np.flatnonzero(self.trace_level == level_idx)
+            for state in level.final_states:
+                np.add.at(level_adjoint[state], self.trace_col[level_traces], coefficients[level_traces])
+            adjoint_visits = self.solve_silent(lu, level, level_adjoint, "N")
+            silent_arcs, arc_from, arc_to = level.silent_arcs
+            arc_adjoints[silent_arcs] += (level_visits[arc_from] * adjoint_visits[arc_to]).sum(axis=1)
+            if level_idx == 0:
+                break
+
+            # pass the adjoints on to the parents
+            previous_visits = visits[level_idx - 1]
+            arcs, arc_from, arc_to, nodes = level.steps
+            parents = level.parents[nodes]
+            step_adjoints = adjoint_visits[arc_to, nodes]
+            arc_adjoints += np.bincount(arcs, weights=previous_visits[arc_from, parents] * step_adjoints,
+                                        minlength=len(arc_adjoints))
+            n_parents = previous_visits.shape[1]
+            adjoint = np.bincount(arc_from * n_parents + parents, weights=arc_probs[arcs] * step_adjoints,
+                                  minlength=previous_visits.size).reshape(previous_visits.shape)
+
+        # d p_arc / d w_k = [k == arc_var] / normaliser - p_arc / normaliser * [k fires an arc of the same state]
+        arc_var = self.probability_matrix.arc_var
+        arc_row = self.probability_matrix.arc_row
+        arc_contributions = arc_adjoints / normalisers
+        row_contributions = np.bincount(arc_row, weights=arc_contributions * arc_probs)
+        return np.bincount(arc_var, weights=arc_contributions - row_contributions[arc_row], minlength=len(var_lst))
+
+
+def get_silent_closure(states, silent_successors):
+    """
+    :param states: some srg states
+    :param silent_successors: the targets of the silent arcs leaving every state
+    :return: the sorted states reachable from them by silent arcs, themselves included
+    """
+    reached = set(int(state) for state in states)
+    stack = list(reached)
+    while stack:
+        for next_state in silent_successors[stack.pop()]:
+            if next_state not in reached:
+                reached.add(next_state)
+                stack.append(next_state)
+    return np.array(sorted(reached), dtype=np.int64)
+
+
+def get_label_slices(labels):
+    """
+    :param labels: the sorted label of every node of a level
+    :return: (label, start, end) for every run of nodes with the same label
+    """
+    slices = []
+    start = 0
+    for end in range(1, len(labels) + 1):
+        if end == len(labels) or labels[end] != labels[start]:
+            slices.append((labels[start], start, end))
+            start = end
+    return slices
@@ -0,0 +1,162 @@
+# This file contains the instrumentation of a discovery run.
+# The phases of the run are timed, and every trace whose cross product is computed gets a record of its size and
+# solving time, so the traces that take most of the time can be found. Nothing is measured unless an Instrumentation
+# is passed to the discovery.
+import cProfile
+import csv
+import glob
+import json
+import os
+import pstats
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# the columns of the trace records, in the order they are written to csv
+TRACE_FIELDS = ["trace", "trace_length", "weight", "cached", "timed_out", "failed", "skipped", "attempts", "timeout",
+                "fits", "states", "arcs", "build_time", "solve_time", "expression_size", "peak_memory_mb"]
+
+
+class Instrumentation(object):
+    """
+    The phase timers and the trace records of a discovery run.
+
+    A phase may be entered several times, its time and number of calls add up. If profile_path is given, the phases
+    run under cProfile, and so do the cross products in the worker processes, each of which dumps its statistics to
+    profile_path.<pid>, see profile_worker_task; write_profile merges them all into profile_path.
+    """
+
+    def __init__(self, profile_path=None):
+        """
+        :param profile_path: the file the merged cProfile statistics are written to, None to not profile
+        """
+        self.phases = {}
+        self.traces = []
+        self.profile_path = profile_path
+        self.__profiler = cProfile.Profile() if profile_path is not None else None
+
+    @contextmanager
+    def phase(self, name):
+        """Time the enclosed code as the phase with the given name"""
+        if self.__profiler is not None:
+            self.__profiler.enable()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start_time
+            if self.__profiler is not None:
+                self.__profiler.disable()
+            phase = self.phases.setdefault(name, {"time": 0.0, "calls": 0})
+            phase["time"] += elapsed
+            phase["calls"] += 1
+
+    def add_trace_record(self, record):
+        """
+        :param record: a dict with some of the TRACE_FIELDS
+        """
+        self.traces.append(record)
+
+    def get_slowest_traces(self, n=10):
+        """
+        :return: the records of the n traces with the longest cross product, the timed out ones first
+        """
+        def get_time(record):
+            return (record.get("build_time") or 0.0) + (record.get("solve_time") or 0.0)
+
+        return sorted(self.traces, key=lambda record: (not record.get("timed_out", False), -get_time(record)))[:n]
+
+    def get_report(self):
+        return {"phases": self.phases, "traces": self.traces}
+
+    def write_json(self, path):
+        with open(path, "w") as file:
+            json.dump(self.get_report(), file, indent=1)
+
+    def write_csv(self, path):
+        """Write the trace records, one row per trace, the activities of a trace separated by commas"""
+        with open(path, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=TRACE_FIELDS, extrasaction="ignore")
+            writer.writeheader()
+            for record in self.traces:
+                row = dict(record)
+                row["trace"] = ",".join(record.get("trace", ()))
+                writer.writerow(row)
+
+    def write_profile(self):
+        """Merge the statistics of this process and of the worker processes into profile_path"""
+        if self.profile_path is None:
+            return
+        stats = pstats.Stats()
+        if self.__profiler.getstats():
+            stats.add(self.__profiler)
+        for worker_path in glob.glob(glob.escape(self.profile_path) + ".*"):
+            stats.add(worker_path)
+            os.remove(worker_path)
+        stats.dump_stats(self.profile_path)
+
+
+def measure(instrumentation, name):
+    """
+    :param instrumentation: the Instrumentation of the run, or None
+    :return: a context timing the phase with the given name, that does nothing without instrumentation
+    """
+    return nullcontext() if instrumentation is None else instrumentation.phase(name)
+
+
+def reset_peak_memory():
+    """Reset the peak resident memory of this process, if the os allows it"""
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+
+def get_peak_memory():
+    """
+    :return: the peak resident memory of this process in MB, since the last reset_peak_memory where supported
+    """
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / (1024 * 1024) if sys.platform == "darwin" else max_rss / 1024
+
+
+# the profiler of a worker process, created by its first profiled task
+_worker_profiler = None
+
+
+@contextmanager
+def profile_worker_task(profile_path):
+    """
+    Profile a task of a worker process, the statistics of the process are dumped to profile_path.<pid> after every
+    task, since a worker may be killed at any time.
+    :param profile_path: the profile_path of the Instrumentation, None to not profile
+    """
+    global _worker_profiler
+    if profile_path is None:
+        yield
+        return
+    if _worker_profiler is None:
+        _worker_profiler = cProfile.Profile()
+    _worker_profiler.enable()
+    try:
+        yield
+    finally:
+        _worker_profiler.disable()
+        _worker_profiler.dump_stats(profile_path + "." + str(os.getpid()))
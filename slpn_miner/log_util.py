@@ -1,5 +1,9 @@
+import gzip
+import os
 import pandas as pd
 import fractions
+import xml.etree.ElementTree as ElementTree
+from collections import Counter
 
 from pm4py.algo.filtering.log.variants import variants_filter
 from pm4py.objects.log.importer.xes import importer as xes_importer
@@ -12,6 +16,8 @@ from pm4py.statistics.variants.log.get import get_variants_from_log_trace_idx, c
     Parameters
 from pm4py.util import variants_util
 
+from slpn_miner.slang_importer import get_slang_stochastic_language
+
 
 def get_variant(import_path, export_path):
     log = xes_importer.apply(import_path)
@@ -29,6 +35,13 @@ def get_variant(import_path, export_path):
 
 
 def get_stochastic_language(*args, **kwargs) -> Dict[List[str], fractions.Fraction]:
+    if isinstance(args[0], dict):
+        # a stochastic language computed before, e.g. shared by several discoveries on the same log
+        return args[0]
+    if isinstance(args[0], (str, os.PathLike)):
+        if os.fspath(args[0]).endswith(".slang"):
+            return get_slang_stochastic_language(args[0])
+        return get_xes_stochastic_language(args[0], **kwargs)
     if isinstance(args[0], EventLog) or isinstance(args[0], EventStream) or isinstance(args[0], pd.DataFrame):
         from pm4py.objects.conversion.log import converter as log_converter
         log = log_converter.apply(args[0])
@@ -43,6 +56,54 @@ def get_stochastic_language(*args, **kwargs) -> Dict[List[str], fractions.Fracti
         return vars
 
 
+def get_xes_variant_counts(xes_path, activity_key="concept:name") -> Dict[tuple, int]:
+    """
+    Count the variants of an XES file in one streaming pass, without building an EventLog. Only the activities of
+    the trace being read are kept in memory, so the memory use is bounded by the number of distinct variants.
+    :param xes_path: the path of the XES file, which may be gzip compressed, e.g. "log.xes.gz"
+    :param activity_key: the event attribute holding the activity
+    :return: the number of traces of every variant, a variant being the tuple of its activities
+    """
+    with open(xes_path, "rb") as file:
+        is_gzip = file.read(2) == b"\x1f\x8b"
+    variant_counts = Counter()
+    with (gzip.open(xes_path, "rb") if is_gzip else open(xes_path, "rb")) as file:
+        context = ElementTree.iterparse(file, events=("start", "end"))
+        _, root = next(context)
+        activities = []
+        depth = 0
+        for event, elem in context:
+            # the tags carry the XES namespace, if the file declares one
+            tag = elem.tag.rpartition("}")[2]
+            if event == "start":
+                depth += 1
+                continue
+            depth -= 1
+            if tag == "event" and depth == 1:
+                activity = next((child.get("value") for child in elem
+                                 if child.get("key") == activity_key), None)
+                if activity is not None:
+                    activities.append(activity)
+                elem.clear()
+            elif tag == "trace" and depth == 0:
+                variant_counts[tuple(activities)] += 1
+                activities = []
+                # the finished trace is dropped from the tree
+                root.clear()
+    return variant_counts
+
+
+def get_xes_stochastic_language(xes_path, activity_key="concept:name") -> Dict[tuple, float]:
+    """
+    :param xes_path: the path of the XES file, which may be gzip compressed
+    :param activity_key: the event attribute holding the activity
+    :return: the probability of every variant in the log, see get_xes_variant_counts
+    """
+    variant_counts = get_xes_variant_counts(xes_path, activity_key=activity_key)
+    all_values_sum = sum(variant_counts.values())
+    return {variant: count / all_values_sum for variant, count in variant_counts.items()}
+
+
 def get_trace_weight_dict(*args, **kwargs) -> Dict[List[str], fractions.Fraction]:
     if isinstance(args[0], EventLog) or isinstance(args[0], EventStream) or isinstance(args[0], pd.DataFrame):
         from pm4py.objects.conversion.log import converter as log_converter
@@ -85,8 +146,13 @@ def get_variants(log: EventLog, parameters: Optional[Dict[Union[str, Parameters]
 
 
 def export_stochastic_language(import_path, export_path):
-    log = xes_importer.apply(import_path)
-    variants = get_stochastic_language(log)
+    """
+    Count the variants of an XES file and write them to a slang file, which the discovery reads instead of the log.
+    :param import_path: the path of the XES file, which may be gzip compressed
+    :param export_path: the path of the slang file
+    """
+    variants = get_xes_variant_counts(import_path)
+    all_values_sum = sum(variants.values())
 
     with open(export_path, "w") as file:
         file.write("finite stochastic language\n")
@@ -94,7 +160,8 @@ def export_stochastic_language(import_path, export_path):
         file.write(str(len(variants)))
 
         i = 0
-        for key, val in variants.items():
+        for key, count in variants.items():
+            val = fractions.Fraction(count, all_values_sum)
             file.write("\n# trace " + str(i))
             file.write("\n# weight")
             file.write("\n" + str(val.numerator) + "/" + str(val.denominator))
@@ -103,7 +170,6 @@ def export_stochastic_language(import_path, export_path):
             for j in range(len(key)):
                 file.write("\n" + key[j])
             i += 1
-    file.close()
 
 
 # get a main function
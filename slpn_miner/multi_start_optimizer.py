@@ -0,0 +1,107 @@
+# This file contains a multi-start driver for basin hopping.
+# Several chains with different seeds and starting points run in a process pool, in rounds. After every round the
+# incumbent best is shared: a chain that did not improve during the round continues from it.
+import logging
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import scipy
+
+from slpn_miner.worker_pool import TimeoutWorkerPool
+
+
+# the objective and the basin hopping settings shared by all chains, set once per worker process
+_worker_basin_hopping = None
+
+
+def init_basin_hopping_worker(obj_func, minimizer_kwargs, niter, stepsize):
+    """Initializer of the worker processes, the objective is inherited by fork and compiled only once"""
+    global _worker_basin_hopping
+    _worker_basin_hopping = (obj_func, minimizer_kwargs, niter, stepsize)
+
+
+def run_basin_hopping_round(args):
+    """Worker function running one round of one chain"""
+    x_start, seed = args
+    obj_func, minimizer_kwargs, niter, stepsize = _worker_basin_hopping
+    start_time = time.time()
+    res = scipy.optimize.basinhopping(obj_func, x_start, niter=niter, stepsize=stepsize,
+                                      minimizer_kwargs=minimizer_kwargs, seed=int(seed))
+    return res.x, float(res.fun), int(res.nfev), time.time() - start_time
+
+
+def optimize_with_multi_start_basin_hopping(x0, obj_func, minimizer_kwargs, n_chains=None, n_rounds=5, niter=100,
+                                            stepsize=0.5, seed=None, processes=None):
+    """
+    Run several basin hopping chains concurrently and return the best weights found by any of them.
+    The first chain starts from x0, the others from points drawn uniformly within the bounds.
+    :param x0: the initial guess for variables
+    :param obj_func: the objective function
+    :param minimizer_kwargs: the arguments of the local minimizer, they must contain the bounds
+    :param n_chains: the number of chains, the number of cpus by default
+    :param n_rounds: the number of rounds, the incumbent best is shared after every round
+    :param niter: the number of basin hopping iterations of every chain, spread over the rounds
+    :param stepsize: the step size of basin hopping
+    :param seed: the seed of the starting points and the chains
+    :param processes: the number of worker processes, n_chains by default
+    :return: the best variable list, and for every chain a summary dict
+    """
+    n_chains = (os.cpu_count() or 1) if n_chains is None else n_chains
+    rng = np.random.default_rng(seed)
+    lower = np.array([bound[0] for bound in minimizer_kwargs["bounds"]], dtype=np.float64)
+    upper = np.array([bound[1] for bound in minimizer_kwargs["bounds"]], dtype=np.float64)
+    chain_x = [np.asarray(x0, dtype=np.float64)] + [rng.uniform(lower, upper) for _ in range(n_chains - 1)]
+    chain_seeds = rng.integers(2 ** 32, size=(n_rounds, n_chains))
+    niter_per_round = max(1, niter // n_rounds)
+
+    chain_summaries = [{"chain": chain, "best_fun": np.inf, "nfev": 0, "time": 0.0, "improved_rounds": 0,
+                        "adopted_incumbent": 0} for chain in range(n_chains)]
+    best_x, best_fun = chain_x[0], np.inf
+
+    initargs = (obj_func, minimizer_kwargs, niter_per_round, stepsize)
+    # the objective is a closure over the compiled traces, so the chains can only share it through fork
+    if "fork" in multiprocessing.get_all_start_methods():
+        pool = TimeoutWorkerPool(run_basin_hopping_round, initializer=init_basin_hopping_worker, initargs=initargs,
+                                 processes=n_chains if processes is None else processes, context="fork")
+    else:
+        logging.warning("Processes cannot be forked, the basin hopping chains run one after the other.")
+        init_basin_hopping_worker(*initargs)
+        pool = None
+
+    try:
+        for round_idx in range(n_rounds):
+            tasks = [(chain_x[chain], chain_seeds[round_idx, chain]) for chain in range(n_chains)]
+            if pool is None:
+                results = [run_basin_hopping_round(task) for task in tasks]
+            else:
+                results = pool.map(tasks, timeout=None)
+
+            improved = [False] * n_chains
+            for chain, result in enumerate(results):
+                if result is None:
+                    continue
+                x, fun, nfev, elapsed = result
+                summary = chain_summaries[chain]
+                summary["nfev"] += nfev
+                summary["time"] += elapsed
+                if fun < summary["best_fun"]:
+                    summary["best_fun"] = fun
+                    summary["improved_rounds"] += 1
+                    improved[chain] = True
+                chain_x[chain] = x
+                if fun < best_fun:
+                    best_x, best_fun = x, fun
+
+            # the chains that got stuck continue from the incumbent best
+            for chain in range(n_chains):
+                if not improved[chain] and chain_summaries[chain]["best_fun"] > best_fun:
+                    chain_x[chain] = best_x
+                    chain_summaries[chain]["adopted_incumbent"] += 1
+            logging.info(f"Basin hopping round {round_idx + 1}/{n_rounds}: incumbent objective {best_fun}")
+    finally:
+        if pool is not None:
+            pool.close()
+
+    return best_x, chain_summaries
@@ -0,0 +1,172 @@
+# This file contains the silent transition closure (tau-closure) of a stochastic reachability graph.
+# A cross product built on top of it only steps on visible labels: every state of the graph is summarised by the
+# states it reaches through silent transitions alone, and by the probability of doing so, tau-loops included.
+import numpy as np
+import sympy
+
+from slpn_miner.stochastic_equation_system import eliminate_graph, get_strongly_connected_components
+from slpn_miner.symbolic_conversion import SympyExpressionBuilder
+
+
+class SilentClosure(object):
+    """
+    The silent paths of a CompactReachabilityGraph.
+
+    An exit point is a state with a visible arc or without any arc, i.e. a final state. The weight of an exit point
+    u from a state s is the expected number of visits of u when only the silent arcs are followed from s, which is
+    the probability of reaching u if the silent arcs form no loop. The strongly connected components of the silent
+    arcs are computed up front; the weights of a component are solved once, when a cross product first needs them.
+    """
+
+    def __init__(self, srg):
+        """
+        :param srg: the CompactReachabilityGraph
+        """
+        self.srg = srg
+        self.arc_from = np.repeat(np.arange(srg.n_states), np.diff(srg.arc_ptr))
+        self.silent_arcs = [[arc for arc in range(srg.arc_ptr[state], srg.arc_ptr[state + 1])
+                             if srg.arc_label[arc] < 0] for state in range(srg.n_states)]
+        self.is_exit_point = [srg.arc_ptr[state] == srg.arc_ptr[state + 1] or
+                              len(self.silent_arcs[state]) < srg.arc_ptr[state + 1] - srg.arc_ptr[state]
+                              for state in range(srg.n_states)]
+        self.components = get_strongly_connected_components(
+            [[int(srg.arc_to[arc]) for arc in self.silent_arcs[state]] for state in range(srg.n_states)])
+        self.state_component = [-1] * srg.n_states
+        for component, states in enumerate(self.components):
+            for state in states:
+                self.state_component[state] = component
+
+        self.__n_exits = 0
+        self.__weights = {}
+        self.__exits = {}
+
+    def __getstate__(self):
+        # the weights and the exits are rebuilt on demand
+        state = self.__dict__.copy()
+        state["_SilentClosure__weights"] = {}
+        state["_SilentClosure__exits"] = {}
+        return state
+
+    def get_arc_symbol(self, arc):
+        """
+        :return: the probability of the arc as a sympy expression, a symbol named like its srg arc unless it is 1
+        """
+        state = self.arc_from[arc]
+        if self.srg.arc_ptr[state + 1] - self.srg.arc_ptr[state] == 1:
+            return sympy.Integer(1)
+        return sympy.Symbol("t" + str(arc))
+
+    def get_weights(self, state):
+        """
+        :param state: the srg state
+        :return: the weight of every exit point silently reachable from the state, as a dict state -> sympy expression
+        """
+        component = self.state_component[state]
+        if component not in self.__weights:
+            # the components are numbered sinks first, so the successors of a component are solved before it
+            stack = [component]
+            while stack:
+                current = stack[-1]
+                missing = [successor for successor in self.get_successor_components(current)
+                           if successor not in self.__weights]
+                if missing:
+                    stack.extend(missing)
+                    continue
+                stack.pop()
+                if current not in self.__weights:
+                    self.__weights[current] = self.solve_component(current)
+        return self.__weights[component][state]
+
+    def get_successor_components(self, component):
+        return {self.state_component[self.srg.arc_to[arc]] for state in self.components[component]
+                for arc in self.silent_arcs[state]} - {component}
+
+    def solve_component(self, component):
+        """
+        The weights w(v) of the states v of a component satisfy w(v) = [v exit point] + sum p(arc) * w(arc target)
+        over the silent arcs leaving v. The weights of the other components are known, the ones of the component
+        itself are solved by state elimination if its silent arcs form a loop, see eliminate_graph.
+        :return: the weights of every state of the component
+        """
+        states = self.components[component]
+        state_idx = {state: idx for idx, state in enumerate(states)}
+        external = []
+        internal = []
+        for state in states:
+            weights = {state: sympy.Integer(1)} if self.is_exit_point[state] else {}
+            loop_arcs = []
+            for arc in self.silent_arcs[state]:
+                next_state = int(self.srg.arc_to[arc])
+                if next_state in state_idx:
+                    loop_arcs.append((state_idx[next_state], self.get_arc_symbol(arc)))
+                    continue
+                for exit_point, weight in self.__weights[self.state_component[next_state]][next_state].items():
+                    weights[exit_point] = weights.get(exit_point, sympy.Integer(0)) + self.get_arc_symbol(arc) * weight
+            external.append(weights)
+            internal.append(loop_arcs)
+
+        if not any(internal):
+            return dict(zip(states, external))
+
+        # a source node leads to every state of the component with probability 1, and every exit point is a target
+        # node reached with the weights above; once the states are eliminated, the transitions from the source of a
+        # state to the targets carry its weights
+        exit_points = sorted({exit_point for weights in external for exit_point in weights})
+        n_states = len(states)
+        target_idx = {exit_point: 2 * n_states + idx for idx, exit_point in enumerate(exit_points)}
+        builder = SympyExpressionBuilder()
+        out_edges = [{} for _ in range(2 * n_states + len(exit_points))]
+        in_edges = [set() for _ in range(len(out_edges))]
+        for idx in range(n_states):
+            out_edges[n_states + idx][idx] = sympy.Integer(1)
+            in_edges[idx].add(n_states + idx)
+            for next_idx, symbol in internal[idx]:
+                out_edges[idx][next_idx] = out_edges[idx].get(next_idx, sympy.Integer(0)) + symbol
+                in_edges[next_idx].add(idx)
+            for exit_point, weight in external[idx].items():
+                out_edges[idx][target_idx[exit_point]] = weight
+                in_edges[target_idx[exit_point]].add(idx)
+        eliminate_graph(out_edges, in_edges, set(range(n_states, len(out_edges))), builder)
+        return {state: {exit_points[next_idx - 2 * n_states]: weight
+                        for next_idx, weight in out_edges[n_states + idx].items()}
+                for idx, state in enumerate(states)}
+
+    def get_exits(self, state):
+        """
+        The visible steps of a state, like CompactReachabilityGraph.get_outgoing but with the probabilities as sympy
+        expressions over the arc symbols, see get_arc_symbol. A visible arc leaving an exit point u of the state is taken with the weight of u times the
+        probability of the arc, and all arcs with the same label and target state are merged into one. An exit point
+        that is a final state other than the state itself is reached by a silent step, labelled None, with the weight
+        of u.
+        :param state: the srg state
+        :return: the list of ((name, transition name, label, probability), next state)
+        """
+        exits = self.__exits.get(state)
+        if exits is None:
+            merged = {}
+            for exit_point, weight in self.get_weights(state).items():
+                arcs = range(self.srg.arc_ptr[exit_point], self.srg.arc_ptr[exit_point + 1])
+                if len(arcs) == 0 and exit_point != state:
+                    merged[(None, exit_point)] = (None, weight)
+                for arc in arcs:
+                    label = self.srg.get_label(arc)
+                    if label is None:
+                        continue
+                    key = (label, int(self.srg.arc_to[arc]))
+                    transition_name, total = merged.get(key, (self.srg.transition_names[self.srg.arc_transition[arc]],
+                                                              sympy.Integer(0)))
+                    merged[key] = (transition_name, total + weight * self.get_arc_symbol(arc))
+
+            exits = []
+            for (label, next_state), (transition_name, weight) in merged.items():
+                exits.append((("t" + str(self.__n_exits), transition_name, label, weight), next_state))
+                self.__n_exits += 1
+            self.__exits[state] = exits
+        return exits
+
+    def get_arc_expression(self, symbol_name):
+        """
+        :param symbol_name: the symbol of an arc, see get_arc_symbol
+        :return: the probability of the arc as an inverse poland expression
+        """
+        return self.srg.get_probability_expression(int(symbol_name[1:]))
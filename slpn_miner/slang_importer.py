@@ -1,3 +1,7 @@
+import fractions
+import sys
+
+
 def read_slang_file(file_path):
     with open(file_path, 'r') as file:
         content = file.read()
@@ -46,6 +50,63 @@ def parse_slang_file(slang_content):
     return traces
 
 
+def parse_slang_weight(weight):
+    """
+    :param weight: a weight as written in a slang file, e.g. "3/20", "0.15" or "1.5E-4"
+    :return: the weight as a Fraction if it is rational, as a float otherwise
+    """
+    try:
+        return fractions.Fraction(weight)
+    except ValueError:
+        return float(weight)
+
+
+def iterate_slang_file(file_path):
+    """
+    Read a slang file line by line, without loading it into memory. The activities are interned, so the traces
+    share the strings of their activities.
+    :param file_path: the path of the slang file
+    :return: a generator of (trace, weight), the trace being the tuple of its activities
+    """
+    with open(file_path, 'r') as file:
+        def next_value(section):
+            # the comment lines, e.g. "# weight", only describe the value that follows them
+            for line in file:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    return line
+            raise ValueError(f"The slang file {file_path} is cut off at the {section}.")
+
+        def next_event(section):
+            # the events are read as they are, an activity may start with "#"
+            line = next(file, None)
+            if line is None:
+                raise ValueError(f"The slang file {file_path} is cut off at the {section}.")
+            return sys.intern(line.strip())
+
+        header = next_value("header")
+        if header != "finite stochastic language":
+            raise ValueError("Not a finite stochastic language: " + str(file_path))
+        number_of_traces = int(next_value("number of traces"))
+        for trace_idx in range(number_of_traces):
+            weight = parse_slang_weight(next_value(f"weight of trace {trace_idx}"))
+            number_of_events = int(next_value(f"number of events of trace {trace_idx}"))
+            events = tuple(next_event(f"events of trace {trace_idx}") for _ in range(number_of_events))
+            yield events, weight
+
+
+def get_slang_stochastic_language(file_path):
+    """
+    :param file_path: the path of the slang file
+    :return: the probability of every trace, the weights of a trace listed twice are added up
+    """
+    weights = {}
+    for trace, weight in iterate_slang_file(file_path):
+        weights[trace] = weights.get(trace, 0) + weight
+    all_values_sum = sum(weights.values())
+    return {trace: float(weight / all_values_sum) for trace, weight in weights.items()}
+
+
 def main():
     file_path = 'data/rtf_2000.slang'
     slang_content = read_slang_file(file_path)
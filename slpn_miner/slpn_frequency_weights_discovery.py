@@ -1,3 +1,5 @@
+from collections import Counter
+
 import pm4py
 
 from pm4py.objects.petri_net.utils import final_marking, initial_marking
@@ -7,19 +9,27 @@ from slpn_miner.util import setup, get_slpn
 from slpn_miner.slpn_exporter import export_slpn, export_slpn_xml
 
 
+def get_activity_counts(variant_counts):
+    """
+    :param variant_counts: the number of traces of every variant, see get_xes_variant_counts
+    :return: the number of occurrences of every activity in the log
+    """
+    activity_counts = Counter()
+    for trace, count in variant_counts.items():
+        for activity in trace:
+            activity_counts[activity] += count
+    return activity_counts
+
+
 def get_frequency_weights(pn, activity_frequencies):
     trans2weight = {}
 
     for trans in pn.transitions:
         if trans.label is None:
-            print("trans labe")
             trans2weight[trans.name] = 1.0
         else:
             trans2weight[trans.name] = activity_frequencies[trans.label]
 
-    for k,v in trans2weight.items():
-        print("k: ",k, " v: ", v)
-
     return trans2weight
 
 
@@ -1,66 +1,138 @@
-import math
+import logging
 import sys
 
+import numpy as np
 import pm4py
 import scipy
 
 from pm4py.objects.log.importer.xes import importer as xes_importer
 
 from slpn_miner.slpn_visualiser import visualize_slpn, view
-from slpn_miner.symbolic_conversion import calculate_inverse_poland_expression, get_inverse_poland_expression
-from slpn_miner.util import setup, get_slpn
+from slpn_miner.expression_dag import compile_expression_dag
+from slpn_miner.instrumentation import measure
+from slpn_miner.multi_start_optimizer import optimize_with_multi_start_basin_hopping
+from slpn_miner.sparse_equation_system import combine_sparse_traces
+from slpn_miner.symbolic_conversion import get_trace_expression
+from slpn_miner.util import setup, get_slpn, load_weights, store_weights
 from slpn_miner.slpn_exporter import export_slpn, export_slpn_xml
 
 
-def optimize_with_er(log, pn, im, fm):
+def optimize_with_er(log, pn, im, fm, engine="symbolic", cache=None, n_chains=1, instrumentation=None,
+                     warm_start=False, time_budget=None, processes=None):
+    if warm_start and cache is None:
+        raise ValueError("A warm start needs the cache of the previous run.")
+
     # setup the preliminaries
-    obj2add, var_name2idx_map, var_idx2name_map, var_lst = setup(log, pn, im, fm)
+    obj2add, var_name2idx_map, var_idx2name_map, var_lst = setup(log, pn, im, fm, engine=engine, cache=cache,
+                                                                instrumentation=instrumentation,
+                                                                time_budget=time_budget, processes=processes)
 
     # optimize for the entropic relevance objective function
-    objective_function = get_er_obj_func(obj2add, var_name2idx_map)
-    trans_prob_result = optimize_with_basin_hopping(var_lst, objective_function)
+    with measure(instrumentation, "compile"):
+        if engine in ("sparse", "prefix_tree", "forward"):
+            objective_function = get_sparse_er_obj_func(obj2add, jac=True)
+        else:
+            objective_function = get_er_obj_func(obj2add, var_name2idx_map, jac=True)
+    # the weights found on the log of the previous run are a good start on the grown log
+    if warm_start:
+        var_lst = load_weights(cache, pn, im, "er", var_idx2name_map, var_lst)
+    with measure(instrumentation, "optimize"):
+        trans_prob_result = optimize_with_basin_hopping(var_lst, objective_function, jac=True, n_chains=n_chains)
     trans2weight = {}
     for i in range(len(var_lst)):
         trans2weight[str(var_idx2name_map[i])] = trans_prob_result[i]
+    if warm_start:
+        store_weights(cache, pn, im, "er", trans2weight)
     return trans2weight
 
 
-def get_er_obj_func(obj2add, var_name2idx_map):
+def get_er_obj_func(obj2add, var_name2idx_map, jac=False):
     """
     This is the obj func to optimize for entropic-relevance measure
     :param obj2add: each element is a list [trace_symbolic_prob, trace_real_prob]
     :param var_name2idx_map: map transition to value in var_lst
+    :param jac: if True, the objective function returns its value together with its gradient
     :return: the calculated objective function for er
     """
 
+    # compile all traces into one DAG, such that the subterms they share are evaluated once
+    expression_dag = compile_expression_dag(
+        [get_trace_expression(trace_symbolic_prob) for trace_symbolic_prob, _ in obj2add],
+        var_name2idx_map)
+    trace_probs = np.array([trace_prob for _, trace_prob in obj2add], dtype=np.float64)
+
     def er_objective_function(var_lst):
-        obj_func = 0
-        for trace_symbolic_prob, trace_real_prob in obj2add:
-            trace_in_slpn_prob = calculate_inverse_poland_expression(get_inverse_poland_expression(trace_symbolic_prob),
-                                                                     var_name2idx_map, var_lst)
-            if trace_in_slpn_prob == 0:
-                continue
-            obj_func -= math.log(trace_in_slpn_prob, 2) * trace_real_prob
-        return obj_func
+        trace_in_slpn_probs = expression_dag.probabilities(var_lst)
+        fitting = trace_in_slpn_probs > 0
+        return -np.sum(np.log2(trace_in_slpn_probs[fitting]) * trace_probs[fitting])
+
+    def er_objective_function_with_gradient(var_lst):
+        trace_in_slpn_probs = expression_dag.probabilities(var_lst)
+        fitting = trace_in_slpn_probs > 0
+        coefficients = np.zeros(len(trace_probs), dtype=np.float64)
+        coefficients[fitting] = -trace_probs[fitting] / (trace_in_slpn_probs[fitting] * np.log(2))
+        obj_func = -np.sum(np.log2(trace_in_slpn_probs[fitting]) * trace_probs[fitting])
+        return obj_func, expression_dag.gradient(var_lst, coefficients)
+
+    if jac:
+        return er_objective_function_with_gradient
+    return er_objective_function
 
+
+def get_sparse_er_obj_func(obj2add, jac=False):
+    """
+    This is the obj func to optimize for entropic-relevance measure, with trace probabilities from sparse equation systems
+    :param obj2add: each element is a list [sparse_trace, trace_real_prob], see SparseTrace
+    :param jac: if True, the objective function returns its value together with its gradient
+    :return: the calculated objective function for er
+    """
+    # one block diagonal system, such that a single factorisation serves all traces
+    system, trace_index = combine_sparse_traces([sparse_trace for sparse_trace, _ in obj2add])
+    trace_probs = np.array([trace_prob for _, trace_prob in obj2add], dtype=np.float64)
+
+    def er_objective_function(var_lst):
+        trace_in_slpn_probs = system.probabilities(var_lst)[trace_index]
+        fitting = trace_in_slpn_probs > 0
+        return -np.sum(np.log2(trace_in_slpn_probs[fitting]) * trace_probs[fitting])
+
+    def er_objective_function_with_gradient(var_lst):
+        trace_in_slpn_probs = system.probabilities(var_lst)[trace_index]
+        fitting = trace_in_slpn_probs > 0
+        coefficients = np.zeros(len(trace_probs), dtype=np.float64)
+        coefficients[fitting] = -trace_probs[fitting] / (trace_in_slpn_probs[fitting] * np.log(2))
+        obj_func = -np.sum(np.log2(trace_in_slpn_probs[fitting]) * trace_probs[fitting])
+        coefficients = np.bincount(trace_index, weights=coefficients, minlength=system.n_traces)
+        return obj_func, system.gradient(var_lst, coefficients)
+
+    if jac:
+        return er_objective_function_with_gradient
     return er_objective_function
 
 
-def optimize_with_basin_hopping(var_lst, obj_func):
+def optimize_with_basin_hopping(var_lst, obj_func, jac=False, n_chains=1):
     """
     This function is used to optimize the objective function with basin hopping method,
     Regarding basin hopping global optimiser, refer to https://en.wikipedia.org/wiki/Basin-hopping
     :param var:
     :param obj_func:
+    :param jac: whether obj_func returns its gradient together with its value
+    :param n_chains: the number of basin hopping chains, more than one runs them concurrently from different starts
     :return: the variable list that maximize er or uemsc-based measure
     """
     # add constraint such that every var is between 0 and 1
     bds = [(0.0001, 1) for i in range(len(var_lst))]
     # define the method and bound
-    minimizer_kwargs = {"method": "L-BFGS-B", "bounds": bds}
+    minimizer_kwargs = {"method": "L-BFGS-B", "bounds": bds, "jac": jac}
+    if n_chains > 1:
+        best_x, chain_summaries = optimize_with_multi_start_basin_hopping(var_lst, obj_func, minimizer_kwargs,
+                                                                          n_chains=n_chains, niter=100,
+                                                                          stepsize=0.00001)
+        for chain_summary in chain_summaries:
+            logging.info(f"Basin hopping chain: {chain_summary}")
+        return best_x
     # solve problem
     res = scipy.optimize.basinhopping(obj_func, var_lst, minimizer_kwargs=minimizer_kwargs, niter=100, stepsize=0.00001)
-    print(res)
+    logging.debug(res)
     return res.x
 
 
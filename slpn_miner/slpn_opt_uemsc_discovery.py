@@ -1,105 +1,129 @@
-from itertools import chain
+import logging
 
+import numpy as np
 import scipy
-import numba
 import pm4py
 
 from pm4py.objects.petri_net.utils import final_marking, initial_marking
 from pm4py.objects.log.importer.xes import importer as xes_importer
-from slpn_miner.symbolic_conversion import *
-from slpn_miner.util import setup, get_slpn
+from slpn_miner.expression_dag import compile_expression_dag
+from slpn_miner.instrumentation import measure
+from slpn_miner.multi_start_optimizer import optimize_with_multi_start_basin_hopping
+from slpn_miner.sparse_equation_system import combine_sparse_traces
+from slpn_miner.symbolic_conversion import get_trace_expression
+from slpn_miner.util import setup, get_slpn, load_weights, store_weights
 from slpn_miner.slpn_exporter import export_slpn, export_slpn_xml
 
 
-def optimize_with_uemsc(log, pn, im, fm):
+def optimize_with_uemsc(log, pn, im, fm, engine="symbolic", cache=None, n_chains=1, instrumentation=None,
+                        warm_start=False, time_budget=None, processes=None):
+    if warm_start and cache is None:
+        raise ValueError("A warm start needs the cache of the previous run.")
+
     # setup the preliminaries
-    obj2add, var_name2idx_map, var_idx2name_map, var_lst = setup(log, pn, im, fm)
+    obj2add, var_name2idx_map, var_idx2name_map, var_lst = setup(log, pn, im, fm, engine=engine, cache=cache,
+                                                                instrumentation=instrumentation,
+                                                                time_budget=time_budget, processes=processes)
 
     # optimize for the uemsc objective function
-    objective_function = get_uemsc_obj_func(obj2add, var_name2idx_map)
-    trans_prob_result = optimize_with_basin_hopping(var_lst, objective_function)
+    with measure(instrumentation, "compile"):
+        if engine in ("sparse", "prefix_tree", "forward"):
+            objective_function = get_sparse_uemsc_obj_func(obj2add, jac=True)
+        else:
+            objective_function = get_uemsc_obj_func(obj2add, var_name2idx_map, jac=True)
+    # the weights found on the log of the previous run are a good start on the grown log
+    if warm_start:
+        var_lst = load_weights(cache, pn, im, "uemsc", var_idx2name_map, var_lst)
+    with measure(instrumentation, "optimize"):
+        trans_prob_result = optimize_with_basin_hopping(var_lst, objective_function, jac=True, n_chains=n_chains)
     trans2weight = {}
     for i in range(len(var_lst)):
         trans2weight[str(var_idx2name_map[i])] = trans_prob_result[i]
+    if warm_start:
+        store_weights(cache, pn, im, "uemsc", trans2weight)
     return trans2weight
 
 
-def optimize_with_basin_hopping(x0, obj_func):
+def optimize_with_basin_hopping(x0, obj_func, jac=False, n_chains=1):
     """
     This function is used to optimize the objective function with basin hopping method,
     Regarding basin hopping global optimiser, refer to https://en.wikipedia.org/wiki/Basin-hopping
     :param x0: the initial gusee for variables
     :param obj_func: the objective function
+    :param jac: whether obj_func returns its gradient together with its value
+    :param n_chains: the number of basin hopping chains, more than one runs them concurrently from different starts
     :return: the variable list that maximize er or uemsc-based measure
     """
     # add constraint such that every var is between 0 and 1
     bds = [(0.0001, 1) for i in range(len(x0))]
     # define the method and bound
-    minimizer_kwargs = {"method": "L-BFGS-B", "bounds": bds}
+    minimizer_kwargs = {"method": "L-BFGS-B", "bounds": bds, "jac": jac}
+    if n_chains > 1:
+        best_x, chain_summaries = optimize_with_multi_start_basin_hopping(x0, obj_func, minimizer_kwargs,
+                                                                          n_chains=n_chains)
+        for chain_summary in chain_summaries:
+            logging.info(f"Basin hopping chain: {chain_summary}")
+        return best_x
     # solve problem
     res = scipy.optimize.basinhopping(obj_func, x0, minimizer_kwargs=minimizer_kwargs)
     return res.x
 
 
-@numba.njit()
-def uemsc_objective_function(inverse_poland_exprs, trace_probs, constants_lookup, x):
-    obj_func = 0
-    for idx, inverse_poland_expr in enumerate(inverse_poland_exprs):
-        trace_prob = trace_probs[idx]
-        trace_in_slpn_prob = calculate_inverse_poland_expression_numba(inverse_poland_expr, constants_lookup, x)
-        after_inverse = max(trace_prob - trace_in_slpn_prob, 0)
-        obj_func += after_inverse
-    # print("obj_func:",obj_func)
-    return obj_func
-
-
-def get_uemsc_obj_func(obj2add, var_name2idx_map):
+def get_uemsc_obj_func(obj2add, var_name2idx_map, jac=False):
     """
     This is the obj func to optimize for unit-Earth Mover's Stochastic Conformance (uEMSC) measure
     :param obj2add: each element is a list [trace_symbolic_prob, trace_real_prob]
     :param var_name2idx_map: map transition to value in var_lst
+    :param jac: if True, the objective function returns its value together with its gradient
     :return: the calculated objective function for uEMSC
     """
-    inverse_obj2add = [
-        (get_inverse_poland_expression(trace_symbolic_prob), trace_real_prob)
-        for trace_symbolic_prob, trace_real_prob in obj2add
-    ]
-
-    # Now map the expressions to indices:
-    #   - Negative for operators
-    #   - Positive < len(var_list) for variables
-    #   - Positive >= len(var_list) for constants
-    #       - Create a lookup array for these symbols
-    # For this to work, IDs must be continuously assigned
-    assert len(var_name2idx_map) == max(var_name2idx_map.values()) + 1, "IDs must be continuously assigned"
-
-    operator_indexes = {'+': plus_idx, '-': minus_idx, '*': prod_idx, '/': div_idx}
-
-    constant_symbols = {*chain(*(inverse_poland for inverse_poland, _ in inverse_obj2add))}
-    constant_symbols = constant_symbols - var_name2idx_map.keys() - operator_indexes.keys()
-    constant_symbols = list(constant_symbols)  # Put them on a list to order them
-
-    constant_indexes = {symbol: len(var_name2idx_map) + idx for idx, symbol in enumerate(constant_symbols)}
-    constants_lookup = np.array([float(symbol) for symbol in constant_symbols])
-
-    symbol_to_idx = {**var_name2idx_map, **constant_indexes, **operator_indexes}
-    inverse_obj2add = [
-        ([symbol_to_idx[symbol] for symbol in inverse_poland], trace_prob)
-        for inverse_poland, trace_prob in inverse_obj2add
-    ]
-
-    # Pack it into data types that are more friendly to numba
-    # The most important is packing the poland expressions into a numpy array
-    inverse_poland_exprs = [np.array(inverse_poland_exprs, dtype=np.int16)
-                            for inverse_poland_exprs, _ in inverse_obj2add]
-    inverse_poland_exprs = numba.typed.List(inverse_poland_exprs)
-    trace_probs = [trace_prob for _, trace_prob in inverse_obj2add]
-    trace_probs = np.array(trace_probs, dtype=np.float64)
-
-    # Capture the variables
+    # compile all traces into one DAG, such that the subterms they share are evaluated once
+    expression_dag = compile_expression_dag(
+        [get_trace_expression(trace_symbolic_prob) for trace_symbolic_prob, _ in obj2add],
+        var_name2idx_map)
+    trace_probs = np.array([trace_prob for _, trace_prob in obj2add], dtype=np.float64)
+
     def _uemsc_objective_function(x):
-        return uemsc_objective_function(inverse_poland_exprs, trace_probs, constants_lookup, x)
+        trace_in_slpn_probs = expression_dag.probabilities(x)
+        return np.maximum(trace_probs - trace_in_slpn_probs, 0).sum()
+
+    def _uemsc_objective_function_with_gradient(x):
+        trace_in_slpn_probs = expression_dag.probabilities(x)
+        # only the traces that are under-estimated by the slpn contribute to the objective
+        under_estimated = trace_probs - trace_in_slpn_probs > 0
+        gradient = expression_dag.gradient(x, -under_estimated.astype(np.float64))
+        return np.maximum(trace_probs - trace_in_slpn_probs, 0).sum(), gradient
+
+    if jac:
+        return _uemsc_objective_function_with_gradient
+    return _uemsc_objective_function
+
 
+def get_sparse_uemsc_obj_func(obj2add, jac=False):
+    """
+    This is the obj func to optimize for uEMSC measure, with trace probabilities from sparse equation systems
+    :param obj2add: each element is a list [sparse_trace, trace_real_prob], see SparseTrace
+    :param jac: if True, the objective function returns its value together with its gradient
+    :return: the calculated objective function for uEMSC
+    """
+    # one block diagonal system, such that a single factorisation serves all traces
+    system, trace_index = combine_sparse_traces([sparse_trace for sparse_trace, _ in obj2add])
+    trace_probs = np.array([trace_prob for _, trace_prob in obj2add], dtype=np.float64)
+
+    def _uemsc_objective_function(x):
+        trace_in_slpn_probs = system.probabilities(x)[trace_index]
+        return np.maximum(trace_probs - trace_in_slpn_probs, 0).sum()
+
+    def _uemsc_objective_function_with_gradient(x):
+        trace_in_slpn_probs = system.probabilities(x)[trace_index]
+        under_estimated = trace_probs - trace_in_slpn_probs > 0
+        coefficients = np.bincount(trace_index, weights=-under_estimated.astype(np.float64),
+                                   minlength=system.n_traces)
+        gradient = system.gradient(x, coefficients)
+        return np.maximum(trace_probs - trace_in_slpn_probs, 0).sum(), gradient
+
+    if jac:
+        return _uemsc_objective_function_with_gradient
     return _uemsc_objective_function
 
 
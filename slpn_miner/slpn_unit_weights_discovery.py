@@ -18,8 +18,6 @@ def get_unit_weights(pn):
     trans2weight = {}
     for i in range(len(var_lst)):
         trans2weight[str(var_idx2name_map[i])] = 1.0
-    for k, v in trans2weight.items():
-        print("Transition:", k, "Weight:", v)
     return trans2weight
 
 
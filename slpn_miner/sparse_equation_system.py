@@ -0,0 +1,260 @@
+# This file contains the numeric counterpart of the stochastic equation system.
+# Instead of solving the cross product symbolically, it is kept as a sparse linear system whose
+# coefficients are filled from the weight vector proposed by the optimizer.
+from collections import namedtuple
+
+import numpy as np
+
+from scipy.sparse import csc_matrix, identity
+from scipy.sparse.linalg import splu
+
+
+# a trace whose probability is the trace_idx-th probability of a (possibly shared) SparseEquationSystem
+SparseTrace = namedtuple("SparseTrace", ["system", "trace_idx"])
+
+
+class SparseEquationSystem(object):
+    """
+    A (block of) cross product(s) as a sparse absorbing Markov chain parameterised by the transition weights.
+
+    Every arc carries the index of the petri net transition it fires and the index of its normaliser group,
+    i.e. the set of transitions enabled in the marking it leaves. For a weight vector w the arc probability is
+    w[arc_var] / sum(w[group]). The expected number of visits z solves (I - P(w))^T z = e_0, and since the
+    target states have no outgoing arcs, z at a target equals the probability of reaching it.
+    """
+
+    def __init__(self, n_states, arc_from, arc_to, arc_var, arc_group, group_ptr, group_var,
+                 initial_states, target_ptr, target_states):
+        """
+        :param n_states: number of states in the system
+        :param arc_from: source state of every arc
+        :param arc_to: target state of every arc
+        :param arc_var: index in var_lst of the transition fired by every arc
+        :param arc_group: index of the normaliser group of every arc
+        :param group_ptr: CSR pointer into group_var, one group per distinct enabled set
+        :param group_var: indices in var_lst of the transitions of every normaliser group
+        :param initial_states: the initial state of every block
+        :param target_ptr: CSR pointer into target_states, one entry per trace
+        :param target_states: the absorbing states whose reaching probabilities are summed up per trace
+        """
+        self.n_states = int(n_states)
+        self.arc_from = np.asarray(arc_from, dtype=np.int64)
+        self.arc_to = np.asarray(arc_to, dtype=np.int64)
+        self.arc_var = np.asarray(arc_var, dtype=np.int64)
+        self.arc_group = np.asarray(arc_group, dtype=np.int64)
+        self.group_ptr = np.asarray(group_ptr, dtype=np.int64)
+        self.group_var = np.asarray(group_var, dtype=np.int64)
+        self.initial_states = np.asarray(initial_states, dtype=np.int64)
+        self.target_ptr = np.asarray(target_ptr, dtype=np.int64)
+        self.target_states = np.asarray(target_states, dtype=np.int64)
+
+        self.group_owner = np.repeat(np.arange(len(self.group_ptr) - 1), np.diff(self.group_ptr))
+        self.target_owner = np.repeat(np.arange(len(self.target_ptr) - 1), np.diff(self.target_ptr))
+        self.initial_vector = np.zeros(self.n_states, dtype=np.float64)
+        np.add.at(self.initial_vector, self.initial_states, 1.0)
+
+        self.__cached_x = None
+        self.__cached_factorisation = None
+
+    def __getstate__(self):
+        # the factorisation is not picklable, it is recomputed on demand
+        state = self.__dict__.copy()
+        state["_SparseEquationSystem__cached_x"] = None
+        state["_SparseEquationSystem__cached_factorisation"] = None
+        return state
+
+    @property
+    def n_traces(self):
+        return len(self.target_ptr) - 1
+
+    def get_trace(self, trace_idx):
+        return SparseTrace(self, trace_idx)
+
+    def has_target(self, trace_idx):
+        return self.target_ptr[trace_idx + 1] > self.target_ptr[trace_idx]
+
+    @classmethod
+    def stack(cls, systems):
+        """
+        Put several systems into one block diagonal system, such that a single factorisation serves all of them.
+        :param systems: the systems to stack
+        :return: the stacked system, its traces are ordered as in systems
+        """
+        state_offset = 0
+        group_offset = 0
+        group_var_offset = 0
+        target_offset = 0
+        arc_from, arc_to, arc_var, arc_group = [], [], [], []
+        group_ptr, group_var = [np.zeros(1, dtype=np.int64)], []
+        initial_states, target_ptr, target_states = [], [np.zeros(1, dtype=np.int64)], []
+        for system in systems:
+            arc_from.append(system.arc_from + state_offset)
+            arc_to.append(system.arc_to + state_offset)
+            arc_var.append(system.arc_var)
+            arc_group.append(system.arc_group + group_offset)
+            group_ptr.append(system.group_ptr[1:] + group_var_offset)
+            group_var.append(system.group_var)
+            initial_states.append(system.initial_states + state_offset)
+            target_ptr.append(system.target_ptr[1:] + target_offset)
+            target_states.append(system.target_states + state_offset)
+            state_offset += system.n_states
+            group_offset += len(system.group_ptr) - 1
+            group_var_offset += len(system.group_var)
+            target_offset += len(system.target_states)
+
+        def concat(arrays):
+            return np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.int64)
+
+        return cls(state_offset, concat(arc_from), concat(arc_to), concat(arc_var), concat(arc_group),
+                   concat(group_ptr), concat(group_var), concat(initial_states), concat(target_ptr),
+                   concat(target_states))
+
+    def get_arc_probabilities(self, var_lst):
+        """
+        :param var_lst: the weight of every transition
+        :return: the probability of every arc and the normaliser of every group
+        """
+        normalisers = np.bincount(self.group_owner, weights=var_lst[self.group_var],
+                                  minlength=len(self.group_ptr) - 1)
+        return var_lst[self.arc_var] / normalisers[self.arc_group], normalisers
+
+    def factorise(self, var_lst):
+        """
+        LU-factorise I - P(var_lst), the factorisation is reused as long as the weights do not change.
+        :param var_lst: the weight of every transition
+        :return: the factorisation, the arc probabilities and the group normalisers
+        """
+        var_lst = np.asarray(var_lst, dtype=np.float64)
+        if self.__cached_x is not None and np.array_equal(self.__cached_x, var_lst):
+            return self.__cached_factorisation
+
+        arc_probs, normalisers = self.get_arc_probabilities(var_lst)
+        transition_matrix = csc_matrix((arc_probs, (self.arc_from, self.arc_to)),
+                                       shape=(self.n_states, self.n_states))
+        lu = splu((identity(self.n_states, format="csc") - transition_matrix).tocsc())
+
+        self.__cached_x = var_lst.copy()
+        self.__cached_factorisation = (lu, arc_probs, normalisers)
+        return self.__cached_factorisation
+
+    def get_visits(self, var_lst):
+        """
+        :param var_lst: the weight of every transition
+        :return: the expected number of visits of every state when starting in the initial states
+        """
+        lu, _, _ = self.factorise(var_lst)
+        return lu.solve(self.initial_vector, trans="T")
+
+    def probabilities(self, var_lst):
+        """
+        :param var_lst: the weight of every transition
+        :return: the probability of every trace in the system
+        """
+        if self.n_states == 0:
+            return np.zeros(self.n_traces, dtype=np.float64)
+        visits = self.get_visits(var_lst)
+        return np.bincount(self.target_owner, weights=visits[self.target_states], minlength=self.n_traces)
+
+    def gradient(self, var_lst, coefficients):
+        """
+        Gradient of sum_k coefficients[k] * probabilities(var_lst)[k], computed with one extra solve.
+        With A = I - P, the probability of trace k is e_0^T A^-1 e_k, so its derivative is z^T dP v with
+        z = A^-T e_0 (the visits) and v = A^-1 sum_k coefficients[k] e_k.
+        :param var_lst: the weight of every transition
+        :param coefficients: the weight of every trace in the sum
+        :return: the gradient with respect to var_lst
+        """
+        var_lst = np.asarray(var_lst, dtype=np.float64)
+        gradient = np.zeros(len(var_lst), dtype=np.float64)
+        if self.n_states == 0:
+            return gradient
+
+        lu, arc_probs, normalisers = self.factorise(var_lst)
+        visits = lu.solve(self.initial_vector, trans="T")
+        rhs = np.zeros(self.n_states, dtype=np.float64)
+        np.add.at(rhs, self.target_states, np.asarray(coefficients, dtype=np.float64)[self.target_owner])
+        absorption = lu.solve(rhs)
+
+        # d p_arc / d w_k = [k == arc_var] / normaliser - p_arc / normaliser * [k in group]
+        arc_contributions = visits[self.arc_from] * absorption[self.arc_to] / normalisers[self.arc_group]
+        gradient += np.bincount(self.arc_var, weights=arc_contributions, minlength=len(var_lst))
+        group_contributions = np.bincount(self.arc_group, weights=arc_contributions * arc_probs,
+                                          minlength=len(self.group_ptr) - 1)
+        gradient -= np.bincount(self.group_var, weights=group_contributions[self.group_owner],
+                                minlength=len(var_lst))
+        return gradient
+
+
+def combine_sparse_traces(sparse_traces):
+    """
+    Stack the distinct systems of some traces into one system, each shared system is only included once.
+    :param sparse_traces: a list of SparseTrace, they may only share a system other than a SparseEquationSystem
+    :return: the stacked system, and for every trace the index of its probability in the stacked system
+    """
+    systems = []
+    trace_offsets = {}
+    n_traces = 0
+    for sparse_trace in sparse_traces:
+        if id(sparse_trace.system) not in trace_offsets:
+            trace_offsets[id(sparse_trace.system)] = n_traces
+            systems.append(sparse_trace.system)
+            n_traces += sparse_trace.system.n_traces
+    trace_index = np.array([trace_offsets[id(sparse_trace.system)] + sparse_trace.trace_idx
+                            for sparse_trace in sparse_traces], dtype=np.int64)
+    # a single shared system, e.g. of the prefix tree, is used as it is
+    if len(systems) == 1:
+        return systems[0], trace_index
+    return SparseEquationSystem.stack(systems), trace_index
+
+
+def get_normaliser(transition_prob, original_transition_name):
+    """
+    Recover the enabled transitions from a probability string as built by CompactReachabilityGraph.get_outgoing,
+    e.g. "n3/(n3+n5)".
+    :param transition_prob: the probability string of the arc
+    :param original_transition_name: the petri net transition fired by the arc
+    :return: the names of the transitions enabled together with the fired one
+    """
+    if transition_prob == "1":
+        return (original_transition_name,)
+    return tuple(transition_prob.split("/", 1)[1].strip("()").split("+"))
+
+
+def get_sparse_equation_system(cross_product, initial_state, final_states, var_name2idx_map):
+    """
+    This function generates the sparse equation system for the stochastic cross product.
+    :param cross_product: the cross product whose connected states have been computed
+    :param initial_state: the initial state of the cross product
+    :param final_states: the final states of the cross product
+    :param var_name2idx_map: map transition to value in var_lst
+    :return: the sparse system of the trace, or None if the trace cannot be replayed
+    """
+    final_states = [state for state in final_states if state in cross_product.connected_states]
+    if initial_state not in cross_product.connected_states or len(final_states) == 0:
+        return None
+
+    state_to_idx = {initial_state: 0}
+    for state in cross_product.connected_states:
+        if state not in state_to_idx:
+            state_to_idx[state] = len(state_to_idx)
+
+    group_to_idx = {}
+    group_ptr = [0]
+    group_var = []
+    arc_from, arc_to, arc_var, arc_group = [], [], [], []
+    for state, state_idx in state_to_idx.items():
+        for transition in state.outgoing:
+            if transition.to_state not in state_to_idx:
+                continue
+            normaliser = get_normaliser(transition.transition_prob, transition.original_transition_name)
+            if normaliser not in group_to_idx:
+                group_to_idx[normaliser] = len(group_to_idx)
+                group_var.extend(var_name2idx_map[name] for name in normaliser)
+                group_ptr.append(len(group_var))
+            arc_from.append(state_idx)
+            arc_to.append(state_to_idx[transition.to_state])
+            arc_var.append(var_name2idx_map[transition.original_transition_name])
+            arc_group.append(group_to_idx[normaliser])
+
+    return SparseEquationSystem(len(state_to_idx), arc_from, arc_to, arc_var, arc_group, group_ptr, group_var,
+                                [0], [0, len(final_states)], [state_to_idx[state] for state in final_states])
@@ -1,34 +1,116 @@
 # construct a cross product between stochastic reachability graph of the petri net and a trace dfa
-import copy
 import logging
-import re
+from collections import deque
 
-from slpn_miner.stochastic_equation_system import get_equation_system, expand_powers
+from slpn_miner.sparse_equation_system import SparseEquationSystem, get_sparse_equation_system
+from slpn_miner.stochastic_equation_system import eliminate_states
 from slpn_miner.stochastic_transition_system import StochasticTransitionSystem
-
-logging.getLogger().setLevel(logging.DEBUG)
-
+from slpn_miner.symbolic_conversion import ExpressionBuilder, get_inverse_poland_expression
 
 
 def set_and_get_initial_state(trace_incoming_transitions,
-                              srg_incoming_transitions
+                              srg
                               ):
     """
 
     :param trace_incoming_transitions:
-    :param srg_incoming_transitions:
-    :param cross_product:
+    :param srg: the CompactReachabilityGraph
     :return: the initial states in trace and srg
     """
     for s1 in trace_incoming_transitions:
         if trace_incoming_transitions[s1] is None:
-            for s2 in srg_incoming_transitions:
-                if len(srg_incoming_transitions[s2]) == 0:
-                    return s1, s2
+            return s1, srg.initial_state
+
+
+def get_cross_state_name(trace_state, srg_state):
+    """
+    :return: the name of the cross product state, the separator keeps e.g. (1, 12) and (11, 2) apart
+    """
+    return str(trace_state) + "|" + str(srg_state)
+
+
+def get_prefix_tree_cross_product(tree_outgoing_transitions,
+                                  trace_nodes,
+                                  srg,
+                                  var_name2idx_map):
+    """
+    Construct a single cross product between the prefix tree of all traces and the srg, and keep it as one
+    sparse equation system, such that common prefixes are explored only once.
+    A trace ends in its prefix tree node together with a final state of the srg, and since a path can only reach
+    that node by replaying the trace, the probability of reaching it is the probability of the trace.
+    :param tree_outgoing_transitions: the outgoing transitions of the prefix tree, see create_prefix_tree_from_list
+    :param trace_nodes: the prefix tree node reached by every trace
+    :param srg: the CompactReachabilityGraph
+    :param var_name2idx_map: map transition to value in var_lst
+    :return: the sparse equation system whose k-th trace is the one ending in trace_nodes[k]
+    """
+    try:
+        _, srg_init_state = set_and_get_initial_state({0: None}, srg)
+    except TypeError:
+        raise SystemExit(
+            "No initial state found for the stochastic reachability graph. Please check the input petri net.")
+
+    # explore the product breadth first, a product state is a pair of prefix tree node and srg state
+    state_to_idx = {(0, srg_init_state): 0}
+    queue = deque([(0, srg_init_state)])
+    # the normaliser groups are the enabled sets of the srg, all arcs leaving states with the same set share one
+    transition_var = [var_name2idx_map[name] for name in srg.transition_names]
+    group_var = [transition_var[transition] for transition in srg.group_transitions]
+    arc_from, arc_to, arc_var, arc_group = [], [], [], []
+    while queue:
+        node, srg_state = queue.popleft()
+        state_idx = state_to_idx[(node, srg_state)]
+        for arc in range(srg.arc_ptr[srg_state], srg.arc_ptr[srg_state + 1]):
+            label = srg.get_label(arc)
+            if label is None:
+                next_state = (node, int(srg.arc_to[arc]))
+            elif label in tree_outgoing_transitions[node]:
+                next_state = (tree_outgoing_transitions[node][label], int(srg.arc_to[arc]))
+            else:
+                continue
+            if next_state not in state_to_idx:
+                state_to_idx[next_state] = len(state_to_idx)
+                queue.append(next_state)
+            arc_from.append(state_idx)
+            arc_to.append(state_to_idx[next_state])
+            arc_var.append(transition_var[srg.arc_transition[arc]])
+            arc_group.append(srg.state_group[srg_state])
+
+    srg_final_states = srg.final_states.tolist()
+    trace_targets = [[state_to_idx[(node, srg_final_state)] for srg_final_state in srg_final_states
+                      if (node, srg_final_state) in state_to_idx] for node in trace_nodes]
+
+    # keep only the live states, i.e. the ones from which some trace can still end
+    incoming_arcs = [[] for _ in range(len(state_to_idx))]
+    for state_from, state_to in zip(arc_from, arc_to):
+        incoming_arcs[state_to].append(state_from)
+    live_states = {target for targets in trace_targets for target in targets}
+    queue = deque(live_states)
+    while queue:
+        for state_from in incoming_arcs[queue.popleft()]:
+            if state_from not in live_states:
+                live_states.add(state_from)
+                queue.append(state_from)
+    # every explored state is reachable from the initial state 0, so it stays first whenever a trace fits
+    live_idx = {state_idx: new_idx for new_idx, state_idx in enumerate(sorted(live_states))}
+
+    live_arcs = [arc_idx for arc_idx in range(len(arc_from))
+                 if arc_from[arc_idx] in live_idx and arc_to[arc_idx] in live_idx]
+    target_ptr = [0]
+    target_states = []
+    for targets in trace_targets:
+        target_states.extend(live_idx[target] for target in targets)
+        target_ptr.append(len(target_states))
+    return SparseEquationSystem(len(live_idx),
+                                [live_idx[arc_from[arc_idx]] for arc_idx in live_arcs],
+                                [live_idx[arc_to[arc_idx]] for arc_idx in live_arcs],
+                                [arc_var[arc_idx] for arc_idx in live_arcs],
+                                [arc_group[arc_idx] for arc_idx in live_arcs],
+                                srg.group_ptr, group_var,
+                                [0] if live_idx else [], target_ptr, target_states)
 
 
 class ConstructCP:
-    boundary_states_in_rsg = dict()
     cross_product = StochasticTransitionSystem()
     connected_to_initial_state_set = set()
     connected_to_final_state_set = set()
@@ -37,291 +119,240 @@ class ConstructCP:
     def get_cross_product(self,
                           trace_incoming_transitions,
                           trace_outgoing_transitions,
-                          srg_incoming_transitions,
-                          srg_outgoing_transitions) -> str:
+                          srg,
+                          closure=None) -> tuple:
         """
 
         :param trace_incoming_transitions:
         :param trace_outgoing_transitions:
-        :param srg_incoming_transitions:
-        :param srg_outgoing_transitions:
-        :return: the symbolic probability of trace from the cross product as a stochastic transition system between trace and srg
+        :param srg: the CompactReachabilityGraph
+        :param closure: the SilentClosure of the srg, if given the cross product only steps on visible labels
+        :return: the probability of the trace as an Expression of the transition weights, solved from the cross
+                 product between trace and srg, None if the trace cannot be replayed
+        """
+        initial_state, final_states = self.build_cross_product(trace_incoming_transitions,
+                                                               trace_outgoing_transitions,
+                                                               srg,
+                                                               closure)
+        return self.solve_cross_product(initial_state, final_states, closure)
+
+    def build_cross_product(self,
+                            trace_incoming_transitions,
+                            trace_outgoing_transitions,
+                            srg,
+                            closure=None):
+        """
+        Construct the cross product between trace and srg, and keep only its live states.
+        :return: the initial state and the final states of the cross product, the final states are empty if the trace
+                 cannot be replayed
+        """
+        if closure is None:
+            initial_state, final_states = self.construct_cross_product(trace_incoming_transitions,
+                                                                       trace_outgoing_transitions,
+                                                                       srg)
+        else:
+            initial_state, final_states = self.construct_visible_cross_product(trace_incoming_transitions,
+                                                                               trace_outgoing_transitions,
+                                                                               srg,
+                                                                               closure)
+        self.connected(initial_state, final_states)
+        return initial_state, final_states
+
+    def solve_cross_product(self, initial_state, final_states, closure=None):
+        """
+        Solve the equation system of a cross product built by build_cross_product, see eliminate_states.
+        :return: the probability of the trace as an Expression of the transition weights, None if the trace cannot
+                 be replayed
+        """
+        final_states = [state for state in final_states if state in self.cross_product.connected_states]
+        if final_states:
+            builder = ExpressionBuilder()
+            # the arc symbols of the closure are shared by the transitions, so they get their own memo
+            arc_memo = {}
+
+            def get_arc_node(arc_name):
+                return builder.add_inverse_poland_expression(closure.get_arc_expression(arc_name))
+
+            def get_probability_node(transition):
+                if isinstance(transition.transition_prob, str):
+                    return builder.add_inverse_poland_expression(
+                        get_inverse_poland_expression(transition.transition_prob))
+                return builder.add_sympy_expression(transition.transition_prob, get_arc_node, arc_memo)
+
+            trace_prob = eliminate_states(self.cross_product, initial_state, final_states, builder,
+                                          get_probability_node)
+            if trace_prob is not None:
+                return builder.get_expression(trace_prob)
+
+        logging.debug("Cannot derive the probability of this trace from model.")
+        return None
+
+    def get_sparse_system(self,
+                          trace_incoming_transitions,
+                          trace_outgoing_transitions,
+                          srg,
+                          var_name2idx_map):
+        """
+
+        :param trace_incoming_transitions:
+        :param trace_outgoing_transitions:
+        :param srg: the CompactReachabilityGraph
+        :param var_name2idx_map: map transition to value in var_lst
+        :return: the cross product between trace and srg as a sparse equation system, None if the trace does not fit
+        """
+        initial_state, final_states = self.construct_cross_product(trace_incoming_transitions,
+                                                                   trace_outgoing_transitions,
+                                                                   srg)
+        self.connected(initial_state, final_states)
+        if initial_state not in self.cross_product.connected_states:
+            logging.debug("Cannot derive the probability of this trace from model.")
+            return None
+        return get_sparse_equation_system(self.cross_product, initial_state, final_states, var_name2idx_map)
+
+    def construct_cross_product(self,
+                                trace_incoming_transitions,
+                                trace_outgoing_transitions,
+                                srg):
+        """
+        Construct the cross product between trace and srg breadth first, a cross product state is a pair of trace
+        state and srg state and is explored only once, so the silent loops of the srg become loops of the cross product.
+        :param trace_incoming_transitions:
+        :param trace_outgoing_transitions:
+        :param srg: the CompactReachabilityGraph
+        :return: the initial state and the final states of the cross product, the final states are empty if the trace
+                 cannot be replayed
         """
-        self.cross_product.connected_states = set()
-        self.boundary_states_in_rsg = dict()
         self.cross_product = StochasticTransitionSystem()
         self.connected_to_initial_state_set = set()
         self.connected_to_final_state_set = set()
-        self.connected_states = set()
 
         try:
             # set the initial state for cross product system
-            trace_init_state, srg_init_state = set_and_get_initial_state(trace_incoming_transitions, srg_incoming_transitions)
+            trace_init_state, srg_init_state = set_and_get_initial_state(trace_incoming_transitions, srg)
         except TypeError:
             raise SystemExit(
                 "No initial state found for the stochastic reachability graph. Please check the input petri net.")
 
-        # set current state to be the initial state
-        trace_current_state = trace_init_state
-
-        # add the initial state to the boundary states
-        self.boundary_states_in_rsg[srg_init_state] = True
+        cross_states = {(trace_init_state, srg_init_state): self.cross_product.add_state(
+            StochasticTransitionSystem.State(name=get_cross_state_name(trace_init_state, srg_init_state)))}
+        queue = deque([(trace_init_state, srg_init_state)])
+        while queue:
+            trace_state, srg_state = queue.popleft()
+            cross_state = cross_states[(trace_state, srg_state)]
+            trace_step = trace_outgoing_transitions[trace_state]
+            for srg_out_trans, srg_next_state in srg.get_outgoing(srg_state):
+                # a silent transition keeps the trace state, a visible one has to match the next trace label
+                if srg_out_trans[2] is None:
+                    next_state = (trace_state, srg_next_state)
+                elif trace_step is not None and srg_out_trans[2] == trace_step[0]:
+                    next_state = (trace_step[1], srg_next_state)
+                else:
+                    continue
+                if next_state not in cross_states:
+                    cross_states[next_state] = self.cross_product.add_state(
+                        StochasticTransitionSystem.State(name=get_cross_state_name(*next_state)))
+                    queue.append(next_state)
+                self.add_arc_from_to(*srg_out_trans, cross_state, cross_states[next_state])
+
+        trace_final_state = next(state for state, step in trace_outgoing_transitions.items() if step is None)
+        final_states = [cross_states[(trace_final_state, srg_final_state)]
+                        for srg_final_state in srg.final_states.tolist()
+                        if (trace_final_state, srg_final_state) in cross_states]
+        return cross_states[(trace_init_state, srg_init_state)], final_states
+
+    def construct_visible_cross_product(self,
+                                        trace_incoming_transitions,
+                                        trace_outgoing_transitions,
+                                        srg,
+                                        closure):
+        """
+        Construct the cross product on the silent closure of the srg: every trace step fires one visible exit of the
+        srg states reached so far, and the silent paths before it are folded into the probability of the exit.
+        After the last trace step, the final srg states are reached by the silent exits.
+        :param trace_incoming_transitions:
+        :param trace_outgoing_transitions:
+        :param srg: the CompactReachabilityGraph
+        :param closure: the SilentClosure of the srg
+        :return: the initial state and the final states of the cross product, the final states are empty if the trace
+                 cannot be replayed
+        """
+        self.cross_product = StochasticTransitionSystem()
+        self.connected_to_initial_state_set = set()
+        self.connected_to_final_state_set = set()
 
-        # loop until reaching the final state in trace
+        trace_current_state, srg_init_state = set_and_get_initial_state(trace_incoming_transitions, srg)
+        initial_state = self.cross_product.add_state(StochasticTransitionSystem.State(
+            name=get_cross_state_name(trace_current_state, srg_init_state)))
+        frontier = {srg_init_state: initial_state}
         while trace_outgoing_transitions[trace_current_state] is not None:
-            # get the transition label from trace
-            trace_transition_label = trace_outgoing_transitions[trace_current_state][0]
-            temp_boundary_in_rsg = copy.copy(self.boundary_states_in_rsg)
-
-            for srg_state_to_explore, flag in self.boundary_states_in_rsg.items():
-                # if the transition is fired in this state
-                if flag is False:
-                    del temp_boundary_in_rsg[srg_state_to_explore]
+            trace_transition_label, trace_next_state = trace_outgoing_transitions[trace_current_state]
+            next_frontier = {}
+            for srg_state, cross_state in frontier.items():
+                for srg_exit, srg_next_state in closure.get_exits(srg_state):
+                    if srg_exit[2] != trace_transition_label:
+                        continue
+                    if srg_next_state not in next_frontier:
+                        next_frontier[srg_next_state] = self.cross_product.add_state(StochasticTransitionSystem.State(
+                            name=get_cross_state_name(trace_next_state, srg_next_state)))
+                    self.add_arc_from_to(*srg_exit, cross_state, next_frontier[srg_next_state])
+            frontier = next_frontier
+            trace_current_state = trace_next_state
+
+        srg_final_states = set(srg.final_states.tolist())
+        final_states = {srg_state: cross_state for srg_state, cross_state in frontier.items()
+                        if srg_state in srg_final_states}
+        for srg_state, cross_state in frontier.items():
+            for srg_exit, srg_next_state in closure.get_exits(srg_state):
+                if srg_exit[2] is not None:
                     continue
-                temp_boundary_in_rsg[srg_state_to_explore] = False
-
-            for srg_state_to_explore, flag in temp_boundary_in_rsg.items():
-                # if the transition is fired in this state
-                self.get_match_states(trace_outgoing_transitions,
-                                      trace_transition_label,
-                                      trace_current_state,
-                                      srg_outgoing_transitions,
-                                      srg_state_to_explore
-                                      )
-
-            # continue with the next state in trace
-            trace_current_state = trace_outgoing_transitions[trace_current_state][1]
-
-        trace_final_state = ""
-        for state, key in trace_outgoing_transitions.items():
-            if key is None:
-                trace_final_state = state
-
-        rsg_final_state_set = set()
-        rsg_final_state = ""
-        for state, key in srg_outgoing_transitions.items():
-            if len(key) == 0:
-                rsg_final_state = state.name
-                rsg_final_state_set.add(rsg_final_state)
-
-        trace_init_state = ""
-        for state, key in trace_incoming_transitions.items():
-            if key is None:
-                trace_initial_state = state
-
-        connected_states = set()
-        rsg_initial_state = ""
-        for state, key in srg_incoming_transitions.items():
-            if len(key) == 0:
-                rsg_initial_state = state.name
-        trace_prob = "0"
-
-        for rsg_final_state in rsg_final_state_set:
-            if (self.cross_product.get_state_by_name(str(trace_final_state) + str(rsg_final_state))) is not None:
-                # print("have a final state: ", str(trace_final_state) + str(rsg_final_state))
-                cross_product_final_state = str(trace_final_state) + str(rsg_final_state)
-            else:
-                trace_prob = "0"
-                continue
-
-            if (self.cross_product.get_state_by_name(str(trace_initial_state) + str(rsg_initial_state))) is not None:
-                cross_product_initial_state = str(trace_initial_state) + str(rsg_initial_state)
-            else:
-                trace_prob = "0"
-                continue
+                if srg_next_state not in final_states:
+                    final_states[srg_next_state] = self.cross_product.add_state(StochasticTransitionSystem.State(
+                        name=get_cross_state_name(trace_current_state, srg_next_state)))
+                self.add_arc_from_to(*srg_exit, cross_state, final_states[srg_next_state])
+        return initial_state, list(final_states.values())
 
-            # construc_equation_system()
-            initial_state = self.cross_product.get_state_by_name(cross_product_initial_state)
-            final_state = self.cross_product.get_state_by_name(cross_product_final_state)
-
-            self.connected_to_initial_state(initial_state)
-            self.connected_to_final_state(final_state)
-            self.connected(initial_state, final_state)
-
-            trace_prob = get_equation_system(self.cross_product, initial_state, final_state)
-            if trace_prob != "0":
-                break
-
-        if trace_prob != "0":
-            pattern = r't\d+'
-            # Replace substrings using re.sub with the replace_match function
-            s = re.sub(pattern, self.replace_variables, expand_powers(trace_prob))
-            updated_trace_prob = s.replace("1*", "")
-            return updated_trace_prob
-
-        logging.debug("Cannot derive the probability of this trace from model.")
-        return "0"
-
-    def replace_variables(self, match):
-        variable_name = match.group(0)
-        for transition in self.cross_product.transitions:
-            if transition.new_transition_name == variable_name:
-                return transition.transition_prob
-
-    def connected(self, initial_state, final_state):
+    def connected(self, initial_state, final_states):
         """
+        Keep only the live states, i.e. the states on some path from the initial state to a final state,
+        and prune all other states from the cross product before the equation system is generated.
         :return: update cross product
         """
-        self.cross_product.connected_states = self.connected_to_initial_state_set & self.connected_to_final_state_set
-        self.cross_product.connected_states.add(initial_state)
-        self.cross_product.connected_states.add(final_state)
+        self.connected_to_initial_state(initial_state)
+        for final_state in final_states:
+            self.connected_to_final_state(final_state)
+        live_states = self.connected_to_initial_state_set & self.connected_to_final_state_set
+        self.cross_product.restrict_to(live_states)
+        self.cross_product.connected_states = live_states
 
     def connected_to_initial_state(self, state_to_explore):
         """
-
+        Breadth-first search along outgoing transitions, states already in the set are not explored again.
         :return: update cross product
         """
-        for transition in self.cross_product.transitions:
-            if transition.from_state == state_to_explore:
-                self.connected_to_initial_state_set.add(transition.to_state)
-                self.connected_to_initial_state(transition.to_state)
+        if state_to_explore in self.connected_to_initial_state_set:
+            return
+        self.connected_to_initial_state_set.add(state_to_explore)
+        queue = deque([state_to_explore])
+        while queue:
+            for transition in queue.popleft().outgoing:
+                if transition.to_state not in self.connected_to_initial_state_set:
+                    self.connected_to_initial_state_set.add(transition.to_state)
+                    queue.append(transition.to_state)
 
     def connected_to_final_state(self, state_to_explore):
         """
-
+        Breadth-first search along incoming transitions, states already in the set are not explored again.
         :return: update cross product
         """
-        for transition in self.cross_product.transitions:
-            if transition.to_state == state_to_explore:
-                self.connected_to_final_state_set.add(transition.from_state)
-                self.connected_to_final_state(transition.from_state)
-
-    def get_match_states(self,
-                         trace_outgoing_transitions,
-                         trace_transition_label,
-                         trace_current_state,
-                         srg_outgoing_transitions,
-                         srg_current_state,
-                         ):
-        """
-
-        :param trace_outgoing_transitions:
-        :param trace_transition_label:
-        :param trace_current_state:
-        :param srg_outgoing_transitions:
-        :param srg_current_state:
-        :param non_silent_tansition_num: count the time we observe non-silent transitions
-        :return: no return
-        """
-        state_name = str(trace_current_state) + str(srg_current_state)
-
-        # iterate until find the matching state with same transition_label
-        for srg_out_trans, srg_next_state in srg_outgoing_transitions[srg_current_state].items():
-
-            # if the srg transition is no-silent and equals the trace transition label
-            if srg_out_trans[2] == trace_transition_label:
-                # cross_product.add_state(state_name)
-                cross_state = self.cross_product.get_state_by_name(state_name)
-                if cross_state is None:
-                    cross_state = StochasticTransitionSystem.State(name=state_name)
-                    # add the state to cp
-                    self.cross_product.states.add(cross_state)
-
-                # add state to boundary
-                self.boundary_states_in_rsg[srg_next_state] = True
-                trace_next_state = trace_outgoing_transitions[trace_current_state][1]
-                # aim to add transition
-                self.get_future_matching_states(trace_outgoing_transitions,
-                                                srg_outgoing_transitions,
-                                                trace_transition_label,
-                                                trace_next_state,
-                                                srg_next_state,
-                                                srg_out_trans,
-                                                cross_state)
-
-            # if the srg transition is silent, we continue to explore the next state
-            elif srg_out_trans[2] is None:
-
-                cross_state = self.cross_product.get_state_by_name(state_name)
-                if cross_state is None:
-                    cross_state = StochasticTransitionSystem.State(name=state_name)
-                    # add the state to cp
-                    self.cross_product.states.add(cross_state)
-                # visited_state_set.add(state_name)
-                if srg_next_state not in self.boundary_states_in_rsg:
-                    self.boundary_states_in_rsg[srg_next_state] = False
-                    self.get_future_matching_states(trace_outgoing_transitions,
-                                                    srg_outgoing_transitions,
-                                                    trace_transition_label,
-                                                    trace_current_state,
-                                                    srg_next_state,
-                                                    srg_out_trans,
-                                                    cross_state)
-
-    def get_future_matching_states(self,
-                                   trace_outgoing_transitions,
-                                   srg_outgoing_transitions,
-                                   trace_transition_label,
-                                   trace_current_state,
-                                   srg_current_state,
-                                   srg_previous_trans,
-                                   cross_state_previous):
-        state_name = str(trace_current_state) + str(srg_current_state)
-        cross_state = self.cross_product.get_state_by_name(state_name)
-
-        # if the arc is already in, then we do not add a transition
-        if cross_state is not None:
-            if not (
-                    self.cross_product.transition_exists(srg_previous_trans[2], cross_state_previous.name,
-                                                         cross_state.name)):
-                self.add_arc_from_to(srg_previous_trans[0],
-                                     srg_previous_trans[1],
-                                     srg_previous_trans[2],
-                                     srg_previous_trans[3],
-                                     cross_state_previous,
-                                     cross_state
-                                     )
-
-        #  if the cross state is None
-        else:
-            cross_state = StochasticTransitionSystem.State(name=state_name)
-            self.cross_product.add_state(state_name)
-            # add the state to cp
-            self.cross_product.states.add(cross_state)
-            # if the current state is already in cross product, we do not add it again
-            # add the state to already visited_state_set
-            self.add_arc_from_to(srg_previous_trans[0],
-                                 srg_previous_trans[1],
-                                 srg_previous_trans[2],
-                                 srg_previous_trans[3],
-                                 cross_state_previous,
-                                 cross_state
-                                 )
-
-        # continue the search
-        for srg_out_trans, srg_next_state in srg_outgoing_transitions[srg_current_state].items():
-
-            # continue if firing non-silent transition for next state
-            if self.boundary_states_in_rsg[srg_current_state] is False and srg_out_trans[2] == trace_transition_label:
-                self.boundary_states_in_rsg[srg_next_state] = True
-                self.get_future_matching_states(trace_outgoing_transitions,
-                                                srg_outgoing_transitions,
-                                                trace_transition_label,
-                                                trace_outgoing_transitions[trace_current_state][1],
-                                                srg_next_state,
-                                                srg_out_trans,
-                                                cross_state)
-
-            elif self.boundary_states_in_rsg[srg_current_state] is False and srg_out_trans[2] is None:
-                self.boundary_states_in_rsg[srg_next_state] = False
-                self.get_future_matching_states(trace_outgoing_transitions,
-                                                srg_outgoing_transitions,
-                                                trace_transition_label,
-                                                trace_current_state,
-                                                srg_next_state,
-                                                srg_out_trans,
-                                                cross_state)
-
-            # continue if firing silent transition for next state
-            elif self.boundary_states_in_rsg[srg_current_state] is True and srg_out_trans[2] is None:
-                self.boundary_states_in_rsg[srg_next_state] = True
-                self.get_future_matching_states(trace_outgoing_transitions,
-                                                srg_outgoing_transitions,
-                                                trace_transition_label,
-                                                trace_current_state,
-                                                srg_next_state,
-                                                srg_out_trans,
-                                                cross_state)
+        if state_to_explore in self.connected_to_final_state_set:
+            return
+        self.connected_to_final_state_set.add(state_to_explore)
+        queue = deque([state_to_explore])
+        while queue:
+            for transition in queue.popleft().incoming:
+                if transition.from_state not in self.connected_to_final_state_set:
+                    self.connected_to_final_state_set.add(transition.from_state)
+                    queue.append(transition.from_state)
 
     def add_arc_from_to(self, new_t_name, original_t_name, t_label, t_prob, fr, to):
         """
@@ -350,7 +381,4 @@ class ConstructCP:
             fr,
             to
         )
-        self.cross_product.transitions.add(tran)
-
-        fr.outgoing.add(tran)
-        to.incoming.add(tran)
\ No newline at end of file
+        self.cross_product.add_transition(tran)
\ No newline at end of file
@@ -1,77 +1,192 @@
-# This file contains the function to generate the equation system for the stochastic cross product.
-import re
-import logging
+# This file contains the solver of the equation system of the stochastic cross product.
+# The probability x(s) of reaching the final state from a state s satisfies x(s) = sum p(s -> t) * x(t) over the
+# transitions leaving s, with x(s) = 1 for every final state. Instead of handing this system to a general purpose
+# solver, the states are eliminated one by one from the transition graph, and the probability is built as an
+# Expression.
+import heapq
+from collections import deque
 
-from sympy import Eq, solve, Symbol
 
-logging.getLogger().setLevel(logging.DEBUG)
+def eliminate_states(cross_product, initial_state, final_states, builder, get_probability_node):
+    """
+    Solve the equation system of a cross product by state elimination. Eliminating a state s reroutes every path
+    u -> s -> w through a transition u -> w with probability p(u -> s) * p(s -> w) / (1 - p(s -> s)), so the
+    acyclic parts of the cross product reduce to sums of products and only its loops create a division. The
+    strongly connected components are eliminated in reverse topological order, the sinks first, such that every
+    state is eliminated once its successors are, and the states within a component in order of the fewest new
+    transitions, i.e. minimum degree. The final states lead to one absorbing target with probability 1, so the
+    probabilities of reaching them add up.
+    :param cross_product: the cross product whose connected states have been computed
+    :param initial_state: the initial state of the cross product
+    :param final_states: the final states of the cross product
+    :param builder: the ExpressionBuilder the probability is added to
+    :param get_probability_node: maps a transition of the cross product to the node of its probability
+    :return: the node of the probability of reaching a final state from the initial state, None if it is 0
+    """
+    one = builder.add_node("1")
+    final_states = set(final_states)
+    if initial_state in final_states:
+        return one
+
+    # number the states breadth first from the initial state, with the transitions in order of their names, so the
+    # expression is the same in every run; the final states are absorbing, they are not left
+    states = [initial_state]
+    state_idx = {initial_state: 0}
+    queue = deque([initial_state])
+    while queue:
+        state = queue.popleft()
+        if state in final_states:
+            continue
+        for transition in sorted(state.outgoing, key=lambda transition: transition.new_transition_name):
+            if transition.to_state in cross_product.connected_states and transition.to_state not in state_idx:
+                state_idx[transition.to_state] = len(states)
+                states.append(transition.to_state)
+                queue.append(transition.to_state)
+    final_idx = [idx for idx, state in enumerate(states) if state in final_states]
+    if not final_idx:
+        return None
+    target_idx = len(states)
+
+    # the probability of every transition, parallel transitions are added up; every final state leads to the target
+    out_edges = [{} for _ in range(target_idx + 1)]
+    in_edges = [set() for _ in range(target_idx + 1)]
+    for idx in final_idx:
+        out_edges[idx][target_idx] = one
+        in_edges[target_idx].add(idx)
+    for idx, state in enumerate(states):
+        if state in final_states:
+            continue
+        for transition in sorted(state.outgoing, key=lambda transition: transition.new_transition_name):
+            next_idx = state_idx.get(transition.to_state)
+            if next_idx is None:
+                continue
+            node = get_probability_node(transition)
+            existing = out_edges[idx].get(next_idx)
+            out_edges[idx][next_idx] = node if existing is None else builder.add_node(('+', existing, node))
+            in_edges[next_idx].add(idx)
 
+    # the initial state and the target stay, every path between them is rerouted through a direct transition
+    eliminate_graph(out_edges, in_edges, {0, target_idx}, builder)
 
+    trace_prob = out_edges[0].get(target_idx)
+    if trace_prob is None:
+        return None
+    loop = out_edges[0].get(0)
+    if loop is not None:
+        trace_prob = builder.add_node(('/', trace_prob, builder.add_node(('-', one, loop))))
+    return trace_prob
 
-def get_equation_system(cross_product, initial_state, final_state):
+
+def eliminate_graph(out_edges, in_edges, kept, builder):
     """
-    This function generates the equation system for the stochastic cross product.
-    :param cross_product:
-    :param initial_state:
-    :param final_state:
-    :return: the symbolic representation of trace probability from the slpn
+    Eliminate every state of a transition graph that is not kept, see eliminate_states. Afterwards the transitions
+    between the kept states stand for all paths between them through the eliminated states.
+    :param out_edges: the node of every transition leaving every state, as a dict next state -> node, it is updated
+    :param in_edges: the states with a transition to every state, as a set, it is updated
+    :param kept: the states that are not eliminated
+    :param builder: the builder the nodes are added to, e.g. an ExpressionBuilder
     """
-    print("compute equation system")
-    eqs = []
-    variables = []
-    state_to_variable_map = {}
-    state_idx = 1
-    for state in cross_product.connected_states:
-        if state == initial_state:
-            variable_name = Symbol(f'a0', positive=True)
-            variables.append(variable_name)
-            state_to_variable_map[state] = variable_name
-            continue
-        variable_name = Symbol(f'a{state_idx}')
-        variables.append(variable_name)
-        state_to_variable_map[state] = variable_name
-        state_idx += 1
+    one = builder.add_node("1")
 
-    for transition in cross_product.transitions:
-        if transition.to_state in cross_product.connected_states and transition.from_state in cross_product.connected_states:
-            variable_name = Symbol(f'{transition.new_transition_name}')
-            state_to_variable_map[transition] = variable_name
+    def multiply(left, right):
+        if left == one:
+            return right
+        if right == one:
+            return left
+        return builder.add_node(('*', left, right))
 
-    for state in cross_product.connected_states:
-        right_hand = 0
-        for transition in cross_product.transitions:
-            if transition.from_state == state and transition.to_state in cross_product.connected_states:
-                right_hand += state_to_variable_map[transition] * state_to_variable_map[transition.to_state]
-        if state == final_state:
-            right_hand = 1
-        eq = Eq(state_to_variable_map[state], right_hand)
-        eqs.append(eq)
+    def eliminate(idx):
+        loop = out_edges[idx].pop(idx, None)
+        in_edges[idx].discard(idx)
+        successors = out_edges[idx]
+        if loop is not None:
+            # the expected number of visits of the state per entry
+            factor = builder.add_node(('/', one, builder.add_node(('-', one, loop))))
+            successors = {next_idx: multiply(node, factor) for next_idx, node in successors.items()}
+        for previous_idx in sorted(in_edges[idx]):
+            entry = out_edges[previous_idx].pop(idx)
+            for next_idx, node in successors.items():
+                node = multiply(entry, node)
+                existing = out_edges[previous_idx].get(next_idx)
+                out_edges[previous_idx][next_idx] = node if existing is None else builder.add_node(('+', existing,
+                                                                                                    node))
+                in_edges[next_idx].add(previous_idx)
+        for next_idx in successors:
+            in_edges[next_idx].discard(idx)
+        out_edges[idx] = {}
+        in_edges[idx] = set()
 
-    sols = solve(eqs, variables)
-    if len(sols) == 0:
-        return str(0)
+    def get_degree(idx):
+        return len(in_edges[idx] - {idx}) * len(out_edges[idx].keys() - {idx})
 
-    variable_name = Symbol(f'a0', positive=True)
-    input_string = str(sols[variable_name])
-    # for transition in cross_product.transitions:
-    return input_string
+    for component in get_strongly_connected_components(out_edges):
+        remaining = {idx for idx in component if idx not in kept}
+        if len(remaining) == 1:
+            eliminate(remaining.pop())
+            continue
+        heap = [(get_degree(idx), idx) for idx in remaining]
+        heapq.heapify(heap)
+        while heap:
+            degree, idx = heapq.heappop(heap)
+            if idx not in remaining:
+                continue
+            if degree != get_degree(idx):
+                heapq.heappush(heap, (get_degree(idx), idx))
+                continue
+            remaining.discard(idx)
+            neighbours = (in_edges[idx] | out_edges[idx].keys()) & remaining
+            eliminate(idx)
+            for neighbour in neighbours:
+                heapq.heappush(heap, (get_degree(neighbour), neighbour))
 
 
-def expand_powers(s):
+def get_strongly_connected_components(out_edges):
     """
-    This function expands the powers in the string.
-    :param s:
-    :return:
+    Tarjan's algorithm, without recursion.
+    :param out_edges: the successors of every state, as a list or as the keys of a dict
+    :return: the states of every component, in reverse topological order, i.e. the sink components first
     """
-    # Function to replace match with expanded form
-    def replacer(match):
-        var = match.group(1)
-        power = int(match.group(2))
-        return '*'.join([var] * power)
-
-    # Regex to match t<digit>**<power>
-    pattern = re.compile(r"(t\d+)\*\*(\d+)")
-
-    # Replace all occurrences using replacer function
-    expanded_string = pattern.sub(replacer, s)
-    return expanded_string
\ No newline at end of file
+    index = [-1] * len(out_edges)
+    low_link = [0] * len(out_edges)
+    on_stack = [False] * len(out_edges)
+    components = []
+    stack = []
+    counter = 0
+    for root in range(len(out_edges)):
+        if index[root] >= 0:
+            continue
+        work = [(root, iter(out_edges[root]))]
+        index[root] = low_link[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        while work:
+            state, successors = work[-1]
+            recurse = False
+            for next_state in successors:
+                if index[next_state] < 0:
+                    index[next_state] = low_link[next_state] = counter
+                    counter += 1
+                    stack.append(next_state)
+                    on_stack[next_state] = True
+                    work.append((next_state, iter(out_edges[next_state])))
+                    recurse = True
+                    break
+                if on_stack[next_state]:
+                    low_link[state] = min(low_link[state], index[next_state])
+            if recurse:
+                continue
+            work.pop()
+            if low_link[state] == index[state]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = False
+                    component.append(member)
+                    if member == state:
+                        break
+                components.append(component)
+            if work:
+                parent = work[-1][0]
+                low_link[parent] = min(low_link[parent], low_link[state])
+    return components
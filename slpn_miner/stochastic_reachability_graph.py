@@ -1,22 +1,79 @@
 import time
 from enum import Enum
 
-from pm4py.objects import petri_net
-from pm4py.objects.petri_net.utils import align_utils
-from pm4py.objects.transition_system import obj as ts
-from pm4py.util import exec_utils
+import numba
+import numpy as np
 
-from slpn_miner.stochastic_transition_system import StochasticTransitionSystem
+from pm4py.util import exec_utils
 
 
 class Parameters(Enum):
     MAX_ELAB_TIME = "max_elab_time"
-    PETRI_SEMANTICS = "petri_semantics"
 
 
-def marking_flow_petri(net, im, return_eventually_enabled=False, parameters=None):
+def get_incidence_matrices(net):
+    """
+    Encode the arcs of a petri net as CSR pre and post incidence matrices, places and transitions ordered by name.
+    :param net: petri net
+    :return: places, transitions, (pre_ptr, pre_place, pre_weight), (post_ptr, post_place, post_weight)
+    """
+    places = sorted(net.places, key=lambda place: place.name)
+    transitions = sorted(net.transitions, key=lambda transition: transition.name)
+    place_to_idx = {place: idx for idx, place in enumerate(places)}
+    transition_to_idx = {transition: idx for idx, transition in enumerate(transitions)}
+
+    pre_arcs = [[] for _ in transitions]
+    post_arcs = [[] for _ in transitions]
+    for arc in net.arcs:
+        if arc.source in place_to_idx:
+            pre_arcs[transition_to_idx[arc.target]].append((place_to_idx[arc.source], arc.weight))
+        else:
+            post_arcs[transition_to_idx[arc.source]].append((place_to_idx[arc.target], arc.weight))
+
+    def get_csr(arcs_per_transition):
+        ptr = np.cumsum([0] + [len(arcs) for arcs in arcs_per_transition])
+        arcs = [arc for arcs in arcs_per_transition for arc in sorted(arcs)]
+        return ptr.astype(np.int64), np.array([place for place, _ in arcs], dtype=np.int64), \
+            np.array([weight for _, weight in arcs], dtype=np.int64)
+
+    return places, transitions, get_csr(pre_arcs), get_csr(post_arcs)
+
+
+@numba.njit(cache=True)
+def fire_enabled_transitions_numba(marking, pre_ptr, pre_place, pre_weight, post_ptr, post_place, post_weight):
+    """
+    :return: the indices of the transitions enabled in the marking, and the marking reached by firing each of them
+    """
+    n_transitions = len(pre_ptr) - 1
+    enabled = np.zeros(n_transitions, dtype=np.int64)
+    n_enabled = 0
+    for t in range(n_transitions):
+        is_enabled = True
+        for k in range(pre_ptr[t], pre_ptr[t + 1]):
+            if marking[pre_place[k]] < pre_weight[k]:
+                is_enabled = False
+                break
+        if is_enabled:
+            enabled[n_enabled] = t
+            n_enabled += 1
+
+    successors = np.empty((n_enabled, len(marking)), dtype=np.int64)
+    for i in range(n_enabled):
+        t = enabled[i]
+        for p in range(len(marking)):
+            successors[i, p] = marking[p]
+        for k in range(pre_ptr[t], pre_ptr[t + 1]):
+            successors[i, pre_place[k]] -= pre_weight[k]
+        for k in range(post_ptr[t], post_ptr[t + 1]):
+            successors[i, post_place[k]] += post_weight[k]
+    return enabled[:n_enabled], successors
+
+
+def marking_flow_incidence(net, im, parameters=None):
     """
-    Construct the marking flow of a Petri net
+    Construct the marking flow of a Petri net, with markings as packed integer vectors whose enabled transitions
+    and successors are computed from the incidence matrices. Every distinct marking is
+    interned into an integer state id, the initial marking being state 0.
 
     Parameters
     -----------------
@@ -24,207 +81,57 @@ def marking_flow_petri(net, im, return_eventually_enabled=False, parameters=None
         Petri net
     im
         Initial marking
-    return_eventually_enabled
-        Return the eventually enabled (visible) transitions
+
+    Returns
+    -----------------
+    places
+        The places, in the order of the marking vectors
+    transitions
+        The transitions, in the order of arc_transition
+    markings
+        The marking vector of every state
+    arc_from, arc_to, arc_transition
+        The source state, target state and transition index of every arc, grouped by source state
     """
     if parameters is None:
         parameters = {}
 
     # set a maximum execution time of 1 day (it can be changed by providing the parameter)
     max_exec_time = exec_utils.get_param_value(Parameters.MAX_ELAB_TIME, parameters, 86400)
-    semantics = exec_utils.get_param_value(Parameters.PETRI_SEMANTICS, parameters,
-                                           petri_net.semantics.ClassicSemantics())
 
     start_time = time.time()
 
-    incoming_transitions = {im: set()}
-    outgoing_transitions = {}
-    eventually_enabled = {}
-
-    active = [im]
-    while active:
+    places, transitions, pre, post = get_incidence_matrices(net)
+    place_to_idx = {place: idx for idx, place in enumerate(places)}
+    initial_marking_vector = np.zeros(len(places), dtype=np.uint16)
+    for place, count in im.items():
+        initial_marking_vector[place_to_idx[place]] = count
+
+    # the packed markings double as the keys of the state ids
+    markings = [initial_marking_vector.tobytes()]
+    state_ids = {markings[0]: 0}
+    arc_from, arc_to, arc_transition = [], [], []
+    state = 0
+    while state < len(markings):
         if (time.time() - start_time) >= max_exec_time:
             # interrupt the execution
-            return incoming_transitions, outgoing_transitions, eventually_enabled
-        m = active.pop()
-        enabled_transitions = semantics.enabled_transitions(net, m)
-        if return_eventually_enabled:
-            eventually_enabled[m] = align_utils.get_visible_transitions_eventually_enabled_by_marking(net, m)
-        outgoing_transitions[m] = {}
-        for t in enabled_transitions:
-            nm = semantics.weak_execute(t, net, m)
-            outgoing_transitions[m][t] = nm
-            if nm not in incoming_transitions:
-                incoming_transitions[nm] = set()
-                if nm not in active:
-                    active.append(nm)
-            incoming_transitions[nm].add(t)
-
-    return incoming_transitions, outgoing_transitions, eventually_enabled
-
-
-def construct_stochatic_reachability_graph_from_flow(incoming_transitions, outgoing_transitions,
-                                                     use_trans_name=False, parameters=None):
-    """
-    Construct the reachability graph from the marking flow
-
-    Parameters
-    ----------------
-    incoming_transitions
-        Incoming transitions
-    outgoing_transitions
-        Outgoing transitions
-    use_trans_name
-        Use the transition name
-
-    Returns
-    ----------------
-    re_gr
-        Transition system that represents the reachability graph of the input Petri net.
-    """
-    if parameters is None:
-        parameters = {}
-
-    re_gr = StochasticTransitionSystem()
-    map_states = {}
-
-    for s in incoming_transitions:
-        map_states[s] = ts.TransitionSystem.State(s)
-        re_gr.states.add(map_states[s])
-        #     get the initial state:
-        if len(incoming_transitions[s]) == 0:
-            re_gr.init_state = map_states[s]
-
-    new_t_id = 0
-    for s1 in outgoing_transitions:
-        total_trans_weight = ""
-        count = 0
-        for t in outgoing_transitions[s1]:
-            if count == 0:
-                total_trans_weight += "(" + str(t.name)
-            else:
-                total_trans_weight += "+" + str(t.name)
-            count += 1
-        total_trans_weight += ")"
-
-        for t in outgoing_transitions[s1]:
-            s2 = outgoing_transitions[s1][t]
-            if t.label is None:
-                if count == 1:
-                    add_arc_from_to(new_t_id, t.name, t.label, "1", map_states[s1], map_states[s2], re_gr)
-                else:
-                    add_arc_from_to(new_t_id, t.name, t.label, t.name + "/" + total_trans_weight, map_states[s1],
-                                    map_states[s2], re_gr)
-            else:
-                if count == 1:
-                    add_arc_from_to(new_t_id, t.name, t.label, "1", map_states[s1], map_states[s2], re_gr)
-                else:
-                    add_arc_from_to(new_t_id, t.name, t.label, t.name + "/" + total_trans_weight, map_states[s1],
-                                    map_states[s2], re_gr)
-            new_t_id += 1
-    return re_gr
-
-
-def construct_srg(incoming_transitions, outgoing_transitions, parameters=None):
-    """
-    Construct the reachability graph from the marking flow
-
-    Parameters
-    ----------------
-    incoming_transitions
-        Incoming transitions
-    outgoing_transitions
-        Outgoing transitions
-    use_trans_name
-        Use the transition name
-
-    Returns
-    ----------------
-    incoming_transitions
-        Incoming transitions
-    outgoing_transitions
-        Outgoing transitions.
-    """
-    if parameters is None:
-        parameters = {}
-
-    re_gr = StochasticTransitionSystem()
-
-    map_states = {}
-    srg_incoming_transitions = {}
-
-    for s in incoming_transitions:
-        map_states[s] = ts.TransitionSystem.State(s)
-        re_gr.states.add(map_states[s])
-        #     get the initial state:
-        srg_incoming_transitions[map_states[s]] = incoming_transitions[s]
-
-    srg_outgoing_transitions = {}
-
-    new_t_id = 0
-    for s1 in outgoing_transitions:
-        srg_outgoing_transitions[map_states[s1]] = {}
-        total_trans_weight = ""
-        count = 0
-        for t in outgoing_transitions[s1]:
-            if count == 0:
-                total_trans_weight += "(" + str(t.name)
-            else:
-                total_trans_weight += "+" + str(t.name)
-            count += 1
-        total_trans_weight += ")"
-
-        for t in outgoing_transitions[s1]:
-            s2 = outgoing_transitions[s1][t]
-            if count == 1:
-                transition = ("t" + str(new_t_id), t.name, t.label, "1")
-            else:
-                transition = ("t" + str(new_t_id), t.name, t.label, t.name + "/" + total_trans_weight)
-            srg_outgoing_transitions[map_states[s1]][transition] = map_states[s2]
-            new_t_id += 1
-    return srg_incoming_transitions, srg_outgoing_transitions
-
-
-def add_arc_from_to(new_t_id, original_t_id, t_label, t_prob, fr, to, stochastic_ts, data=None):
-    """
-    Adds a transition from a state to another state in some transition system.
-    Assumes from and to are in the transition system!
-
-    Parameters
-    ----------
-    name: name of the transition
-    fr: state from
-    to:  state to
-    ts: transition system to use
-    data: data associated to the Transition System
-
-    Returns
-    -------
-    None
-    """
-    tran = StochasticTransitionSystem.Transition("t" + str(new_t_id), original_t_id,
-                                                 t_label, t_prob, fr, to, data)
-    stochastic_ts.transitions.add(tran)
-
-    fr.outgoing.add(tran)
-    to.incoming.add(tran)
-
-
-def construct_stochastic_reachability_graph(net, initial_marking, parameters=None):
-    """
-    Creates a reachability graph of a certain Petri net.
-    DO NOT ATTEMPT WITH AN UNBOUNDED PETRI NET, EVER.
-
-    Parameters
-    ----------
-    net: Petri net
-    initial_marking: initial marking of the Petri net.
-
-    Returns
-    -------
-    re_gr: Transition system that represents the reachability graph of the input Petri net.
-    """
-    incoming_transitions, outgoing_transitions, eventually_enabled = marking_flow_petri(net, initial_marking, parameters=parameters)
-    srg_incoming_transitions, srg_outgoing_transitions = construct_srg(incoming_transitions, outgoing_transitions, parameters=parameters)
-    return srg_incoming_transitions, srg_outgoing_transitions
-
+            break
+        marking = np.frombuffer(markings[state], dtype=np.uint16)
+        enabled, successors = fire_enabled_transitions_numba(marking, *pre, *post)
+        if successors.size and successors.max() > np.iinfo(np.uint16).max:
+            raise ValueError("The petri net is not bounded: a place holds more than 65535 tokens.")
+        successors = successors.astype(np.uint16)
+        for t, successor in zip(enabled, successors):
+            key = successor.tobytes()
+            next_state = state_ids.get(key)
+            if next_state is None:
+                next_state = len(markings)
+                state_ids[key] = next_state
+                markings.append(key)
+            arc_from.append(state)
+            arc_to.append(next_state)
+            arc_transition.append(t)
+        state += 1
+
+    return places, transitions, np.frombuffer(b"".join(markings), dtype=np.uint16).reshape(len(markings), len(places)), \
+        np.array(arc_from, dtype=np.int64), np.array(arc_to, dtype=np.int64), np.array(arc_transition, dtype=np.int64)
@@ -1,5 +1,6 @@
-import numba
-import numpy as np
+from collections import namedtuple
+
+import sympy
 
 
 plus_idx = -1
@@ -8,74 +9,117 @@ prod_idx = -3
 div_idx = -4
 
 
-@numba.njit("float64(int16[::1], float64[::1], float64[::1])", inline='always', cache=True)
-def calculate_inverse_poland_expression_numba(inverse_poland_expression, constants_dict, var_lst):
-    calculate_stack = np.zeros(len(inverse_poland_expression), dtype=np.float64) # preallocate the stack
-    stack_ptr = int(0)
-    len_var_lst = len(var_lst)
-
-    for idx in inverse_poland_expression:
-        if idx == plus_idx:
-            p2 = calculate_stack[stack_ptr - 2]
-            p1 = calculate_stack[stack_ptr - 1]
-            calculate_stack[stack_ptr - 2] = p2 + p1
-            stack_ptr -= 1
-        elif idx == minus_idx:
-            p2 = calculate_stack[stack_ptr - 2]
-            p1 = calculate_stack[stack_ptr - 1]
-            calculate_stack[stack_ptr - 2] = p2 - p1
-            stack_ptr -= 1
-        elif idx == prod_idx:
-            p2 = calculate_stack[stack_ptr - 2]
-            p1 = calculate_stack[stack_ptr - 1]
-            calculate_stack[stack_ptr - 2] = p2 * p1
-            stack_ptr -= 1
-        elif idx == div_idx:
-            p2 = calculate_stack[stack_ptr - 2]
-            p1 = calculate_stack[stack_ptr - 1]
-            calculate_stack[stack_ptr - 2] = p2 / p1
-            stack_ptr -= 1
-        else:
-            if idx < len_var_lst:
-                val = var_lst[idx]
-                calculate_stack[stack_ptr] = val
+# the probability of a trace as a DAG of operators, see ExpressionBuilder
+Expression = namedtuple("Expression", ["nodes", "root"])
+
+
+class ExpressionBuilder(object):
+    """
+    Builds an Expression node by node. A node is either a token, i.e. a transition like "n3" or a constant like
+    "1", or an operator (operator, left node, right node) with the operator one of +, -, * and /. A node that is
+    added twice is stored once, so the subexpressions shared by several parts of the expression are shared too.
+    """
+
+    def __init__(self):
+        self.nodes = []
+        self.__node_idx = {}
+
+    def add_node(self, node):
+        """
+        :param node: a token or an operator (operator, left node, right node)
+        :return: the index of the node
+        """
+        node_idx = self.__node_idx.get(node)
+        if node_idx is None:
+            node_idx = len(self.nodes)
+            self.nodes.append(node)
+            self.__node_idx[node] = node_idx
+        return node_idx
+
+    def add_inverse_poland_expression(self, inverse_poland_expression):
+        """
+        :param inverse_poland_expression: the tokens, see get_inverse_poland_expression
+        :return: the index of the root node
+        """
+        calculate_stack = []
+        for token in inverse_poland_expression:
+            if token in {'+', '-', '*', '/'}:
+                right = calculate_stack.pop()
+                left = calculate_stack.pop()
+                calculate_stack.append(self.add_node((token, left, right)))
             else:
-                constant_idx = idx - len_var_lst
-                calculate_stack[stack_ptr] = constants_dict[constant_idx]
-            stack_ptr += 1
-
-    return calculate_stack[0]
-
-
-def calculate_inverse_poland_expression(inverse_poland_expression, str_to_idx, var_lst):
-    result = 0
-    calculate_stack = []
-    for str_val in inverse_poland_expression:
-        if str_val in {'+', '-', '*', '/'}:
-            # Do the calculation for two variables.
-            p1 = calculate_stack.pop()
-            p2 = calculate_stack.pop()
-            result = simple_calculate(p2, p1, str_val)
-            calculate_stack.append(result)
+                calculate_stack.append(self.add_node(token))
+        return calculate_stack[-1]
+
+    def add_sympy_expression(self, expr, get_symbol_node, memo):
+        """
+        Add a sympy expression without printing it: negations become subtractions from 0 and integer powers are
+        written out as products.
+        :param expr: the sympy expression
+        :param get_symbol_node: maps the name of a symbol to the index of the node it stands for
+        :param memo: the nodes of the subexpressions added so far with the same get_symbol_node
+        :return: the index of the root node
+        """
+        node_idx = memo.get(expr)
+        if node_idx is not None:
+            return node_idx
+
+        def add(subexpr):
+            return self.add_sympy_expression(subexpr, get_symbol_node, memo)
+
+        def fold(operator, left, operands):
+            for operand in operands:
+                left = self.add_node((operator, left, add(operand)))
+            return left
+
+        if expr.is_Symbol:
+            node_idx = get_symbol_node(expr.name)
+        elif expr.is_Add:
+            positive = [term for term in expr.args if not term.could_extract_minus_sign()]
+            negative = [-term for term in expr.args if term.could_extract_minus_sign()]
+            node_idx = fold('+', add(positive[0]), positive[1:]) if positive else self.add_node("0")
+            node_idx = fold('-', node_idx, negative)
+        elif expr.could_extract_minus_sign():
+            node_idx = self.add_node(('-', self.add_node("0"), add(-expr)))
+        elif expr.is_Integer:
+            node_idx = self.add_node(str(expr))
+        elif expr.is_Rational:
+            node_idx = self.add_node(('/', self.add_node(str(expr.p)), self.add_node(str(expr.q))))
         else:
-            if str_val in str_to_idx:
-                calculate_stack.append(var_lst[str_to_idx[str_val]])
+            numerator, denominator = sympy.fraction(expr)
+            if denominator != 1:
+                node_idx = self.add_node(('/', add(numerator), add(denominator)))
+            elif expr.is_Mul:
+                node_idx = fold('*', add(expr.args[0]), expr.args[1:])
+            elif expr.is_Pow and expr.exp.is_Integer and expr.exp > 0:
+                node_idx = fold('*', add(expr.base), [expr.base] * (int(expr.exp) - 1))
             else:
-                calculate_stack.append(float(str_val))
-    return result
+                raise ValueError("Cannot convert the expression " + str(expr))
+        memo[expr] = node_idx
+        return node_idx
+
+    def get_expression(self, root):
+        return Expression(tuple(self.nodes), root)
+
 
+class SympyExpressionBuilder(object):
+    """
+    Builds sympy expressions with the interface of ExpressionBuilder, the node of a token or operator is the sympy
+    expression itself, e.g. to solve the silent closure by the same state elimination as the cross products.
+    """
 
-def simple_calculate(p1, p2, operator):
-    if operator == '+':
-        return p1 + p2
-    elif operator == '-':
-        return p1 - p2
-    elif operator == '*':
-        return p1 * p2
-    elif operator == '/':
-        return p1 / p2
-    else:
-        raise ValueError("Invalid operator")
+    operators = {'+': lambda left, right: left + right, '-': lambda left, right: left - right,
+                 '*': lambda left, right: left * right, '/': lambda left, right: left / right}
+
+    def add_node(self, node):
+        """
+        :param node: a constant like "1" or an operator (operator, left expression, right expression)
+        :return: the sympy expression
+        """
+        if isinstance(node, str):
+            return sympy.Integer(node)
+        operator, left, right = node
+        return self.operators[operator](left, right)
 
 
 def get_inverse_poland_expression(exp):
@@ -138,3 +182,15 @@ def get_inverse_poland_expression(exp):
         temp1 = reverse_polish.pop()
         result2.insert(0, temp1)
     return result2
+
+
+def get_trace_expression(trace_prob):
+    """
+    :param trace_prob: the probability of a trace as computed by the symbolic engine, an Expression, or a probability
+                       string as computed by earlier versions, e.g. read from a TraceProbabilityCache
+    :return: the Expression
+    """
+    if isinstance(trace_prob, str):
+        builder = ExpressionBuilder()
+        return builder.get_expression(builder.add_inverse_poland_expression(get_inverse_poland_expression(trace_prob)))
+    return trace_prob
@@ -0,0 +1,184 @@
+# This file contains a persistent on-disk cache of trace probabilities, such that reruns of the discovery on
+# the same petri net and log skip the cross products. Entries are stored in an SQLite file and the least recently
+# used entries are evicted once the cache grows beyond its maximal size. The optimal weights of a run are kept in
+# the same file, so that the next run on a grown log can start from them.
+import hashlib
+import json
+import pickle
+import sqlite3
+import time
+
+
+# the value cached for a trace that does not fit the petri net, so that it is not computed again either
+NOT_FITTING = "not fitting"
+
+
+def get_petri_net_hash(pn, im):
+    """
+    Canonical hash of a petri net with its initial marking, independent of the order of places, transitions and arcs.
+    :param pn: petri net
+    :param im: initial marking
+    :return: the hex digest of the hash
+    """
+    canonical = {
+        "places": sorted(place.name for place in pn.places),
+        "transitions": sorted([trans.name, trans.label if trans.label is not None else ""]
+                              for trans in pn.transitions),
+        "arcs": sorted([arc.source.name, arc.target.name, arc.weight] for arc in pn.arcs),
+        "initial_marking": sorted([place.name, count] for place, count in im.items()),
+    }
+    return hashlib.sha256(json.dumps(canonical).encode("utf-8")).hexdigest()
+
+
+def get_trace_key(net_hash, engine, trace):
+    """
+    :param net_hash: the hash of the petri net, see get_petri_net_hash
+    :param engine: the engine that computed the probability
+    :param trace: the trace as a sequence of activities
+    :return: the key of the trace probability in the cache
+    """
+    return hashlib.sha256(json.dumps([net_hash, engine, list(trace)]).encode("utf-8")).hexdigest()
+
+
+def get_weights_key(net_hash, objective):
+    """
+    :param net_hash: the hash of the petri net, see get_petri_net_hash
+    :param objective: the objective the weights optimise, e.g. "uemsc"
+    :return: the key of the weights in the cache
+    """
+    return hashlib.sha256(json.dumps([net_hash, "weights", objective]).encode("utf-8")).hexdigest()
+
+
+def get_chunks(keys, chunk_size=500):
+    """
+    :param keys: the keys of a query
+    :param chunk_size: the maximal number of keys in a chunk, below the limit of SQLite on the parameters of a query
+    :return: the keys split into chunks
+    """
+    return [keys[start:start + chunk_size] for start in range(0, len(keys), chunk_size)]
+
+
+class TraceProbabilityCache(object):
+    def __init__(self, path, max_size=1 << 30):
+        """
+        :param path: the path of the SQLite file, it is created if it does not exist
+        :param max_size: the maximal total size in bytes of the cached values
+        """
+        self.path = path
+        self.max_size = max_size
+        self.__connection = sqlite3.connect(path)
+        self.__connection.execute("CREATE TABLE IF NOT EXISTS trace_prob "
+                                  "(key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_used REAL)")
+        self.__connection.execute("CREATE INDEX IF NOT EXISTS trace_prob_last_used ON trace_prob (last_used)")
+        # the weights are few and small, they are never evicted
+        self.__connection.execute("CREATE TABLE IF NOT EXISTS weights (key TEXT PRIMARY KEY, value TEXT)")
+        self.__connection.commit()
+        # the total size is summed once, and kept up to date by put_many and evict
+        self.__size = self.__connection.execute("SELECT COALESCE(SUM(size), 0) FROM trace_prob").fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __contains__(self, key):
+        return self.__connection.execute("SELECT 1 FROM trace_prob WHERE key = ?", (key,)).fetchone() is not None
+
+    def __len__(self):
+        return self.__connection.execute("SELECT COUNT(*) FROM trace_prob").fetchone()[0]
+
+    def get(self, key, default=None):
+        return self.get_many([key], default)[0]
+
+    def get_many(self, keys, default=None):
+        """
+        Look up the values of many keys in one transaction, and mark the found entries as used.
+        :param keys: the keys to look up
+        :param default: the value returned for a key that is not cached
+        :return: the value of every key, in their order
+        """
+        values = {}
+        for chunk in get_chunks(keys):
+            query = "SELECT key, value FROM trace_prob WHERE key IN (" + ",".join("?" * len(chunk)) + ")"
+            for key, blob in self.__connection.execute(query, chunk):
+                values[key] = blob
+        if values:
+            now = time.time()
+            self.__connection.executemany("UPDATE trace_prob SET last_used = ? WHERE key = ?",
+                                          [(now, key) for key in values])
+            self.__connection.commit()
+        return [pickle.loads(values[key]) if key in values else default for key in keys]
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+    def put_many(self, items):
+        """
+        Store many values in one transaction, and evict the least recently used entries if the cache grew beyond its
+        maximal size.
+        :param items: the (key, value) pairs to store
+        """
+        rows = {}
+        now = time.time()
+        for key, value in items:
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            rows[key] = (key, blob, len(blob), now)
+        if not rows:
+            return
+        # the replaced entries no longer count towards the size
+        for chunk in get_chunks(list(rows)):
+            query = "SELECT size FROM trace_prob WHERE key IN (" + ",".join("?" * len(chunk)) + ")"
+            for size, in self.__connection.execute(query, chunk):
+                self.__size -= size
+        self.__connection.executemany("INSERT OR REPLACE INTO trace_prob (key, value, size, last_used) "
+                                      "VALUES (?, ?, ?, ?)", rows.values())
+        self.__size += sum(row[2] for row in rows.values())
+        if self.__size > self.max_size:
+            self.evict()
+        self.__connection.commit()
+
+    def get_size(self):
+        """
+        :return: the total size in bytes of the cached values, kept as a running total since the cache was opened
+        """
+        return self.__size
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits into its maximal size.
+        """
+        excess = self.__size - self.max_size
+        if excess <= 0:
+            return
+        removed = 0
+        keys = []
+        for key, size in self.__connection.execute("SELECT key, size FROM trace_prob ORDER BY last_used"):
+            if removed >= excess:
+                break
+            keys.append((key,))
+            removed += size
+        self.__connection.executemany("DELETE FROM trace_prob WHERE key = ?", keys)
+        self.__size -= removed
+        self.__connection.commit()
+
+    def get_weights(self, key):
+        """
+        :return: the weight of every transition stored with the key, None if there are none
+        """
+        row = self.__connection.execute("SELECT value FROM weights WHERE key = ?", (key,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put_weights(self, key, trans2weight):
+        self.__connection.execute("INSERT OR REPLACE INTO weights (key, value) VALUES (?, ?)",
+                                  (key, json.dumps({name: float(weight) for name, weight in trans2weight.items()})))
+        self.__connection.commit()
+
+    def clear(self):
+        self.__connection.execute("DELETE FROM trace_prob")
+        self.__connection.execute("DELETE FROM weights")
+        self.__connection.commit()
+        self.__size = 0
+
+    def close(self):
+        self.__connection.close()
@@ -6,7 +6,8 @@ def get_outgoing(symbol_list):
     outgoing_transitions = {}
     for i in range(len(symbol_list)):
         outgoing_transitions[i] = (symbol_list[i], i + 1)
-    outgoing_transitions[i + 1] = None
+    # the last state is the final one, for the empty trace it is the initial state
+    outgoing_transitions[len(symbol_list)] = None
     return outgoing_transitions
 
 
@@ -15,3 +16,23 @@ def get_incoming(symbol_list):
     for i in range(1, len(symbol_list) + 1):
         incoming_transitions[i] = (symbol_list[i - 1], i - 1)
     return incoming_transitions
+
+
+def create_prefix_tree_from_list(trace_list):
+    """
+    Create the prefix tree automaton of a list of traces, node 0 is the root.
+    :param trace_list: the traces, each as a sequence of activities
+    :return: the outgoing transitions of every node as a dict label -> child node, and the node reached by every trace
+    """
+    outgoing_transitions = {0: {}}
+    trace_nodes = []
+    for trace in trace_list:
+        node = 0
+        for symbol in trace:
+            if symbol not in outgoing_transitions[node]:
+                child = len(outgoing_transitions)
+                outgoing_transitions[node][symbol] = child
+                outgoing_transitions[child] = {}
+            node = outgoing_transitions[node][symbol]
+        trace_nodes.append(node)
+    return outgoing_transitions, trace_nodes
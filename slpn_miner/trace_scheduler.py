@@ -0,0 +1,99 @@
+# This file contains the scheduler of the cross products of the traces of a log.
+# The traces holding the most probability mass per unit of estimated cost are computed first, so that a limited
+# time budget covers as much of the log as possible. Within a budget, every trace gets a timeout proportional to its
+# mass, and the traces that run over it are retried with a larger one as long as time remains.
+import logging
+import time
+
+
+# the result of a task that timed out or was not started, as opposed to None for a trace that does not fit
+UNFINISHED = object()
+# the result of a task that raised an error, it is not retried, as it would fail again
+FAILED = object()
+
+
+def get_label_fan_out(srg):
+    """
+    :param srg: the CompactReachabilityGraph
+    :return: the number of arcs of the srg with every label
+    """
+    fan_out = {}
+    for label_idx in srg.arc_label:
+        if label_idx >= 0:
+            label = srg.labels[label_idx]
+            fan_out[label] = fan_out.get(label, 0) + 1
+    return fan_out
+
+
+def get_trace_cost(trace, label_fan_out):
+    """
+    A cheap estimate of the size of the cross product of a trace: every event can be matched by any srg arc with its
+    label, so the number of these arcs adds up over the events.
+    :param trace: the trace as a sequence of activities
+    :param label_fan_out: see get_label_fan_out
+    :return: the estimated cost, None if an activity is not a label of the petri net, i.e. the trace does not fit
+    """
+    cost = 1
+    for activity in trace:
+        if activity not in label_fan_out:
+            return None
+        cost += label_fan_out[activity]
+    return cost
+
+
+def run_scheduled_tasks(pool, tasks, masses, costs, timeout=15, time_budget=None, min_timeout=1.0):
+    """
+    Run the tasks on the pool, ordered by mass per cost. Without a time budget every task gets the same timeout
+    and runs once. With a time budget, the timeout of a task is its share of the time budget by mass, between
+    min_timeout and timeout, and the tasks that run over it are retried with twice their timeout while time remains.
+    :param pool: the TimeoutWorkerPool
+    :param tasks: the tasks
+    :param masses: the probability mass of every task
+    :param costs: the estimated cost of every task, see get_trace_cost
+    :param timeout: the timeout of every task without a time budget, the first timeout at most with one
+    :param time_budget: the wall-clock time in seconds after which all tasks are given up, None for no budget
+    :param min_timeout: the smallest timeout of a task with a time budget
+    :return: the results, UNFINISHED for the tasks that did not finish and FAILED for the ones that raised an error,
+             and the number of attempts and the last timeout of every task, a task without attempts was skipped, as
+             the time budget ran out before it was started
+    """
+    results = [UNFINISHED] * len(tasks)
+    attempts = [0] * len(tasks)
+    timeouts = [timeout] * len(tasks)
+    if not tasks:
+        return results, attempts, timeouts
+
+    deadline = None if time_budget is None else time.time() + time_budget
+    pending = sorted(range(len(tasks)), key=lambda task_idx: -masses[task_idx] / max(costs[task_idx], 1))
+    if deadline is not None:
+        # every worker spends the remaining time on its share of the mass
+        pending_mass = sum(masses[task_idx] for task_idx in pending) or 1.0
+        for task_idx in pending:
+            share = time_budget * pool.processes * masses[task_idx] / pending_mass
+            timeouts[task_idx] = max(min_timeout, min(timeout, share))
+
+    while pending:
+        round_results = pool.map([tasks[task_idx] for task_idx in pending],
+                                 timeout=[timeouts[task_idx] for task_idx in pending],
+                                 default=UNFINISHED, deadline=deadline, error=FAILED)
+        for round_idx, (task_idx, result) in enumerate(zip(pending, round_results)):
+            results[task_idx] = result
+            # a task that was not started before the deadline is no attempt
+            if round_idx in pool.submitted:
+                attempts[task_idx] += 1
+        if deadline is None:
+            break
+
+        remaining = deadline - time.time()
+        unfinished = [task_idx for task_idx in pending if results[task_idx] is UNFINISHED]
+        # a retry only helps a task if it gets more time than it had
+        pending = [task_idx for task_idx in unfinished if timeouts[task_idx] < remaining]
+        if pending:
+            logging.info(f"Retrying {len(pending)} traces with {remaining:.0f}s of the time budget left.")
+        for task_idx in pending:
+            timeouts[task_idx] = min(2 * timeouts[task_idx], remaining)
+
+    skipped = attempts.count(0)
+    if skipped:
+        logging.info(f"Skipped {skipped} traces that were not started before the time budget ran out.")
+    return results, attempts, timeouts
@@ -1,46 +1,91 @@
 import re
 import logging
-import multiprocessing
-import queue
+import time
+
+import pm4py
+from pm4py.objects.petri_net.utils import final_marking, initial_marking
+
+from slpn_miner.compact_reachability_graph import CompactReachabilityGraph
+from slpn_miner.forward_trace_system import ForwardTraceSystem
+from slpn_miner.instrumentation import get_peak_memory, measure, profile_worker_task, reset_peak_memory
 from slpn_miner.log_util import get_stochastic_language
-from slpn_miner.stochastic_cross_product import ConstructCP
-from slpn_miner.stochastic_reachability_graph import construct_stochastic_reachability_graph
-from slpn_miner.trace_dfa import create_dfa_from_list
-logging.getLogger().setLevel(logging.DEBUG)
+from slpn_miner.silent_closure import SilentClosure
+from slpn_miner.stochastic_cross_product import ConstructCP, get_prefix_tree_cross_product
+from slpn_miner.trace_cache import NOT_FITTING, get_petri_net_hash, get_trace_key, get_weights_key
+from slpn_miner.trace_dfa import create_dfa_from_list, create_prefix_tree_from_list
+from slpn_miner.trace_scheduler import FAILED, UNFINISHED, get_label_fan_out, get_trace_cost, run_scheduled_tasks
+from slpn_miner.worker_pool import TimeoutWorkerPool
+
+
+# the srg and its silent closure shared by all traces, set once per worker process by init_cross_product_worker
+_worker_srg = None
+
+
+def init_cross_product_worker(srg, closure, var_name2idx_map, profile_path=None):
+    """Initializer of the worker processes, it receives the srg only once per process"""
+    global _worker_srg
+    _worker_srg = (srg, closure, var_name2idx_map, profile_path)
 
 
 def get_cross_product_worker(args):
-    """Worker function for multiprocessing"""
-    trace_it, trace_ot, srg_it, srg_ot = args
-    try:
+    """
+    Worker function for multiprocessing, it computes the cross product of one trace, under cProfile if the
+    Instrumentation of the run profiles.
+    :param args: the trace and the engine
+    :return: the probability of the trace, None if it does not fit, and its trace record, see TRACE_FIELDS
+    """
+    trace, engine = args
+    srg, closure, var_name2idx_map, profile_path = _worker_srg
+    # the peak memory of the worker while it computes this trace, where the os allows to reset it
+    reset_peak_memory()
+    with profile_worker_task(profile_path):
+        trace_ot, trace_it = create_dfa_from_list(trace)
         CP = ConstructCP()
-        return CP.get_cross_product(trace_it, trace_ot, srg_it, srg_ot)
-    except Exception as e:
-        raise e
-
-def run_with_timeout(trace_it, trace_ot, srg_it, srg_ot, timeout=3):
-    """Run function with timeout using multiprocessing"""
-    with multiprocessing.Pool(1) as pool:
-        try:
-            result = pool.apply_async(
-                get_cross_product_worker,
-                ((trace_it, trace_ot, srg_it, srg_ot),)
-            )
-            return result.get(timeout=timeout)
-        except multiprocessing.TimeoutError:
-            return "0"
-        except Exception as e:
-            print(f"Function error: {e}")
-            return "0"
-
-def get_cross_product_func(trace_it, trace_ot, srg_it, srg_ot):
-    CP = ConstructCP()
-    return CP.get_cross_product(trace_it, trace_ot, srg_it, srg_ot)
-
-
-def setup(log, pn, im, fm):
+        start_time = time.perf_counter()
+        if engine == "sparse":
+            trace_system = CP.get_sparse_system(trace_it, trace_ot, srg, var_name2idx_map)
+            trace_prob = None if trace_system is None else trace_system.get_trace(0)
+            record = {"build_time": time.perf_counter() - start_time, "solve_time": None, "expression_size": None,
+                      "states": 0 if trace_system is None else trace_system.n_states,
+                      "arcs": 0 if trace_system is None else len(trace_system.arc_from)}
+        else:
+            initial_state, final_states = CP.build_cross_product(trace_it, trace_ot, srg, closure)
+            build_time = time.perf_counter() - start_time
+            # the cross product is restricted to its live states already
+            record = {"build_time": build_time, "states": len(CP.cross_product.states),
+                      "arcs": len(CP.cross_product.transitions)}
+            trace_prob = CP.solve_cross_product(initial_state, final_states, closure)
+            record["solve_time"] = time.perf_counter() - start_time - build_time
+            record["expression_size"] = None if trace_prob is None else len(trace_prob.nodes)
+    record["fits"] = trace_prob is not None
+    record["peak_memory_mb"] = get_peak_memory()
+    return trace_prob, record
+
+
+def setup(log, pn, im, fm, engine="symbolic", processes=None, cache=None, instrumentation=None, timeout=15,
+          time_budget=None):
+    """
+    Compute the probability of every trace of the log in the slpn as a function of the transition weights.
+    :param log: the event log, the path of an XES file, optionally gzip compressed, whose variants are counted
+                while streaming it, see get_xes_variant_counts, or the path of a .slang stochastic language
+    :param engine: "symbolic" solves each cross product into an Expression by state elimination,
+                   "sparse" keeps each cross product as a SparseEquationSystem solved numerically per weight vector,
+                   "prefix_tree" builds one SparseEquationSystem from the prefix tree of all traces, shared by them,
+                   "forward" replays the prefix tree of all traces on the srg per weight vector, see ForwardTraceSystem
+    :param processes: the number of worker processes computing the cross products, the number of cpus by default
+    :param cache: an optional TraceProbabilityCache, the symbolic trace probabilities are looked up in and stored to it
+    :param instrumentation: an optional Instrumentation, which times the phases and records every trace
+    :param timeout: the time in seconds after which the cross product of a trace is given up
+    :param time_budget: an optional time in seconds for all cross products, the traces with the most probability mass
+                        per estimated cost are computed first and the timeouts are adapted, see run_scheduled_tasks
+    :return: obj2add, where each element is a list [trace_prob_in_slpn, trace_real_prob], and the variable maps
+    """
+    if engine not in ("symbolic", "sparse", "prefix_tree", "forward"):
+        raise ValueError("Invalid engine: " + str(engine))
+
     # get trace and its probability
-    stochastic_lang = get_stochastic_language(log)
+    with measure(instrumentation, "stochastic_language"):
+        stochastic_lang = get_stochastic_language(log)
 
     # get the transition to weight mapping
     var_name2idx_map = {}
@@ -54,37 +99,101 @@ def setup(log, pn, im, fm):
         var_idx += 1
 
     # construct rsg from petri net
-    srg_it, srg_ot = construct_stochastic_reachability_graph(pn, im)
+    with measure(instrumentation, "srg"):
+        srg = CompactReachabilityGraph.from_petri_net(pn, im)
 
     # define obj function uemsc
     obj2add = []
 
-    for trace, weight in stochastic_lang.items():
-        weight_result = float(weight)
-        trace_ot, trace_it = create_dfa_from_list(trace)
+    if engine in ("prefix_tree", "forward"):
+        with measure(instrumentation, "cross_products"):
+            tree_ot, trace_nodes = create_prefix_tree_from_list(stochastic_lang.keys())
+            if engine == "prefix_tree":
+                prefix_tree_system = get_prefix_tree_cross_product(tree_ot, trace_nodes, srg, var_name2idx_map)
+            else:
+                prefix_tree_system = ForwardTraceSystem(srg, tree_ot, trace_nodes, var_name2idx_map)
+            trace_probs = [prefix_tree_system.get_trace(trace_idx) if prefix_tree_system.has_target(trace_idx)
+                           else None for trace_idx in range(len(stochastic_lang))]
+    else:
+        # the sparse systems refer to the variable indices of this run, so only the symbolic expressions are cached
+        use_cache = cache is not None and engine == "symbolic"
+        traces = list(stochastic_lang.keys())
+        trace_probs = [None] * len(traces)
+        trace_keys = []
+        missing = list(range(len(traces)))
+        if use_cache:
+            net_hash = get_petri_net_hash(pn, im)
+            trace_keys = [get_trace_key(net_hash, engine, trace) for trace in traces]
+            cached_values = cache.get_many(trace_keys)
+            missing = [trace_idx for trace_idx, value in enumerate(cached_values) if value is None]
+            trace_probs = [None if isinstance(value, str) and value == NOT_FITTING else value
+                           for value in cached_values]
+
+        # the symbolic cross products only step on visible labels, the silent paths are solved once per srg state;
+        # the sparse systems keep the silent arcs, their arcs must stay single transitions for the gradient
+        with measure(instrumentation, "silent_closure"):
+            closure = SilentClosure(srg) if engine == "symbolic" else None
+
+        trace_records = {}
+        if instrumentation is not None:
+            for trace_idx, trace in enumerate(traces):
+                trace_records[trace_idx] = {"trace": list(trace), "trace_length": len(trace),
+                                            "weight": float(stochastic_lang[trace]), "cached": True}
+
+        # a trace with an activity that is not a label of the petri net cannot fit, the other traces are scheduled
+        # by their probability mass and their estimated cost
+        label_fan_out = get_label_fan_out(srg)
+        trace_costs = {trace_idx: get_trace_cost(traces[trace_idx], label_fan_out) for trace_idx in missing}
+        for trace_idx in missing:
+            if trace_costs[trace_idx] is None and instrumentation is not None:
+                trace_records[trace_idx]["cached"] = False
+        missing = [trace_idx for trace_idx in missing if trace_costs[trace_idx] is not None]
+        logging.info(f"Computing the cross products of {len(missing)} out of {len(traces)} traces.")
 
-        symbolic_trace_prob = run_with_timeout(trace_it, trace_ot, srg_it, srg_ot, timeout=15)
+        # compute the cross products concurrently, every worker receives the srg once
+        if missing:
+            with measure(instrumentation, "cross_products"), \
+                    TimeoutWorkerPool(get_cross_product_worker, initializer=init_cross_product_worker,
+                                      initargs=(srg, closure, var_name2idx_map,
+                                                None if instrumentation is None else instrumentation.profile_path),
+                                      processes=processes) as pool:
+                tasks = [(traces[trace_idx], engine) for trace_idx in missing]
+                results, attempts, timeouts = run_scheduled_tasks(
+                    pool, tasks, [float(stochastic_lang[traces[trace_idx]]) for trace_idx in missing],
+                    [trace_costs[trace_idx] for trace_idx in missing], timeout=timeout, time_budget=time_budget)
+            cache_items = []
+            for trace_idx, result, trace_attempts, trace_timeout in zip(missing, results, attempts, timeouts):
+                # a trace is skipped if the time budget ran out before it was started
+                skipped = result is UNFINISHED and trace_attempts == 0
+                timed_out = result is UNFINISHED and not skipped
+                failed = result is FAILED
+                if result is not UNFINISHED and not failed:
+                    result, record = result
+                if instrumentation is not None:
+                    trace_records[trace_idx].update({"cached": False, "timed_out": timed_out, "failed": failed,
+                                                     "skipped": skipped, "attempts": trace_attempts,
+                                                     "timeout": trace_timeout})
+                    if result is not UNFINISHED and not failed:
+                        trace_records[trace_idx].update(record)
+                trace_probs[trace_idx] = None if result is UNFINISHED or failed else result
+                # timed out, skipped and failed traces are not cached, they may succeed in a later run
+                if use_cache and result is not UNFINISHED and not failed:
+                    cache_items.append((trace_keys[trace_idx], NOT_FITTING if result is None else result))
+            if cache_items:
+                cache.put_many(cache_items)
+
+        for trace_idx, record in trace_records.items():
+            record.setdefault("fits", trace_probs[trace_idx] is not None)
+            instrumentation.add_trace_record(record)
+
+    for symbolic_trace_prob, (trace, weight) in zip(trace_probs, stochastic_lang.items()):
+        weight_result = float(weight)
 
-        if symbolic_trace_prob == "0":
-            print("trace with 0 prob: ", trace)
+        if symbolic_trace_prob is None:
+            logging.debug(f"Trace with 0 probability: {trace}")
             continue
-        print("find trace with prob:", trace)
         sub_obj = [symbolic_trace_prob, weight_result]
         obj2add.append(sub_obj)
-    # iterate each trace
-    # for trace, weight in stochastic_lang.items():
-    #     # get trace probability
-    #     weight_result = float(weight)
-    #     # get trace incoming and outgoing transitions
-    #     trace_ot, trace_it = create_dfa_from_list(trace)
-    #     CP = ConstructCP()
-    #     symbolic_trace_prob = CP.get_cross_product(trace_it, trace_ot, srg_it, srg_ot)
-    #     print("symbolic: ", symbolic_trace_prob, type(symbolic_trace_prob))
-    #     if symbolic_trace_prob == "0":
-    #         continue
-    #     print("find trace with prob:", trace, symbolic_trace_prob)
-    #     sub_obj = [symbolic_trace_prob, weight_result]
-    #     obj2add.append(sub_obj)
 
     covered_trace = sum(float(sublist[1]) for sublist in obj2add)
     if len(obj2add) == 0:
@@ -96,6 +205,43 @@ def setup(log, pn, im, fm):
     return obj2add, var_name2idx_map, var_idx2name_map, var_lst
 
 
+def load_weights(cache, pn, im, objective, var_idx2name_map, var_lst):
+    """
+    :param cache: the TraceProbabilityCache
+    :param objective: the objective the weights optimise, e.g. "uemsc"
+    :param var_idx2name_map: map value in var_lst to transition
+    :param var_lst: the weights to start from if the cache holds none
+    :return: the weights stored by store_weights as a variable list, a transition that is new to the petri net
+             keeps its weight in var_lst
+    """
+    trans2weight = cache.get_weights(get_weights_key(get_petri_net_hash(pn, im), objective))
+    if trans2weight is None:
+        return var_lst
+    logging.info(f"Starting from the {objective} weights of the previous run.")
+    return [trans2weight.get(var_idx2name_map[var_idx], var_lst[var_idx]) for var_idx in range(len(var_lst))]
+
+
+def store_weights(cache, pn, im, objective, trans2weight):
+    """
+    Store the weights found by a run, the next run with warm_start starts from them.
+    """
+    cache.put_weights(get_weights_key(get_petri_net_hash(pn, im), objective), trans2weight)
+
+
+def load_petri_net(model_path):
+    """
+    :param model_path: the path of a pnml file
+    :return: the petri net, with the names of its transitions as in the file, so the exported slpn matches it, and
+             its markings, which are discovered if the file has none
+    """
+    pn, im, fm = pm4py.read_pnml(model_path, auto_guess_final_marking=True)
+    if not im:
+        im = initial_marking.discover_initial_marking(pn)
+    if not fm:
+        fm = final_marking.discover_final_marking(pn)
+    return pn, im, fm
+
+
 def get_slpn(pn, im):
     # place to number
     idx = 0
@@ -0,0 +1,176 @@
+# This file contains a persistent process pool that enforces a timeout per task.
+# Unlike multiprocessing.Pool, a task that runs over its timeout is killed by terminating only the process
+# running it, which is then replaced, so the other tasks keep running and the pool is not torn down.
+import logging
+import math
+import multiprocessing
+import os
+import signal
+import time
+
+from multiprocessing.connection import wait
+
+
+def _worker_loop(conn, worker, initializer, initargs, process_group):
+    if process_group:
+        os.setpgrp()
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        try:
+            conn.send((True, worker(task)))
+        except Exception as e:
+            conn.send((False, str(e)))
+
+
+class TimeoutWorkerPool(object):
+    def __init__(self, worker, initializer=None, initargs=(), processes=None, context=None, daemon=True,
+                 process_group=False):
+        """
+        :param worker: the function applied to each task, it must be picklable
+        :param initializer: called once with initargs in every worker process, e.g. to receive shared data once
+        :param initargs: the arguments of the initializer
+        :param processes: the number of worker processes, the number of cpus by default
+        :param context: the multiprocessing start method, e.g. "fork", the default one by default
+        :param daemon: whether the worker processes are daemonic, only a non daemonic worker can start processes
+                       itself, e.g. a pool of its own
+        :param process_group: whether every worker runs in a process group of its own, which is killed with it, so
+                              the processes it started do not outlive it
+        """
+        self.worker = worker
+        self.initializer = initializer
+        self.initargs = initargs
+        self.processes = (os.cpu_count() or 1) if processes is None else processes
+        self.daemon = daemon
+        self.process_group = process_group
+        self.__context = multiprocessing.get_context(context)
+        self.__workers = []
+        # the message of every task that raised an error or whose worker died in the last map, by task index
+        self.errors = {}
+        # the indices of the tasks of the last map that were sent to a worker, the others were not started
+        self.submitted = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __start_worker(self):
+        parent_conn, child_conn = self.__context.Pipe()
+        process = self.__context.Process(target=_worker_loop,
+                                         args=(child_conn, self.worker, self.initializer, self.initargs,
+                                               self.process_group),
+                                         daemon=self.daemon)
+        process.start()
+        child_conn.close()
+        self.__workers.append((process, parent_conn))
+        return process, parent_conn
+
+    def __terminate(self, process):
+        if self.process_group:
+            try:
+                os.killpg(process.pid, signal.SIGTERM)
+                return
+            except ProcessLookupError:
+                # the worker was killed before it started its process group
+                pass
+        process.terminate()
+
+    def __kill_worker(self, process, conn):
+        self.__terminate(process)
+        process.join()
+        conn.close()
+        self.__workers.remove((process, conn))
+
+    def map(self, tasks, timeout, default=None, deadline=None, error=None):
+        """
+        Apply the worker to every task concurrently.
+        :param tasks: the tasks
+        :param timeout: the time in seconds after which a single task is killed, None to never kill a task, or a
+                        list with the timeout of every task
+        :param default: the result of a task that timed out or was not started before the deadline
+        :param deadline: the time.time() at which the running tasks are killed and no more tasks are started
+        :param error: the result of a task that raised an error or whose worker died, default if None, the message of
+                      the error is kept in errors
+        :return: the results, in the order of the tasks
+        """
+        tasks = list(tasks)
+        self.errors = {}
+        self.submitted = set()
+        timeouts = list(timeout) if isinstance(timeout, (list, tuple)) else [timeout] * len(tasks)
+        deadline = math.inf if deadline is None else deadline
+        results = [default] * len(tasks)
+        error = default if error is None else error
+        while len(self.__workers) < min(self.processes, len(tasks)):
+            self.__start_worker()
+
+        next_task = 0
+        idle = list(self.__workers)
+        running = {}
+        while next_task < len(tasks) or running:
+            if time.time() >= deadline:
+                next_task = len(tasks)
+            while idle and next_task < len(tasks):
+                process, conn = idle.pop()
+                conn.send(tasks[next_task])
+                self.submitted.add(next_task)
+                task_timeout = timeouts[next_task]
+                running[conn] = (process, next_task,
+                                 min(deadline, math.inf if task_timeout is None else time.time() + task_timeout))
+                next_task += 1
+            if not running:
+                break
+
+            wait_time = max(0.0, min(task_deadline for _, _, task_deadline in running.values()) - time.time())
+            if math.isinf(wait_time):
+                wait_time = None
+            for conn in wait(list(running.keys()), timeout=wait_time):
+                process, task_idx, _ = running.pop(conn)
+                try:
+                    success, result = conn.recv()
+                except EOFError:
+                    # the worker died, e.g. it ran out of memory
+                    logging.warning(f"Worker died on task {task_idx}")
+                    results[task_idx] = error
+                    self.__kill_worker(process, conn)
+                    self.errors[task_idx] = f"The worker died with exit code {process.exitcode}."
+                    if next_task < len(tasks):
+                        idle.append(self.__start_worker())
+                    continue
+                if success:
+                    results[task_idx] = result
+                else:
+                    logging.warning(f"Function error: {result}")
+                    results[task_idx] = error
+                    self.errors[task_idx] = result
+                idle.append((process, conn))
+
+            now = time.time()
+            for conn, (process, task_idx, task_deadline) in list(running.items()):
+                if task_deadline <= now:
+                    del running[conn]
+                    self.__kill_worker(process, conn)
+                    if next_task < len(tasks):
+                        idle.append(self.__start_worker())
+        return results
+
+    def close(self):
+        for process, conn in self.__workers:
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for process, conn in self.__workers:
+            process.join(timeout=1)
+            if process.is_alive():
+                self.__terminate(process)
+                process.join()
+            conn.close()
+        self.__workers = []
@@ -0,0 +1,43 @@
+# regression test of the cross products on a petri net whose silent transitions form a loop
+import numpy as np
+import pytest
+from pm4py.objects.petri_net.obj import Marking, PetriNet
+from pm4py.objects.petri_net.utils.petri_utils import add_arc_from_to
+
+from slpn_miner.expression_dag import compile_expression_dag
+from slpn_miner.util import setup
+
+
+def get_silent_loop_net():
+    """
+    :return: the petri net p1 -tau-> p2 -tau-> p1, which leaves p1 by a and p2 by b, with its initial and final marking
+    """
+    pn = PetriNet("silent_loop")
+    places = {name: PetriNet.Place(name) for name in ("p1", "p2", "p3")}
+    for place in places.values():
+        pn.places.add(place)
+    for name, label, place_from, place_to in (("t1", None, "p1", "p2"), ("t2", None, "p2", "p1"),
+                                              ("t3", "a", "p1", "p3"), ("t4", "b", "p2", "p3")):
+        transition = PetriNet.Transition(name, label)
+        pn.transitions.add(transition)
+        add_arc_from_to(places[place_from], transition, pn)
+        add_arc_from_to(transition, places[place_to], pn)
+    return pn, Marking({places["p1"]: 1}), Marking({places["p3"]: 1})
+
+
+@pytest.mark.parametrize("engine", ["symbolic", "sparse", "prefix_tree", "forward"])
+def test_silent_loop(engine):
+    pn, im, fm = get_silent_loop_net()
+    stochastic_lang = {("a",): 0.5, ("b",): 0.5}
+    obj2add, var_name2idx_map, var_idx2name_map, _ = setup(stochastic_lang, pn, im, fm, engine=engine, processes=1)
+    assert len(obj2add) == 2
+
+    # with unit weights, a is fired from p1 with probability 1/2 + 1/4 * P(a)
+    weights = np.ones(len(var_idx2name_map))
+    if engine == "symbolic":
+        probabilities = compile_expression_dag([obj[0] for obj in obj2add], var_name2idx_map).probabilities(weights)
+    else:
+        probabilities = [obj[0].system.probabilities(weights)[obj[0].trace_idx] for obj in obj2add]
+    trace_probs = {trace: probability for trace, probability in zip(stochastic_lang, probabilities)}
+    assert trace_probs[("a",)] == pytest.approx(2 / 3)
+    assert trace_probs[("b",)] == pytest.approx(1 / 3)